@@ -0,0 +1,215 @@
+"""Throughput, latency, CPU and memory of a cluster of ZMQManagers.
+
+Starts N instances on localhost, each in its own process, and introduces them
+to each other by putting discovery tuples straight into discover_events, so
+there's no Zeroconf or UI involved. Every instance then sends chat messages
+through send_message() at a fixed rate for a while, either broadcast or
+round-robin to one peer at a time, and times every message it receives.
+
+Send timestamps travel inside the messages and are compared against
+time.time_ns() on receipt, so latencies are end to end across processes.
+
+Exits non-zero if any message went missing, for use as a regression check.
+
+    $ python -m bench.cluster --instances 4 --rate 200 --size 256 --json -
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import statistics
+import sys
+import threading
+import time
+
+from bench.poll_loop import wait_for
+from bench.scaling import rss_kb
+from lib.net.zmq import PORT_SPAN, TransportMode, ZMQEventType, ZMQManager
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+BROADCAST = "broadcast"
+DIRECT = "direct"
+
+
+def percentile(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def instance(i: int, args, barrier, results):
+    name = f"node-{i}"
+    others = [n for n in range(args.instances) if n != i]
+    zmq = ZMQManager(name, args.port + PORT_SPAN * i, mode=TransportMode[args.mode])
+    metadata = {"caps": "zlib" if args.compress else ""}
+    for n in others:
+        address = f"127.0.0.1:{args.port + PORT_SPAN * n}"
+        zmq.discover_events.put((f"node-{n}", address, metadata))
+    for _ in others:
+        wait_for(zmq, ZMQEventType.SOCKET_ADDED)
+
+    latencies = []
+
+    def receive():
+        for event in zmq.get_events():
+            if event.type == ZMQEventType.MESSAGE_RECEIVED:
+                sent_ns = int(event.payload[1].payload.content.split(":", 1)[0])
+                latencies.append((time.time_ns() - sent_ns) / 1e9)
+
+    threading.Thread(target=receive, daemon=True).start()
+
+    # everyone is connected to everyone. ride out the slow joiner window
+    barrier.wait()
+    time.sleep(0.5)
+
+    cpu, start = time.process_time(), time.perf_counter()
+    sent = 0
+    interval = 1 / args.rate
+    while True:
+        # keep to the schedule rather than sleeping a fixed interval, so
+        # time spent sending doesn't slow the rate down
+        due = start + sent * interval
+        now = time.perf_counter()
+        if now - start >= args.duration:
+            break
+        if due > now:
+            time.sleep(due - now)
+        to = f"node-{others[sent % len(others)]}" if args.pattern == DIRECT else None
+        timestamp = f"{time.time_ns()}:"
+        content = timestamp + "x" * max(0, args.size - len(timestamp))
+        zmq.send_message(
+            EventMessage(
+                type=EventType.MESSAGE_SENT,
+                payload=ChatMessagePayload(content=content, author=name, to=to or "*"),
+            ),
+            to=to,
+        )
+        sent += 1
+
+    # give the last messages time to arrive before counting
+    time.sleep(args.drain)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    received = list(latencies)
+
+    results.put(
+        {
+            "name": name,
+            "sent": sent,
+            "received": len(received),
+            "msgs_per_s": len(received) / args.duration,
+            "p50_ms": statistics.median(received) * 1e3 if received else 0.0,
+            "p99_ms": percentile(received, 0.99) * 1e3,
+            "cpu_percent": 100 * cpu / elapsed,
+            "rss_kb": rss_kb(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "latencies": received,
+        }
+    )
+    barrier.wait()
+    zmq.close()
+
+
+def run(args) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(args.instances)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=instance, args=(i, args, barrier, results))
+        for i in range(args.instances)
+    ]
+    for process in processes:
+        process.start()
+    instances = sorted(
+        (results.get() for _ in processes), key=lambda r: int(r["name"][5:])
+    )
+    for process in processes:
+        process.join()
+
+    latencies = [l for r in instances for l in r.pop("latencies")]
+    expected = sum(r["sent"] for r in instances) * (
+        args.instances - 1 if args.pattern == BROADCAST else 1
+    )
+    return {
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "instances",
+                "rate",
+                "size",
+                "duration",
+                "pattern",
+                "mode",
+                "compress",
+            )
+        },
+        "total": {
+            "sent": sum(r["sent"] for r in instances),
+            "received": len(latencies),
+            "expected": expected,
+            "msgs_per_s": len(latencies) / args.duration,
+            "p50_ms": statistics.median(latencies) * 1e3 if latencies else 0.0,
+            "p99_ms": percentile(latencies, 0.99) * 1e3,
+        },
+        "instances": instances,
+    }
+
+
+def print_table(report: dict):
+    print(
+        f"{'instance':>8} {'sent':>8} {'received':>8} {'msgs/s':>9} {'p50':>9}"
+        f" {'p99':>9} {'cpu':>7} {'rss':>9}"
+    )
+    for r in report["instances"]:
+        print(
+            f"{r['name']:>8} {r['sent']:8d} {r['received']:8d}"
+            f" {r['msgs_per_s']:9.1f} {r['p50_ms']:7.3f}ms {r['p99_ms']:7.3f}ms"
+            f" {r['cpu_percent']:6.1f}% {r['rss_kb'] / 1024:6.1f}MiB"
+        )
+    total = report["total"]
+    print(
+        f"{'total':>8} {total['sent']:8d} {total['received']:8d}"
+        f" {total['msgs_per_s']:9.1f} {total['p50_ms']:7.3f}ms"
+        f" {total['p99_ms']:7.3f}ms"
+    )
+    if total["received"] < total["expected"]:
+        print(f"lost {total['expected'] - total['received']} of {total['expected']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=4, help="Processes")
+    parser.add_argument("--rate", type=float, default=100, help="Msgs/s per instance")
+    parser.add_argument("--size", type=int, default=64, help="Chat content bytes")
+    parser.add_argument("--duration", type=float, default=5.0, help="Send seconds")
+    parser.add_argument(
+        "--drain", type=float, default=1.0, help="Seconds to wait after"
+    )
+    parser.add_argument("--pattern", choices=(BROADCAST, DIRECT), default=BROADCAST)
+    parser.add_argument(
+        "--mode", choices=[m.name for m in TransportMode], default="PER_PEER"
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Advertise zlib to every instance"
+    )
+    parser.add_argument("--port", type=int, default=22000, help="First port to use")
+    parser.add_argument(
+        "--json", metavar="PATH", help="Also write the report as JSON, - for stdout"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run(args)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        print_table(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=1)
+    total = report["total"]
+    sys.exit(1 if total["received"] < total["expected"] else 0)
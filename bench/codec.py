@@ -0,0 +1,76 @@
+"""Encode/decode cost and size on the wire of the EventMessage codecs.
+
+"json (legacy)" is what ZMQManager did before lib.net.codec existed:
+dataclasses.asdict() and json.dumps() out, json.loads() into an untyped dict.
+
+    $ python -m bench.codec
+"""
+import argparse
+import dataclasses
+import json
+import timeit
+from uuid import uuid4
+
+from lib.net.codec import CODECS
+from lib.ui.event import (
+    ChatMessagePayload,
+    EventMessage,
+    EventType,
+    Status,
+    StatusChangedPayload,
+    UsernameChangedPayload,
+)
+
+
+def sample_messages(content_size: int) -> dict:
+    alice, bob = str(uuid4()), str(uuid4())
+    return {
+        "chat": EventMessage(
+            type=EventType.MESSAGE_SENT,
+            payload=ChatMessagePayload(
+                content="x" * content_size, author=alice, to=bob
+            ),
+        ),
+        "status": EventMessage(
+            type=EventType.FRIEND_STATUS_CHANGED,
+            payload=StatusChangedPayload(id=alice, status=Status.AWAY),
+        ),
+        "username": EventMessage(
+            type=EventType.USERNAME_CHANGED,
+            payload=UsernameChangedPayload(id=alice, username="officepal-alice"),
+        ),
+    }
+
+
+def legacy_encode(message: EventMessage) -> bytes:
+    return json.dumps(dataclasses.asdict(message)).encode()
+
+
+def ns_per_call(fn, arg, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number * 1e9
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--content-size", type=int, default=64, help="Chat bytes")
+    parser.add_argument("--number", type=int, default=20000, help="Calls per run")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    codecs = {
+        "json (legacy)": (legacy_encode, json.loads),
+        "json": (CODECS["json"].encode, CODECS["json"].decode),
+        "binary": (CODECS["binary"].encode, CODECS["binary"].decode),
+    }
+    print(f"{'message':>8} {'codec':>13} {'encode':>10} {'decode':>10} {'bytes':>6}")
+    for kind, message in sample_messages(args.content_size).items():
+        for name, (encode, decode) in codecs.items():
+            data = encode(message)
+            print(
+                f"{kind:>8} {name:>13} "
+                f"{ns_per_call(encode, message, args.number):8.0f}ns "
+                f"{ns_per_call(decode, data, args.number):8.0f}ns "
+                f"{len(data):6d}"
+            )
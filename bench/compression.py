@@ -0,0 +1,121 @@
+"""Where zlib compression of outgoing frames starts paying off on loopback.
+
+For a range of chat message sizes, measures the CPU cost of compress() and
+decompress() and the direct message latency between two managers over
+localhost, once with compression off and once with it forced on. Messages are
+pseudo-random prose, which compresses about as well as a real paste does.
+
+Loopback moves bytes for free, so there compression only ever adds latency.
+The "break-even" column is the link speed below which the bytes it saves
+take longer to send than compressing and inflating them does.
+
+    $ python -m bench.compression
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import timeit
+
+from lib.net.codec import CODECS, compress, decompress
+from lib.net.zmq import PORT_SPAN, AsyncZMQManager, ZMQEventType
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+SIZES = (64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or "
+    "his from at which but have an they you were her she there been one all "
+    "would their we him has when who will more no if out so said what up its "
+    "about into than them can only other new some could time these two may "
+    "then do first any my now such like our over man me even most made after "
+    "def return self import none true false class for while lambda yield "
+    "lanmessenger zeroconf subscriber publisher socket friend message status"
+).split()
+
+
+def prose(size: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def chat(size: int, seed: int = 0) -> EventMessage:
+    return EventMessage(
+        type=EventType.MESSAGE_SENT,
+        payload=ChatMessagePayload(
+            content=prose(size, seed), author="sender", to="receiver"
+        ),
+    )
+
+
+def us_per_call(fn, arg, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number * 1e6
+
+
+async def latency(port: int, size: int, count: int, threshold) -> list:
+    """Seconds from send() on one manager to MESSAGE_RECEIVED on another."""
+    sender = AsyncZMQManager("sender", port, compression_threshold=threshold)
+    receiver = AsyncZMQManager("receiver", port + PORT_SPAN)
+    address = f"127.0.0.1:{port + PORT_SPAN}"
+    sender.on_discovered("receiver", address, {"caps": "zlib"})
+    events = receiver.events()
+
+    messages = [chat(size, seed=i) for i in range(count + 10)]
+    samples = []
+    for i, message in enumerate(messages):
+        start = time.perf_counter()
+        await sender.send(message, to="receiver")
+        async for event in events:
+            if event.type == ZMQEventType.MESSAGE_RECEIVED:
+                break
+        # the first few warm up the connection
+        if i >= 10:
+            samples.append(time.perf_counter() - start)
+
+    sender.close()
+    receiver.close()
+    return samples
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=21000, help="First port to use")
+    parser.add_argument("--count", type=int, default=500, help="Messages per size")
+    parser.add_argument("--number", type=int, default=2000, help="Calls per run")
+    return parser.parse_args()
+
+
+async def main(args):
+    codec = CODECS["binary"]
+    print(
+        f"{'size':>6} {'wire':>6} {'zlib':>6} {'compress':>9} {'inflate':>9}"
+        f" {'raw p50':>9} {'zlib p50':>9} {'break-even':>12}"
+    )
+    for i, size in enumerate(SIZES):
+        data = codec.encode(chat(size))
+        packed = compress(data, threshold=0)
+        port = args.port + 4 * PORT_SPAN * i
+        raw = await latency(port, size, args.count, threshold=None)
+        zipped = await latency(port + 2 * PORT_SPAN, size, args.count, threshold=0)
+        deflate = us_per_call(lambda d: compress(d, threshold=0), data, args.number)
+        inflate = us_per_call(decompress, packed, args.number)
+        # bits saved per microsecond spent is Mbit/s
+        break_even = 8 * (len(data) - len(packed)) / (deflate + inflate)
+        print(
+            f"{size:6d} {len(data):6d} {len(packed):6d}"
+            f" {deflate:7.1f}us {inflate:7.1f}us"
+            f" {statistics.median(raw) * 1e6:7.1f}us"
+            f" {statistics.median(zipped) * 1e6:7.1f}us"
+            f" {break_even:7.0f}Mbit/s"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
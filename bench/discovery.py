@@ -0,0 +1,112 @@
+"""How long an AsyncZeroconfManager takes to discover a whole LAN.
+
+Registers a number of fake peers over real mDNS on this machine, then starts
+a manager browsing for them and times how long it takes for every one to be
+handed to on_discovered, at a few caps on concurrent resolutions.
+
+Peers that are already up when we start mostly get answered out of
+zeroconf's record cache. --late brings them up after we start browsing,
+so more of them need a query each. --dead adds peers whose host never
+answers for its address, which hold a resolution slot until
+RESOLVE_TIMEOUT_MS, and are where the cap shows.
+
+    $ python -m bench.discovery --peers 100 --dead 10 --late
+"""
+import argparse
+import asyncio
+import ipaddress
+import time
+
+from zeroconf import ServiceInfo
+from zeroconf.asyncio import AsyncZeroconf
+
+from lib.metrics import REGISTRY
+from lib.net.zeroconf import ZEROCONF_TYPE, AsyncZeroconfManager
+
+LOCALHOST = ipaddress.ip_address("127.0.0.1")
+
+
+def service(i: int, port: int, dead: bool = False) -> ServiceInfo:
+    return ServiceInfo(
+        type_=ZEROCONF_TYPE,
+        name=f"bench-{i}.{ZEROCONF_TYPE}",
+        port=port + 2 * i,
+        addresses=[] if dead else [LOCALHOST.packed],
+        properties={"username": f"bench-{i}"},
+        # nobody answers for this host, so its address never resolves
+        server=f"bench-dead-{i}.local." if dead else None,
+    )
+
+
+async def discover(args, max_resolving: int) -> float:
+    """Seconds from the manager starting to it having every peer."""
+    everyone = asyncio.Event()
+    found = set()
+
+    def on_discovered(name, address, metadata):
+        if address:
+            found.add(name)
+            if len(found) == args.peers:
+                everyone.set()
+
+    responder = AsyncZeroconf()
+    services = [service(i, args.port) for i in range(args.peers)]
+    services += [
+        service(args.peers + i, args.port, dead=True) for i in range(args.dead)
+    ]
+
+    async def register():
+        await asyncio.gather(*(responder.async_register_service(s) for s in services))
+
+    if not args.late:
+        await register()
+
+    manager = AsyncZeroconfManager(
+        "bench-observer",
+        {},
+        [LOCALHOST],
+        args.port - 2,
+        on_discovered,
+        max_resolving=max_resolving,
+    )
+    start = time.monotonic()
+    await manager.start()
+    if args.late:
+        await register()
+    try:
+        await asyncio.wait_for(everyone.wait(), args.timeout)
+        elapsed = time.monotonic() - start
+    except asyncio.TimeoutError:
+        elapsed = float("inf")
+    await manager.close()
+    await asyncio.gather(*(responder.async_unregister_service(s) for s in services))
+    await responder.async_close()
+    return elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=50, help="Fake peers")
+    parser.add_argument("--dead", type=int, default=0, help="Unresolvable peers")
+    parser.add_argument("--late", action="store_true", help="Register after browsing")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up after")
+    parser.add_argument("--port", type=int, default=25000, help="First port to use")
+    parser.add_argument(
+        "--caps", type=int, nargs="+", default=[1, 8, 32], help="max_resolving values"
+    )
+    return parser.parse_args()
+
+
+async def main(args):
+    print(f"{'cap':>4} {'all found':>10} {'cached':>7} {'queried':>8}")
+    for cap in args.caps:
+        cached = REGISTRY.counter("zeroconf.resolve_cached").read()
+        queried = REGISTRY.histogram("zeroconf.resolve_time").count
+        elapsed = await discover(args, cap)
+        cached = REGISTRY.counter("zeroconf.resolve_cached").read() - cached
+        queried = REGISTRY.histogram("zeroconf.resolve_time").count - queried
+        print(f"{cap:4d} {elapsed:9.2f}s {cached:7d} {queried:8d}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
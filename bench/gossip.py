@@ -0,0 +1,87 @@
+"""How long peer exchange takes to spread membership, by cluster size.
+
+Starts N AsyncZMQManagers on localhost in one process, with no Zeroconf.
+Each runs Gossip with node 0 as its only seed, and hands whatever gossip
+finds straight to its manager's on_discovered(). Times how long it takes
+until every manager knows every other, in seconds and in gossip rounds.
+
+Epidemic spread should take a number of rounds that grows with log N. Every
+node shares this one process, so with a short --interval big clusters run
+out of CPU before they run out of rounds.
+
+    $ python -m bench.gossip --sizes 4 8 16 32 64
+"""
+import argparse
+import asyncio
+import ipaddress
+import time
+
+import zmq
+import zmq.asyncio
+
+from lib.net.gossip import GOSSIP_CAPABILITY, Gossip
+from lib.net.zmq import PORT_SPAN, AsyncZMQManager, TransportMode
+
+LOCALHOST = ipaddress.ip_address("127.0.0.1")
+
+
+async def converge(size: int, args) -> float:
+    """Seconds until all `size` managers know each other."""
+    managers, gossips = [], []
+    for i in range(size):
+        port = args.port + PORT_SPAN * i
+        manager = AsyncZMQManager(
+            f"node-{i}", port, mode=TransportMode.MULTIPLEXED, pool_size=0
+        )
+        gossip = Gossip(
+            manager,
+            [LOCALHOST],
+            port,
+            {"username": f"node-{i}", "caps": GOSSIP_CAPABILITY},
+            on_discovered=manager.on_discovered,
+            seeds=[f"127.0.0.1:{args.port}"] if i else [],
+            interval=args.interval,
+        )
+        managers.append(manager)
+        gossips.append(gossip)
+
+    start = time.monotonic()
+    for gossip in gossips:
+        gossip.start()
+    elapsed = float("inf")
+    while time.monotonic() - start < args.timeout:
+        if all(len(m.peers) == size - 1 for m in managers):
+            elapsed = time.monotonic() - start
+            break
+        await asyncio.sleep(args.interval / 10)
+
+    for gossip in gossips:
+        gossip.close()
+    for manager in managers:
+        manager.close()
+    return elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[2, 4, 8, 16, 32], help="Nodes"
+    )
+    parser.add_argument("--interval", type=float, default=0.1, help="Gossip period")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Give up after")
+    parser.add_argument("--port", type=int, default=28000, help="First port to use")
+    return parser.parse_args()
+
+
+async def main(args):
+    # every node has a socket per peer it talks to directly
+    zmq.asyncio.Context.instance().set(zmq.MAX_SOCKETS, 65536)
+    print(f"{'nodes':>5} {'converged':>10} {'rounds':>7}")
+    for i, size in enumerate(args.sizes):
+        args.port += PORT_SPAN * max(args.sizes) * min(i, 1)
+        elapsed = await converge(size, args)
+        print(f"{size:5d} {elapsed:9.2f}s {elapsed / args.interval:7.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,88 @@
+"""How long merging a batch of changes into a mesh log holds the state lock,
+as the log grows.
+
+Builds a log of each size with every other seqno missing, as after a
+partition, then merges batches of --batch changes at random missing seqnos,
+as anti-entropy would. Times that against the flat list it replaced, which
+appended each change and re-sorted whenever one landed out of order, and
+times apply_state_changes() as a whole, which also updates the range sums.
+
+    $ python -m bench.merge --sizes 10000 100000 1000000 --batch 64
+"""
+import argparse
+import random
+import time
+
+from lib.net.mesh.change import StateChange, StateEvent
+from lib.net.mesh.node import InMemSharedState
+from lib.net.mesh.sortedlog import SortedLog
+
+
+def changes_at(seqnos, value: bytes):
+    return [StateChange(seqno, StateEvent.VERIFY, value, ts=0) for seqno in seqnos]
+
+
+def sorted_list(log: list, batch):
+    for change in batch:
+        log.append(change)
+        if len(log) > 1 and log[-2].seqno > change.seqno:
+            log.sort(key=lambda c: c.seqno)
+
+
+def timed(fn, batches) -> float:
+    started = time.perf_counter()
+    for batch in batches:
+        fn(batch)
+    return (time.perf_counter() - started) / len(batches)
+
+
+def run(size: int, args):
+    value = b"x" * args.value_size
+    history = changes_at(range(0, 2 * size, 2), value)
+    missing = random.sample(range(1, 2 * size, 2), args.batch * args.rounds)
+    batches = [
+        sorted(changes_at(missing[i : i + args.batch], value), key=lambda c: c.seqno)
+        for i in range(0, len(missing), args.batch)
+    ]
+
+    flat = list(history)
+    before = timed(lambda batch: sorted_list(flat, batch), batches)
+    log = SortedLog(history)
+    after = timed(log.update, batches)
+    assert [c.seqno for c in log] == [c.seqno for c in flat]
+
+    state = InMemSharedState(0)
+    state.apply_state_changes(history)
+    whole = timed(state.apply_state_changes, batches)
+    print(
+        f"{size:>9} {before * 1e3:10.3f}ms {after * 1e3:10.3f}ms"
+        f" {whole * 1e3:10.3f}ms {before / after:8.0f}x"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="Entries",
+    )
+    parser.add_argument("--batch", type=int, default=64, help="Changes per batch")
+    parser.add_argument("--rounds", type=int, default=20, help="Batches to time")
+    parser.add_argument("--value-size", type=int, default=64, help="Bytes per value")
+    return parser.parse_args()
+
+
+def main(args):
+    print(
+        f"{'entries':>9} {'list+sort':>12} {'SortedLog':>12}"
+        f" {'apply':>12} {'speedup':>9}"
+    )
+    for size in args.sizes:
+        run(size, args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,107 @@
+"""How long mesh Nodes take to reconcile their logs after a partition, and
+how many bytes it takes.
+
+Starts N Nodes on localhost in one process, fully connected, and has every
+node append --entries values so they share a history. Then splits them into
+two halves that can't hear each other, and has every node append --diverge
+more, so both halves write to the same seqnos. Once the halves are joined
+up again, times how long anti-entropy takes to get every node's log
+identical, and counts the bytes sent doing it, against what it would cost
+for every node to send its whole log to every other.
+
+    $ python -m bench.mesh --nodes 4 --entries 10000 --diverge 100
+"""
+import argparse
+import time
+
+from lib.net.mesh.node import Node
+
+HOST = "127.0.0.1"
+
+
+def sent_bytes(nodes) -> int:
+    return sum(node.bytes_sent.read() for node in nodes)
+
+
+def connect(a: Node, b: Node):
+    a.add_peer(HOST, b.port)
+    b.add_peer(HOST, a.port)
+
+
+def run_until_converged(nodes, timeout: float) -> float:
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        for node in nodes:
+            node.synchronize(timeout=0)
+        fingerprints = {node.shared_state.fingerprint() for node in nodes}
+        if len(fingerprints) == 1:
+            return time.monotonic() - start
+        time.sleep(0.001)
+    return float("inf")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=4, help="Nodes, at least 2")
+    parser.add_argument("--entries", type=int, default=10000, help="Shared history")
+    parser.add_argument("--diverge", type=int, default=100, help="Per node, split")
+    parser.add_argument("--size", type=int, default=64, help="Bytes per value")
+    parser.add_argument("--interval", type=float, default=0.05, help="Anti-entropy")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Give up after")
+    parser.add_argument("--port", type=int, default=30000, help="First port to use")
+    return parser.parse_args()
+
+
+def main(args):
+    nodes = [
+        Node(i, HOST, args.port + i, anti_entropy_interval=args.interval)
+        for i in range(args.nodes)
+    ]
+    for i, a in enumerate(nodes):
+        for b in nodes[i + 1 :]:
+            connect(a, b)
+    value = b"x" * args.size
+
+    # the shared history, a node at a time, so there are no collisions
+    for i in range(args.entries):
+        nodes[i % len(nodes)].append_state(value)
+        if i % 100 == 0:
+            for node in nodes:
+                node.synchronize(timeout=0)
+    took = run_until_converged(nodes, args.timeout)
+    print(f"{len(nodes)} nodes agree on {len(nodes[0].shared_state)} entries")
+    print(f"history:   {took:7.3f}s")
+
+    half = len(nodes) // 2
+    left, right = nodes[:half], nodes[half:]
+    for a in left:
+        for b in right:
+            a.remove_peer(HOST, b.port)
+            b.remove_peer(HOST, a.port)
+    for _ in range(args.diverge):
+        for node in nodes:
+            node.append_state(value)
+        for node in nodes:
+            node.synchronize(timeout=0)
+    run_until_converged(left, args.timeout)
+    run_until_converged(right, args.timeout)
+
+    before = sent_bytes(nodes)
+    for a in left:
+        for b in right:
+            connect(a, b)
+    took = run_until_converged(nodes, args.timeout)
+    sent = sent_bytes(nodes) - before
+    log_bytes = sum(len(c.state) + 32 for c in nodes[0].shared_state)
+    naive = log_bytes * len(nodes) * (len(nodes) - 1)
+    print(f"partition: {took:7.3f}s to converge on {len(nodes[0].shared_state)}")
+    print(
+        f"sent:      {sent / 1024:7.1f}KiB, against {naive / 1024:.1f}KiB"
+        f" for everyone to send everyone everything"
+    )
+    for node in nodes:
+        node.close()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,66 @@
+"""Encode/decode cost and size on the wire of mesh messages, against the
+pickle ZMQTransport used before lib.net.mesh.codec existed.
+
+"append" is the ENTRIES broadcast of a single new change, "batch" an
+anti-entropy ENTRIES reply carrying --batch changes, and "digest" the
+DIGEST of --ranges top level sums.
+
+    $ python -m bench.mesh_codec --batch 64 --value-size 64
+"""
+import argparse
+import os
+import pickle
+import random
+import timeit
+
+from lib.net.mesh.change import StateChange, StateEvent
+from lib.net.mesh.codec import DIGEST, ENTRIES, MessageCodec
+
+
+def sample_messages(args) -> dict:
+    def change(seqno: int) -> StateChange:
+        value = os.urandom(args.value_size)
+        return StateChange(seqno, StateEvent.VERIFY, value, node_id=seqno % 8)
+
+    return {
+        "append": (ENTRIES, 1, [change(0)], []),
+        "batch": (ENTRIES, 1, [change(i) for i in range(args.batch)], [1, 2, 3]),
+        "digest": (
+            DIGEST,
+            1,
+            {i: random.getrandbits(64) for i in range(args.ranges)},
+        ),
+    }
+
+
+def ns_per_call(fn, arg, number: int) -> float:
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number * 1e9
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch", type=int, default=64, help="Changes per batch")
+    parser.add_argument("--value-size", type=int, default=64, help="Bytes per value")
+    parser.add_argument("--ranges", type=int, default=16, help="Sums in a digest")
+    parser.add_argument("--number", type=int, default=2000, help="Calls per run")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    codec = MessageCodec()
+    codecs = {
+        "pickle": (pickle.dumps, pickle.loads),
+        "struct": (codec.encode, codec.decode),
+    }
+    print(f"{'message':>8} {'codec':>7} {'encode':>10} {'decode':>10} {'bytes':>7}")
+    for kind, message in sample_messages(args).items():
+        for name, (encode, decode) in codecs.items():
+            data = bytes(encode(message))
+            assert decode(data) == message
+            print(
+                f"{kind:>8} {name:>7} "
+                f"{ns_per_call(encode, message, args.number):8.0f}ns "
+                f"{ns_per_call(decode, data, args.number):8.0f}ns "
+                f"{len(data):7d}"
+            )
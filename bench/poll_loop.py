@@ -0,0 +1,134 @@
+"""Idle CPU and receive latency of the ZMQManager receive loop.
+
+Runs entirely on localhost without Zeroconf: peers are fed to the manager by
+putting discovery tuples straight into discover_events.
+
+    $ python -m bench.poll_loop
+"""
+import argparse
+import statistics
+import time
+
+from lib.net.zmq import (
+    PORT_SPAN,
+    PUBLISHER_PORT_OFFSET,
+    Publisher,
+    ZMQEventType,
+    ZMQManager,
+)
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+
+def wait_for(manager: ZMQManager, type: ZMQEventType):
+    for event in manager.get_events():
+        if event.type == type:
+            return event
+
+
+def idle_cpu(port: int, peers: int, duration: float) -> float:
+    """Percent of one core burnt by a manager subscribed to idle peers."""
+    publishers = [
+        Publisher(
+            name=f"idle-{i}",
+            cxn=f"tcp://127.0.0.1:{port + PORT_SPAN * (i + 1) + PUBLISHER_PORT_OFFSET}",
+        )
+        for i in range(peers)
+    ]
+    manager = ZMQManager("idle-receiver", port)
+    for i in range(peers):
+        address = f"127.0.0.1:{port + PORT_SPAN * (i + 1)}"
+        manager.discover_events.put((f"idle-{i}", address, {"caps": ""}))
+    for _ in range(peers):
+        wait_for(manager, ZMQEventType.SOCKET_ADDED)
+
+    time.sleep(0.5)
+    cpu, wall = time.process_time(), time.perf_counter()
+    time.sleep(duration)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    manager.close()
+    for publisher in publishers:
+        publisher.close()
+    return 100 * cpu / wall
+
+
+def discovery_latency(port: int, rounds: int) -> list:
+    """Seconds from a discovery tuple being queued to SOCKET_ADDED."""
+    manager = ZMQManager("discovery-receiver", port)
+    samples = []
+    for i in range(rounds):
+        # land somewhere random in the receive loop's cycle
+        time.sleep(0.013 * (i % 8))
+        start = time.perf_counter()
+        address = f"127.0.0.1:{port + PORT_SPAN}"
+        manager.discover_events.put((f"peer-{i}", address, {"caps": ""}))
+        wait_for(manager, ZMQEventType.SOCKET_ADDED)
+        samples.append(time.perf_counter() - start)
+        manager.discover_events.put((f"peer-{i}", None, None))
+        wait_for(manager, ZMQEventType.SOCKET_REMOVED)
+    manager.close()
+    return samples
+
+
+def message_latency(port: int, count: int, interval: float, direct=False) -> list:
+    """Seconds from send_message() on one manager to MESSAGE_RECEIVED on another.
+
+    Broadcasts go over PUB/SUB, direct messages over the unicast channel.
+    """
+    sender = ZMQManager("sender", port)
+    receiver = ZMQManager("receiver", port + PORT_SPAN)
+    receiver.discover_events.put(("sender", f"127.0.0.1:{port}", {"caps": ""}))
+    wait_for(receiver, ZMQEventType.SOCKET_ADDED)
+    address = f"127.0.0.1:{port + PORT_SPAN}"
+    sender.discover_events.put(("receiver", address, {"caps": ""}))
+    wait_for(sender, ZMQEventType.SOCKET_ADDED)
+    to = "receiver" if direct else None
+    # ride out the PUB/SUB slow joiner window
+    time.sleep(0.5)
+
+    samples = []
+    for i in range(count):
+        time.sleep(interval)
+        start = time.perf_counter()
+        sender.send_message(
+            EventMessage(
+                type=EventType.MESSAGE_SENT,
+                payload=ChatMessagePayload(
+                    content=str(i), author="sender", to=to or "*"
+                ),
+            ),
+            to=to,
+        )
+        wait_for(receiver, ZMQEventType.MESSAGE_RECEIVED)
+        samples.append(time.perf_counter() - start)
+
+    receiver.close()
+    sender.close()
+    return samples
+
+
+def fmt_ms(samples: list) -> str:
+    samples = sorted(samples)
+    p50 = statistics.median(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50={p50 * 1000:8.3f}ms p99={p99 * 1000:8.3f}ms"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=18000, help="First port to use")
+    parser.add_argument("--peers", type=int, default=10, help="Idle peers")
+    parser.add_argument("--duration", type=float, default=5.0, help="Idle seconds")
+    parser.add_argument("--count", type=int, default=200, help="Messages to time")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cpu = idle_cpu(args.port, args.peers, args.duration)
+    print(f"idle cpu ({args.peers} peers): {cpu:6.2f}%")
+    print(f"discovery latency:      {fmt_ms(discovery_latency(args.port + 100, 50))}")
+    latencies = message_latency(args.port + 200, args.count, 0.01)
+    print(f"broadcast latency:      {fmt_ms(latencies)}")
+    latencies = message_latency(args.port + 300, args.count, 0.01, direct=True)
+    print(f"direct latency:         {fmt_ms(latencies)}")
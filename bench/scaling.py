@@ -0,0 +1,109 @@
+"""File descriptors, memory and receive latency against peer count.
+
+Simulates N peers as bare Publisher sockets on localhost, points a ZMQManager
+at all of them through discover_events, and compares TransportMode.PER_PEER
+with TransportMode.MULTIPLEXED.
+
+    $ python -m bench.scaling --peers 10 100 1000
+"""
+import argparse
+import os
+import resource
+import time
+
+import zmq
+import zmq.asyncio
+
+from bench.poll_loop import fmt_ms, wait_for
+from lib.net.codec import CODECS
+from lib.net.zmq import (
+    PORT_SPAN,
+    PUBLISHER_PORT_OFFSET,
+    Publisher,
+    TransportMode,
+    ZMQEventType,
+    ZMQManager,
+)
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+
+def open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def raise_limits(peers: int):
+    # two sockets per simulated peer in this one process, plus their fds
+    for ctx in (zmq.Context.instance(), zmq.asyncio.Context.instance()):
+        ctx.set(zmq.MAX_SOCKETS, 4 * peers + 64)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run(mode: TransportMode, peers: int, port: int, count: int) -> dict:
+    publishers = [
+        Publisher(
+            name=f"peer-{i}",
+            cxn=f"tcp://127.0.0.1:{port + PORT_SPAN * (i + 1) + PUBLISHER_PORT_OFFSET}",
+        )
+        for i in range(peers)
+    ]
+    # let sockets from the previous run finish closing
+    time.sleep(1)
+    fds, rss = open_fds(), rss_kb()
+
+    manager = ZMQManager("receiver", port, mode=mode)
+    for i in range(peers):
+        address = f"127.0.0.1:{port + PORT_SPAN * (i + 1)}"
+        manager.discover_events.put((f"peer-{i}", address, {"caps": ""}))
+    for _ in range(peers):
+        wait_for(manager, ZMQEventType.SOCKET_ADDED)
+    # let every connection finish its handshake
+    time.sleep(1 + peers / 500)
+    fds, rss = open_fds() - fds, rss_kb() - rss
+
+    samples = []
+    for i in range(count):
+        publisher = publishers[i % peers]
+        start = time.perf_counter()
+        message = EventMessage(
+            type=EventType.MESSAGE_SENT,
+            payload=ChatMessagePayload(content=str(i), author=publisher.name, to="*"),
+        )
+        publisher.send_message(CODECS["binary"].encode(message))
+        wait_for(manager, ZMQEventType.MESSAGE_RECEIVED)
+        samples.append(time.perf_counter() - start)
+
+    manager.close()
+    for publisher in publishers:
+        publisher.close()
+    return {"fds": fds, "rss_kb": rss, "latency": samples}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=20000, help="First port to use")
+    parser.add_argument("--peers", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--count", type=int, default=200, help="Messages to time")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise_limits(max(args.peers))
+    for peers in args.peers:
+        for mode in TransportMode:
+            result = run(mode, peers, args.port, args.count)
+            print(
+                f"{mode.name:>11} {peers:5d} peers: {result['fds']:5d} fds "
+                f"{result['rss_kb'] / 1024:7.1f} MiB {fmt_ms(result['latency'])}"
+            )
+            # leave the previous run's ports to TIME_WAIT
+            args.port += PORT_SPAN * (peers + 1)
@@ -0,0 +1,91 @@
+"""What it costs to keep a mesh log on disk as its history grows.
+
+For each size, appends that many values to a fresh log backed by a
+WriteAheadLog, snapshotting whenever the wal says to, as a Node would. Then
+reopens it, and times recovering the log. Prints how many bytes went to
+disk for every byte of records appended, and recovery time per entry, both
+of which should stay about the same however long the history.
+
+    $ python -m bench.wal --sizes 10000 100000 1000000
+"""
+import argparse
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from lib.metrics import REGISTRY
+from lib.net.mesh.change import StateChange, StateEvent
+from lib.net.mesh.codec import pack_change
+from lib.net.mesh.node import InMemSharedState
+from lib.net.mesh.wal import RECORD_HEADER, WriteAheadLog
+
+
+def disk_usage(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.iterdir())
+
+
+def run(size: int, args):
+    directory = Path(tempfile.mkdtemp(prefix="bench-wal-"))
+    written = REGISTRY.counter("wal.bytes_written")
+    fsyncs = REGISTRY.counter("wal.fsyncs")
+    before, fsyncs_before = written.read(), fsyncs.read()
+    try:
+        wal = WriteAheadLog(directory, segment_size=args.segment_size)
+        state = InMemSharedState(0, wal)
+        value = b"x" * args.value_size
+        appended = 0
+        started = time.perf_counter()
+        for seqno in range(size):
+            change = StateChange(seqno, StateEvent.VERIFY, value)
+            state.apply_state_change(change)
+            appended += RECORD_HEADER.size + len(pack_change(change))
+            if wal.should_snapshot():
+                state.snapshot()
+        wal.close()
+        took = time.perf_counter() - started
+        amplification = (written.read() - before) / appended
+
+        started = time.perf_counter()
+        wal = WriteAheadLog(directory, segment_size=args.segment_size)
+        recovered = InMemSharedState(0, wal)
+        recovery = time.perf_counter() - started
+        wal.close()
+        assert len(recovered) == size
+        print(
+            f"{size:>9} {took:8.2f}s {amplification:6.2f}x"
+            f" {fsyncs.read() - fsyncs_before:7}"
+            f" {disk_usage(directory) / 2**20:9.1f}MiB"
+            f" {recovery:8.2f}s {recovery / size * 1e6:6.2f}us"
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="Entries",
+    )
+    parser.add_argument("--value-size", type=int, default=64, help="Bytes per value")
+    parser.add_argument(
+        "--segment-size", type=int, default=4 * 2**20, help="Bytes per segment"
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    print(
+        f"{'entries':>9} {'append':>9} {'write':>7} {'fsyncs':>7}"
+        f" {'on disk':>12} {'recovery':>9} {'/entry':>8}"
+    )
+    for size in args.sizes:
+        run(size, args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
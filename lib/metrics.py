@@ -0,0 +1,215 @@
+"""In-process counters, gauges and latency histograms.
+
+Everything registers itself with the module level REGISTRY, keyed by a name
+and optional labels, e.g. REGISTRY.counter("zmq.messages_in", peer="bob").
+snapshot() reads everything at once as a dict of plain values, for the
+--metrics dump and the Stats window.
+
+Updates take no locks. Two threads bumping the same counter at the same
+instant can lose an increment, which is fine for metrics, and every hot
+path here only has one writer per metric anyway.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+# (name, sorted label items)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def read(self):
+        return self.value
+
+
+class Gauge:
+    """A value that goes up and down. Either set() it, or give it a function
+    to call whenever it's read."""
+
+    def __init__(self, fn: Callable[[], float] = None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def read(self):
+        return self.fn() if self.fn else self.value
+
+
+class Histogram:
+    """Latencies in seconds, bucketed by powers of two from 1us up to ~1min.
+
+    Percentiles come out as the upper bound of the bucket they land in, so
+    they're accurate to within a factor of two.
+    """
+
+    BOUNDS = [1e-6 * 2**i for i in range(27)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def read(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[MetricKey, object] = {}
+        # what each metric is, by the name snapshot() gives it
+        self.kinds: Dict[str, Type] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name: str, labels: Dict[str, str], *args):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, cls(*args))
+                self.kinds[self.format_key(key)] = type(metric)
+        return metric
+
+    def counter(self, name: str, **labels) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name: str, fn: Callable[[], float] = None, **labels) -> Gauge:
+        gauge = self._get(Gauge, name, labels)
+        if fn:
+            # whoever registers last owns it, e.g. a queue that got recreated
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def remove(self, **labels):
+        """Drop every metric with all of these labels, e.g. a peer's once
+        it's gone. Anyone still holding one can keep updating it, it just
+        won't be read any more."""
+        wanted = {(k, str(v)) for k, v in labels.items()}
+        with self.lock:
+            for key in [key for key in self.metrics if wanted <= set(key[1])]:
+                del self.metrics[key]
+                self.kinds.pop(self.format_key(key), None)
+
+    @staticmethod
+    def format_key(key: MetricKey) -> str:
+        name, labels = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+    def snapshot(self) -> Dict[str, object]:
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {self.format_key(key): metric.read() for key, metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def rates(
+    before: Dict, after: Dict, seconds: float, registry: Registry = REGISTRY
+) -> Dict[str, float]:
+    """Per-second rate of every counter between two snapshots of registry."""
+    if seconds <= 0:
+        return {}
+    kinds = registry.kinds
+    return {
+        name: (value - before.get(name, 0)) / seconds
+        for name, value in after.items()
+        if kinds.get(name) is Counter
+    }
+
+
+def format_snapshot(snapshot: Dict, rates: Optional[Dict] = None) -> str:
+    """One metric per line, for people to read."""
+    lines = []
+    for name, value in snapshot.items():
+        if isinstance(value, dict):
+            value = (
+                f"n={value['count']} mean={value['mean'] * 1e3:.3f}ms "
+                f"p50={value['p50'] * 1e3:.3f}ms p99={value['p99'] * 1e3:.3f}ms "
+                f"max={value['max'] * 1e3:.3f}ms"
+            )
+        elif rates and name in rates:
+            value = f"{value} ({rates[name]:.1f}/s)"
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+class MetricsDumper:
+    """Rewrites path with a JSON snapshot every interval seconds, from a
+    daemon thread, until closed."""
+
+    def __init__(self, path: str, interval: float = 1.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        before, then = self.registry.snapshot(), time.monotonic()
+        while not self.stopped.wait(self.interval):
+            after, now = self.registry.snapshot(), time.monotonic()
+            self._write(
+                {
+                    "time": time.time(),
+                    "metrics": after,
+                    "rates": rates(before, after, now - then, self.registry),
+                }
+            )
+            before, then = after, now
+
+    def _write(self, dump: Dict):
+        # write then rename, so readers never see half a file
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(dump, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"couldn't write metrics to {self.path}: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(timeout=self.interval + 1)
@@ -0,0 +1,152 @@
+import asyncio
+from dataclasses import dataclass
+import ipaddress
+import logging
+import time
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from lib.metrics import REGISTRY
+from lib.net.util import IPAddress
+
+logger = logging.getLogger(__name__)
+
+# how long to wait on a TCP connect before calling an address unreachable
+PROBE_TIMEOUT = 1.0
+# how long a peer's ranking holds before it gets probed again
+RANKING_TTL = 5 * 60.0
+
+
+def format_address(ip: IPAddress, port: int) -> str:
+    # zmq wants IPv6 hosts in brackets, same as a URL
+    if ip.version == 6:
+        return f"[{ip}]:{port}"
+    return f"{ip}:{port}"
+
+
+def usable_addresses(packed: Iterable[bytes]) -> List[IPAddress]:
+    """The addresses out of a ServiceInfo that we could connect to, in the
+    order they were advertised."""
+    addresses = []
+    for raw in packed:
+        try:
+            ip = ipaddress.ip_address(raw)
+        except ValueError:
+            continue
+        # link-local IPv6 needs a scope we aren't told, the same reason
+        # get_lan_ips() never advertises it
+        if ip.is_unspecified or (ip.version == 6 and ip.is_link_local):
+            continue
+        addresses.append(ip)
+    return addresses
+
+
+async def probe(ip: IPAddress, port: int, timeout: float = PROBE_TIMEOUT):
+    """Seconds it takes to open a TCP connection to ip:port, or None if it
+    can't be done within timeout."""
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(str(ip), port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = time.perf_counter() - start
+    writer.close()
+    return rtt
+
+
+@dataclass
+class _Ranking:
+    advertised: FrozenSet[IPAddress]
+    port: int
+    # best first. anything that didn't answer goes after everything that did
+    ranked: List[IPAddress]
+    expires: float
+
+
+class AddressBook:
+    """Picks which of a peer's advertised addresses to talk to it on.
+
+    Machines with wired, wifi and IPv6 addresses advertise all of them, and
+    which is quickest differs from peer to peer. choose() probes every one
+    of them at once with a TCP connect and ranks them by how long that took.
+    The ranking is kept per peer for ttl seconds, or until the peer starts
+    advertising something different, and failover() moves on down it when
+    the address we picked stops working.
+    """
+
+    def __init__(self, ttl: float = RANKING_TTL, timeout: float = PROBE_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.rankings: Dict[str, _Ranking] = {}
+        self.rtt = REGISTRY.histogram("zeroconf.probe_rtt")
+        self.unreachable = REGISTRY.counter("zeroconf.probe_unreachable")
+        self.failovers = REGISTRY.counter("zeroconf.failovers")
+
+    async def _probe_all(
+        self, addresses: List[IPAddress], port: int
+    ) -> List[Tuple[IPAddress, Optional[float]]]:
+        rtts = await asyncio.gather(
+            *(probe(ip, port, self.timeout) for ip in addresses)
+        )
+        for ip, rtt in zip(addresses, rtts):
+            if rtt is None:
+                self.unreachable.inc()
+            else:
+                self.rtt.observe(rtt)
+        return list(zip(addresses, rtts))
+
+    @staticmethod
+    def _rank(results: List[Tuple[IPAddress, Optional[float]]]) -> List[IPAddress]:
+        reachable = sorted(
+            (rtt, i) for i, (_, rtt) in enumerate(results) if rtt is not None
+        )
+        ranked = [results[i][0] for _, i in reachable]
+        return ranked + [ip for ip, rtt in results if rtt is None]
+
+    async def choose(
+        self, peer: str, addresses: List[IPAddress], port: int
+    ) -> Optional[str]:
+        """host:port to reach peer on, out of the addresses it advertises."""
+        if not addresses:
+            return None
+        ranking = self.rankings.get(peer)
+        if (
+            ranking is None
+            or ranking.expires < time.monotonic()
+            or ranking.port != port
+            or ranking.advertised != frozenset(addresses)
+        ):
+            if len(addresses) == 1:
+                # nothing to choose between
+                ranked = list(addresses)
+            else:
+                ranked = self._rank(await self._probe_all(addresses, port))
+            ranking = _Ranking(
+                advertised=frozenset(addresses),
+                port=port,
+                ranked=ranked,
+                expires=time.monotonic() + self.ttl,
+            )
+            self.rankings[peer] = ranking
+            logger.debug(f"ranked addresses of {peer}: {ranked}")
+        return format_address(ranking.ranked[0], port)
+
+    async def failover(self, peer: str) -> Optional[str]:
+        """The best address for peer other than the one choose() last gave,
+        or None if none of the others answer either."""
+        ranking = self.rankings.get(peer)
+        if ranking is None or len(ranking.ranked) < 2:
+            return None
+        failed, others = ranking.ranked[0], ranking.ranked[1:]
+        results = await self._probe_all(others, ranking.port)
+        if all(rtt is None for _, rtt in results):
+            return None
+        ranking.ranked = self._rank(results) + [failed]
+        ranking.expires = time.monotonic() + self.ttl
+        self.failovers.inc()
+        logger.info(f"{peer} stopped answering on {failed}, trying {ranking.ranked[0]}")
+        return format_address(ranking.ranked[0], ranking.port)
+
+    def forget(self, peer: str):
+        self.rankings.pop(peer, None)
@@ -0,0 +1,235 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields
+import dataclasses
+from enum import IntEnum
+import json
+import struct
+from typing import Dict, Tuple, Type
+import zlib
+
+from lib.ui.event import (
+    ChatMessagePayload,
+    EventMessage,
+    EventType,
+    PAYLOAD_TYPES,
+    Status,
+    StatusChangedPayload,
+    UsernameChangedPayload,
+)
+
+# first byte of every binary frame. 0xB1 is a UTF-8 continuation byte, so it
+# can never start a JSON document, which lets decode_any() sniff the encoding.
+MAGIC = 0xB1
+SCHEMA_VERSION = 1
+
+# magic, schema version, flags, event type
+HEADER = struct.Struct("!BBBB")
+
+# flags bit: everything after HEADER is zlib compressed
+FLAG_ZLIB = 0x01
+KNOWN_FLAGS = FLAG_ZLIB
+
+# smaller frames save too little to be worth the CPU. at this size zlib
+# breaks even on a ~130 Mbit/s link and wins on anything slower, like wifi.
+# see bench/compression.py
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 1
+# refuse to inflate anything bigger than this
+MAX_DECOMPRESSED = 16 * 1024 * 1024
+
+# what we advertise in the "caps" Zeroconf property, comma separated
+CAPABILITIES = ("zlib",)
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec(ABC):
+    @abstractmethod
+    def encode(self, message: EventMessage) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode(self, data: bytes) -> EventMessage:
+        ...
+
+
+class JsonCodec(Codec):
+    """The original wire format: dataclasses.asdict() run through json."""
+
+    def encode(self, message: EventMessage) -> bytes:
+        data = dataclasses.asdict(message)
+        for f in fields(message.payload):
+            if not f.metadata.get("wire", True):
+                del data["payload"][f.name]
+        return json.dumps(data).encode()
+
+    def decode(self, data: bytes) -> EventMessage:
+        try:
+            message = json.loads(data)
+            type = self._convert(EventType, message["type"])
+            cls = PAYLOAD_TYPES[type]
+            # same as BinaryCodec, file transfer events never leave the process
+            if cls not in BinaryCodec.SCHEMAS:
+                raise CodecError(f"unknown event type {type}")
+            payload = {
+                f.name: self._convert(f.type, message["payload"][f.name])
+                for f in fields(cls)
+                if f.metadata.get("wire", True)
+            }
+        except (ValueError, KeyError, TypeError) as e:
+            raise CodecError(f"malformed json message: {e}") from e
+        return EventMessage(type=type, payload=cls(**payload))
+
+    @staticmethod
+    def _convert(field_type, value):
+        # json flattens enums into ints
+        if issubclass(field_type, IntEnum) and type(value) is int:
+            return field_type(value)
+        if type(value) is not field_type:
+            raise TypeError(f"expected {field_type.__name__}, got {value!r}")
+        return value
+
+
+@dataclass(frozen=True)
+class _Schema:
+    # one byte enum fields, packed into the header
+    enums: Tuple[Tuple[str, Type[IntEnum]], ...]
+    # short strings, length-prefixed in the header
+    ids: Tuple[str, ...]
+    # the rest of the frame, as UTF-8
+    body: str = None
+
+    @property
+    def header(self) -> struct.Struct:
+        return struct.Struct(
+            HEADER.format + "B" * len(self.enums) + "H" * len(self.ids)
+        )
+
+
+class BinaryCodec(Codec):
+    """Compact encoding of the lib.ui.event payloads.
+
+    A struct-packed header holding the magic, schema version, flags, event
+    type, any enum fields and the lengths of the id fields, followed by the
+    ids themselves and then a UTF-8 body running to the end of the frame.
+    """
+
+    SCHEMAS: Dict[type, _Schema] = {
+        ChatMessagePayload: _Schema(enums=(), ids=("author", "to"), body="content"),
+        StatusChangedPayload: _Schema(enums=(("status", Status),), ids=("id",)),
+        UsernameChangedPayload: _Schema(enums=(), ids=("id",), body="username"),
+    }
+
+    def __init__(self):
+        # everything decode() needs to know about an event type, looked up
+        # once here rather than through Enum constructors on every message
+        self._encoders = {cls: schema.header for cls, schema in self.SCHEMAS.items()}
+        self._decoders = {
+            type.value: (
+                type,
+                cls,
+                self._encoders[cls],
+                tuple(
+                    (name, {m.value: m for m in enum})
+                    for name, enum in self.SCHEMAS[cls].enums
+                ),
+                self.SCHEMAS[cls],
+            )
+            for type, cls in PAYLOAD_TYPES.items()
+            # file transfer events never leave the process
+            if cls in self.SCHEMAS
+        }
+
+    def encode(self, message: EventMessage, flags: int = 0) -> bytes:
+        payload = message.payload
+        schema = self.SCHEMAS[type(payload)]
+        ids = [getattr(payload, name).encode() for name in schema.ids]
+        header = self._encoders[type(payload)].pack(
+            MAGIC,
+            SCHEMA_VERSION,
+            flags,
+            message.type,
+            *(getattr(payload, name) for name, _ in schema.enums),
+            *(len(id) for id in ids),
+        )
+        body = getattr(payload, schema.body).encode() if schema.body else b""
+        return b"".join((header, *ids, body))
+
+    def decode(self, data: bytes) -> EventMessage:
+        try:
+            return self._decode(data)
+        except (struct.error, ValueError, KeyError, IndexError) as e:
+            raise CodecError(f"malformed binary message: {e}") from e
+
+    def _decode(self, data: bytes) -> EventMessage:
+        if data[0] != MAGIC:
+            raise CodecError(f"bad magic {data[0]:#x}")
+        if data[1] != SCHEMA_VERSION:
+            raise CodecError(f"unsupported schema version {data[1]}")
+        if data[2] & ~KNOWN_FLAGS:
+            raise CodecError(f"unsupported flags {data[2]:#x}")
+        if data[2] & FLAG_ZLIB:
+            data = decompress(data)
+
+        if data[3] not in self._decoders:
+            raise CodecError(f"unknown event type {data[3]}")
+        type, cls, header, enums, schema = self._decoders[data[3]]
+        values = header.unpack_from(data)
+
+        payload = {}
+        i = HEADER.size
+        for name, members in enums:
+            payload[name] = members[values[i]]
+            i += 1
+
+        offset = header.size
+        for name in schema.ids:
+            length = values[i]
+            payload[name] = data[offset : offset + length].decode()
+            offset += length
+            i += 1
+        if schema.body:
+            payload[schema.body] = data[offset:].decode()
+
+        return EventMessage(type=type, payload=cls(**payload))
+
+
+CODECS: Dict[str, Codec] = {
+    "binary": BinaryCodec(),
+    "json": JsonCodec(),
+}
+
+
+def compress(data: bytes, threshold: int = COMPRESSION_THRESHOLD) -> bytes:
+    """zlib the body of a binary frame at least threshold bytes long.
+
+    Anything else, including JSON frames which have no flags byte to mark
+    it with, comes back untouched. So does a frame that doesn't shrink.
+    """
+    if len(data) < threshold or data[:1] != bytes([MAGIC]) or data[2] & FLAG_ZLIB:
+        return data
+    body = zlib.compress(data[HEADER.size :], COMPRESSION_LEVEL)
+    if len(body) >= len(data) - HEADER.size:
+        return data
+    return b"".join((data[:2], bytes([data[2] | FLAG_ZLIB]), data[3:4], body))
+
+
+def decompress(data: bytes) -> bytes:
+    """Undo compress(), giving back the frame with FLAG_ZLIB cleared."""
+    inflater = zlib.decompressobj()
+    try:
+        body = inflater.decompress(data[HEADER.size :], MAX_DECOMPRESSED)
+    except zlib.error as e:
+        raise CodecError(f"bad compressed body: {e}") from e
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise CodecError("compressed body is truncated or too big")
+    return b"".join((data[:2], bytes([data[2] & ~FLAG_ZLIB]), data[3:4], body))
+
+
+def decode_any(data: bytes) -> EventMessage:
+    """Decode a message from any peer, whichever codec it was sent with."""
+    if data[:1] == bytes([MAGIC]):
+        return CODECS["binary"].decode(data)
+    return CODECS["json"].decode(data)
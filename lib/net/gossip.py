@@ -0,0 +1,348 @@
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import random
+import struct
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from lib.metrics import REGISTRY
+from lib.net.address import AddressBook, usable_addresses
+from lib.net.util import IPAddress
+from lib.net.zmq import AsyncZMQManager, UnicastChannel, ZMQEvent
+
+logger = logging.getLogger(__name__)
+
+# leading frame of direct messages belonging to peer exchange
+GOSSIP = b"G"
+# advertised in "caps" by peers that take part
+GOSSIP_CAPABILITY = "px"
+
+# second frame: what the rest of the message is. a round is a scuttlebutt
+# style push-pull, where only versions go out until someone asks for more
+SYN = b"Y"  # [entries with just the sender's own, digest of everything]
+ACK = b"K"  # [entries we have newer, digest of the ones we want]
+ACK2 = b"E"  # [entries they wanted]
+
+# a digest is a run of these, each followed by that many bytes of name
+DIGEST_ENTRY = struct.Struct("!QB")  # version, name length
+# an entry starts the same, then the name, then its port, its addresses
+# as a count of packed IPs with a length byte each, then its metadata as a
+# count of key, value pairs with a length short each
+ENTRY_PORT = struct.Struct("!HB")  # port, address count
+LENGTH = struct.Struct("!H")
+
+GOSSIP_INTERVAL = 1.0
+# how often we put out a new version of our own entry, to show we're alive
+REFRESH_INTERVAL = 30.0
+# entries that haven't had a new version for this long are dropped
+EXPIRE_AFTER = 4 * REFRESH_INTERVAL
+
+# (name, address, metadata) or (name, None, None), as from zeroconf
+DiscoveryCallback = Callable[[str, Optional[str], Optional[Dict]], None]
+
+
+@dataclass
+class _Entry:
+    # milliseconds since the epoch when the owner last stamped it
+    version: int
+    port: int
+    addresses: List[bytes]
+    metadata: Dict[str, str] = field(default_factory=dict)
+    # monotonic time we last saw the version go up
+    heard: float = 0.0
+
+
+def pack_digest(versions: List[Tuple[str, int]]) -> bytes:
+    out = bytearray()
+    for name, version in versions:
+        raw = name.encode()
+        out += DIGEST_ENTRY.pack(version, len(raw)) + raw
+    return bytes(out)
+
+
+def unpack_digest(data: bytes) -> List[Tuple[str, int]]:
+    versions = []
+    offset = 0
+    while offset < len(data):
+        version, length = DIGEST_ENTRY.unpack_from(data, offset)
+        offset += DIGEST_ENTRY.size
+        versions.append((data[offset : offset + length].decode(), version))
+        offset += length
+    return versions
+
+
+def _pack_str(out: bytearray, s: str):
+    raw = s.encode()
+    out += LENGTH.pack(len(raw)) + raw
+
+
+def _unpack_str(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    return data[offset : offset + length].decode(), offset + length
+
+
+def pack_entries(entries: Dict[str, _Entry]) -> bytes:
+    out = bytearray()
+    for name, e in entries.items():
+        out += pack_digest([(name, e.version)])
+        out += ENTRY_PORT.pack(e.port, len(e.addresses))
+        for packed in e.addresses:
+            out += bytes((len(packed),)) + packed
+        out += LENGTH.pack(len(e.metadata))
+        for key, value in e.metadata.items():
+            _pack_str(out, key)
+            _pack_str(out, value)
+    return bytes(out)
+
+
+def unpack_entries(data: bytes) -> Dict[str, _Entry]:
+    entries = {}
+    offset = 0
+    while offset < len(data):
+        version, length = DIGEST_ENTRY.unpack_from(data, offset)
+        offset += DIGEST_ENTRY.size
+        name = data[offset : offset + length].decode()
+        offset += length
+        port, count = ENTRY_PORT.unpack_from(data, offset)
+        offset += ENTRY_PORT.size
+        addresses = []
+        for _ in range(count):
+            length = data[offset]
+            addresses.append(bytes(data[offset + 1 : offset + 1 + length]))
+            offset += 1 + length
+        (count,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        metadata = {}
+        for _ in range(count):
+            key, offset = _unpack_str(data, offset)
+            metadata[key], offset = _unpack_str(data, offset)
+        entries[name] = _Entry(version, port, addresses, metadata)
+    return entries
+
+
+class Gossip:
+    """Peer exchange, for finding peers that mDNS can't reach.
+
+    Every interval we push a digest of the peers we know, as (name, version)
+    pairs, to one peer picked at random from those advertising
+    GOSSIP_CAPABILITY and any seeds. It sends back whichever entries it has
+    newer and asks for the ones we do, so membership spreads epidemically
+    and whole entries only cross the wire when something changed.
+
+    Every entry is authored by the peer it describes, which stamps a new
+    version every refresh_interval. Entries that go expire_after without a
+    new one are dropped. Peers we learn about this way that the manager
+    doesn't already know go to on_discovered as (name, address, metadata),
+    just as Zeroconf hands them over, and (name, None, None) once they
+    expire.
+
+    seeds are "host:port" addresses of peers to gossip with even if
+    nothing else says they're there. Construct it anywhere, then call
+    start() on the manager's event loop.
+    """
+
+    def __init__(
+        self,
+        manager: AsyncZMQManager,
+        addresses: List[IPAddress],
+        port: int,
+        metadata: Dict[str, str],
+        on_discovered: DiscoveryCallback,
+        seeds: List[str] = (),
+        interval: float = GOSSIP_INTERVAL,
+        refresh_interval: float = REFRESH_INTERVAL,
+        expire_after: float = EXPIRE_AFTER,
+        address_book: AddressBook = None,
+    ):
+        self.manager = manager
+        self.name = manager.name
+        self.on_discovered = on_discovered
+        self.seeds = list(seeds)
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.expire_after = expire_after
+        self.address_book = address_book or AddressBook()
+
+        self.entries: Dict[str, _Entry] = {
+            self.name: _Entry(
+                version=0,
+                port=port,
+                addresses=[ip.packed for ip in addresses],
+                metadata=dict(metadata),
+            )
+        }
+        # peers we told on_discovered about, and so have to take back
+        self.reported: Set[str] = set()
+        # seed address -> channel to it, since seeds have no name yet
+        self.seed_channels: Dict[str, UnicastChannel] = {}
+        self.pending = set()
+        self.task = None
+        self.handlers = {SYN: self._on_syn, ACK: self._on_ack, ACK2: self._on_ack2}
+        self.rounds = REGISTRY.counter("gossip.rounds")
+        self.updates = REGISTRY.counter("gossip.entries_received")
+        REGISTRY.gauge("gossip.peers", lambda: len(self.entries) - 1)
+
+    def start(self):
+        self.manager.register_unicast(GOSSIP, self._on_frames)
+        self._stamp()
+        self.task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        self.manager.unregister_unicast(GOSSIP)
+        if self.task:
+            self.task.cancel()
+        for task in self.pending:
+            task.cancel()
+        for channel in self.seed_channels.values():
+            channel.close()
+
+    def update_metadata(self, changes: Dict[str, str]):
+        self.entries[self.name].metadata.update(changes)
+        self._stamp()
+
+    def update_addresses(self, addresses: List[IPAddress]):
+        self.entries[self.name].addresses = [ip.packed for ip in addresses]
+        self._stamp()
+
+    def _stamp(self):
+        own = self.entries[self.name]
+        # always forward, even if the clock isn't
+        own.version = max(own.version + 1, time.time_ns() // 1_000_000)
+        own.heard = time.monotonic()
+
+    def _targets(self) -> List[str]:
+        caps = self.manager.capabilities
+        return [
+            peer
+            for peer in self.manager.peers
+            if GOSSIP_CAPABILITY in caps.get(peer, ())
+        ]
+
+    async def _run(self):
+        last_stamp = time.monotonic()
+        while not self.manager.publisher.is_closed():
+            now = time.monotonic()
+            if now - last_stamp >= self.refresh_interval:
+                self._stamp()
+                last_stamp = now
+            self._expire(now)
+
+            targets = self._targets()
+            if targets or self.seeds:
+                self.rounds.inc()
+                target = random.choice(targets + self.seeds)
+                frames = [
+                    GOSSIP,
+                    SYN,
+                    pack_entries({self.name: self.entries[self.name]}),
+                    pack_digest(self._versions()),
+                ]
+                if target in self.seeds:
+                    self._seed_channel(target).put_nowait(frames)
+                else:
+                    await self.manager.send_frames(target, frames)
+            await asyncio.sleep(self.interval)
+
+    def _seed_channel(self, address: str) -> UnicastChannel:
+        channel = self.seed_channels.get(address)
+        if channel is None:
+            cxn = self.manager.fmt_address(self.manager._unicast_address(address))
+            channel = UnicastChannel(
+                self.name,
+                address,
+                cxn,
+                ctx=self.manager.zmq,
+                maxsize=self.manager.unicast_queue,
+            )
+            self.seed_channels[address] = channel
+        return channel
+
+    def _versions(self) -> List[Tuple[str, int]]:
+        return [(name, e.version) for name, e in self.entries.items()]
+
+    def _expire(self, now: float):
+        for name, e in list(self.entries.items()):
+            if name != self.name and now - e.heard > self.expire_after:
+                logger.debug(f"gossip about {name} dried up")
+                del self.entries[name]
+                if name in self.reported:
+                    self.reported.discard(name)
+                    self.on_discovered(name, None, None)
+
+    def _merge(self, entries: Dict[str, _Entry]):
+        now = time.monotonic()
+        for name, e in entries.items():
+            current = self.entries.get(name)
+            if name == self.name or (current and current.version >= e.version):
+                continue
+            self.updates.inc()
+            e.heard = now
+            self.entries[name] = e
+            changed = current is None or (
+                (current.port, current.addresses, current.metadata)
+                != (e.port, e.addresses, e.metadata)
+            )
+            if changed:
+                task = asyncio.ensure_future(self._report(name, e))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+
+    async def _report(self, name: str, e: _Entry):
+        if name not in self.reported and name in self.manager.peers:
+            # discovery found them already
+            return
+        addresses = usable_addresses(e.addresses)
+        address = await self.address_book.choose(name, addresses, e.port)
+        if address and self.entries.get(name) is e:
+            logger.debug(f"gossip says {name} is at {address}")
+            self.reported.add(name)
+            self.on_discovered(name, address, e.metadata)
+
+    def _reply(self, peer: str, op: bytes, *frames: bytes):
+        task = asyncio.ensure_future(
+            self.manager.send_frames(peer, [GOSSIP, op, *frames])
+        )
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def _on_frames(self, peer: str, frames: List[bytes], batch: List[ZMQEvent]):
+        if not frames or frames[0] not in self.handlers:
+            logger.warning(f"dropping malformed gossip from {peer}")
+            return
+        try:
+            self.handlers[frames[0]](peer, *frames[1:])
+        except (struct.error, TypeError, ValueError, IndexError) as e:
+            logger.warning(f"dropping malformed gossip from {peer}: {e}")
+
+    def _on_syn(self, peer: str, own: bytes, digest: bytes):
+        # take the sender's own entry first, so a peer that only knows us
+        # as a seed gets reported, and can be replied to next round
+        self._merge(unpack_entries(own))
+        theirs = dict(unpack_digest(digest))
+        newer = {
+            name: e
+            for name, e in self.entries.items()
+            if e.version > theirs.get(name, 0)
+        }
+        wanted = [
+            (name, 0)
+            for name, version in theirs.items()
+            if version > getattr(self.entries.get(name), "version", 0)
+        ]
+        if newer or wanted:
+            self._reply(peer, ACK, pack_entries(newer), pack_digest(wanted))
+
+    def _on_ack(self, peer: str, entries: bytes, wanted: bytes):
+        self._merge(unpack_entries(entries))
+        wanted = {
+            name: self.entries[name]
+            for name, _ in unpack_digest(wanted)
+            if name in self.entries
+        }
+        if wanted:
+            self._reply(peer, ACK2, pack_entries(wanted))
+
+    def _on_ack2(self, peer: str, entries: bytes):
+        self._merge(unpack_entries(entries))
@@ -0,0 +1,180 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+import struct
+import time
+from typing import Callable, Dict, Hashable, List, Set
+
+from lib.metrics import REGISTRY
+from lib.net.zmq import AsyncZMQManager, ZMQEvent, ZMQEventType
+from lib.ui.event import Status
+
+logger = logging.getLogger(__name__)
+
+# beacons go out on a topic of their own on the framed publisher. peers that
+# predate topics subscribe to everything, but only ever on the legacy port,
+# so they never see one either
+HEARTBEAT_TOPIC = "~hb"
+
+# version, the sender's Status, seq
+BEACON = struct.Struct("!BBI")
+BEACON_VERSION = 1
+
+HEARTBEAT_INTERVAL = 2.0
+# beacons in a row a peer can miss before we call it OFFLINE
+MISSES = 3
+# matches Status.ONLINE's "activity within the past 15 minutes"
+AWAY_AFTER = 15 * 60
+
+
+class TimerWheel:
+    """Hashed timing wheel of deadlines, advanced by a periodic tick.
+
+    Keys live in the slot their deadline falls in, and rescheduling moves a
+    key between slots, so each tick only looks at one slot's worth of keys
+    rather than at every key. A deadline more than a turn of the wheel away
+    gets looked at early, and put back for the next turn.
+    """
+
+    def __init__(self, tick: float, slots: int = 64):
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self.deadlines: Dict[Hashable, float] = {}
+        self.last_tick = self._elapsed(time.monotonic())
+
+    def _elapsed(self, now: float) -> int:
+        # the last tick whose slot is entirely in the past, so that
+        # everything in it from this turn of the wheel is due
+        return int(now // self.tick) - 1
+
+    def _slot(self, deadline: float) -> Set[Hashable]:
+        return self.slots[int(deadline // self.tick) % len(self.slots)]
+
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        self._slot(deadline).add(key)
+        self.deadlines[key] = deadline
+
+    def cancel(self, key: Hashable):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self._slot(deadline).discard(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.deadlines
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Every key whose deadline has passed since the last advance()."""
+        expired = []
+        tick = self._elapsed(now)
+        # after a long stall every slot is due, but each only needs one look
+        first = max(self.last_tick + 1, tick - len(self.slots) + 1)
+        for t in range(first, tick + 1):
+            index = t % len(self.slots)
+            slot, self.slots[index] = self.slots[index], set()
+            for key in slot:
+                deadline = self.deadlines[key]
+                if deadline <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    self._slot(deadline).add(key)
+        self.last_tick = tick
+        return expired
+
+
+@dataclass
+class _Peer:
+    status: Status
+    seq: int
+
+
+class Heartbeat:
+    """Presence from beacons on the Publisher, rather than from Zeroconf.
+
+    Every interval we publish a BEACON.size byte beacon on HEARTBEAT_TOPIC
+    saying whether we're ONLINE, or AWAY because last_activity() was more
+    than away_after seconds ago. A peer is OFFLINE once `misses` beacons in
+    a row fail to turn up.
+
+    Changes come out of the manager's events() as (peer, Status)
+    PEER_STATUS events. Peers are only tracked once we hear a beacon from
+    them, so older clients that never send any stay as discovery left them.
+
+    Construct it anywhere, then call start() on the manager's event loop.
+    """
+
+    def __init__(
+        self,
+        manager: AsyncZMQManager,
+        interval: float = HEARTBEAT_INTERVAL,
+        misses: int = MISSES,
+        away_after: float = AWAY_AFTER,
+        last_activity: Callable[[], float] = time.monotonic,
+    ):
+        self.manager = manager
+        self.interval = interval
+        self.timeout = interval * misses
+        self.away_after = away_after
+        # monotonic time of the user's last input
+        self.last_activity = last_activity
+
+        self.peers: Dict[str, _Peer] = {}
+        self.wheel = TimerWheel(interval)
+        self.seq = 0
+        self.task = None
+        self.missed = REGISTRY.counter("zmq.heartbeat.missed")
+        REGISTRY.gauge("zmq.heartbeat.peers", lambda: len(self.peers))
+
+    def start(self):
+        self.manager.register_topic(HEARTBEAT_TOPIC, self._on_beacon)
+        self.task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        # nobody's watching for them to go OFFLINE any more
+        self.peers.clear()
+
+    @property
+    def status(self) -> Status:
+        if time.monotonic() - self.last_activity() >= self.away_after:
+            return Status.AWAY
+        return Status.ONLINE
+
+    async def _run(self):
+        while not self.manager.publisher.is_closed():
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            beacon = BEACON.pack(BEACON_VERSION, self.status, self.seq)
+            self.manager.publisher.send_message(beacon, topic=HEARTBEAT_TOPIC)
+
+            for peer in self.wheel.advance(time.monotonic()):
+                if self.peers.pop(peer, None):
+                    logger.debug(f"heartbeats from {peer} stopped")
+                    self.manager.emit(
+                        ZMQEvent(ZMQEventType.PEER_STATUS, (peer, Status.OFFLINE))
+                    )
+            await asyncio.sleep(self.interval)
+
+    def _on_beacon(self, peer: str, content: bytes, batch: List[ZMQEvent]):
+        if self.task is None:
+            # closed. there's no unsubscribing from a topic, so ignore them
+            return
+        if len(content) != BEACON.size or content[0] != BEACON_VERSION:
+            logger.warning(f"dropping malformed heartbeat from {peer}")
+            return
+        _, status, seq = BEACON.unpack(content)
+        try:
+            status = Status(status)
+        except ValueError:
+            logger.warning(f"dropping heartbeat with unknown status from {peer}")
+            return
+
+        state = self.peers.get(peer)
+        if state is None or state.status != status:
+            batch.append(ZMQEvent(ZMQEventType.PEER_STATUS, (peer, status)))
+        if state and seq > state.seq + 1:
+            self.missed.inc(seq - state.seq - 1)
+        self.peers[peer] = _Peer(status=status, seq=seq)
+        self.wheel.schedule(peer, time.monotonic() + self.timeout)
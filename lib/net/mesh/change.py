@@ -0,0 +1,95 @@
+"""StateChanges, and the hybrid logical clock that stamps them.
+
+A timestamp is one 64 bit int: milliseconds since the epoch in the top 48
+bits and a counter in the bottom 16. A HybridClock never goes backwards,
+and once it has seen a timestamp, stamps everything after it later. So a
+change made after hearing of another always sorts after it, however far
+apart the two machines' clocks are, and comparing two timestamps is just
+comparing ints.
+"""
+from dataclasses import dataclass, field
+from enum import Enum
+import hashlib
+import logging
+import struct
+import threading
+import time
+from typing import Callable, Optional
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LOGICAL_BITS = 16
+# remote timestamps further ahead of our clock than this are garbage, not
+# skew, and don't get to drag ours along. a day covers laptops set to the
+# wrong timezone
+MAX_DRIFT = 24 * 60 * 60 * 1000
+
+
+def wall_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def physical(ts: int) -> int:
+    """The milliseconds part of a timestamp."""
+    return ts >> LOGICAL_BITS
+
+
+class HybridClock:
+    def __init__(self, last: int = 0, wall: Callable[[], int] = wall_ms):
+        # the latest timestamp we've handed out or seen
+        self.last = last
+        self.wall = wall
+        self.lock = threading.Lock()
+        self.skewed = REGISTRY.counter("mesh.clock_skew_ignored")
+
+    def now(self) -> int:
+        """A timestamp for something happening here, later than any before."""
+        with self.lock:
+            self.last = max(self.last + 1, self.wall() << LOGICAL_BITS)
+            return self.last
+
+    def update(self, ts: int) -> int:
+        """Take in a timestamp from elsewhere, so everything stamped from
+        now on comes after it."""
+        with self.lock:
+            wall = self.wall()
+            if physical(ts) - wall > MAX_DRIFT:
+                logger.warning(
+                    f"ignoring timestamp {physical(ts) - wall}ms ahead of our clock"
+                )
+                self.skewed.inc()
+                return self.last
+            self.last = max(self.last + 1, ts + 1, wall << LOGICAL_BITS)
+            return self.last
+
+
+# stamps changes made without a clock of their own
+CLOCK = HybridClock()
+
+
+def now_ts() -> int:
+    """A timestamp from the process' clock."""
+    return CLOCK.now()
+
+
+class StateEvent(Enum):
+    NOOP = 0
+    VERIFY = 1
+
+
+@dataclass
+class StateChange:
+    seqno: int
+    event: StateEvent
+    state: Optional[bytes] = None
+    ts: int = field(default_factory=now_ts)
+    node_id: int = 0
+
+    def digest(self) -> int:
+        """64 bit hash of everything that makes this entry this entry."""
+        header = struct.pack("!QQQ", self.seqno, self.ts, self.node_id)
+        raw = hashlib.blake2b(header + (self.state or b""), digest_size=8).digest()
+        # never 0, since 0 is what an empty range sums to
+        return int.from_bytes(raw, "big") or 1
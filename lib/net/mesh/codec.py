@@ -0,0 +1,214 @@
+"""Wire format of mesh messages, and of StateChanges in the WriteAheadLog.
+
+A message is a struct header of schema version, kind and sender, then:
+
+    DIGEST   sums
+    RANGES   level, parents, sums
+    ENTRIES  changes, wanted
+
+where parents and wanted are a count and that many 64 bit ints, sums a count
+and that many (index, sum) pairs of them, and changes a count and that many
+StateChanges. A StateChange is a fixed header of seqno, ts, node_id, event
+and the length of its state, then the state itself.
+"""
+from itertools import chain
+import logging
+import struct
+from typing import Any, List, Tuple
+
+from lib.net.mesh.change import StateChange, StateEvent
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+# what's in a message, after its kind and sender
+DIGEST = b"D"  # ({index: sum}), of every top level range
+RANGES = b"R"  # (level, parents, {index: sum}) of their children
+ENTRIES = b"E"  # ([StateChange], [seqnos wanted back])
+
+HEADER = struct.Struct("!BcQ")  # schema version, kind, sender
+CHANGE = struct.Struct("!QQQBI")  # seqno, ts, node_id, event, state length
+COUNT = struct.Struct("!I")
+LEVEL = struct.Struct("!B")
+# state length of a change with no state, as opposed to an empty one
+NO_STATE = 0xFFFFFFFF
+
+EVENTS = {event.value: event for event in StateEvent}
+
+
+class CodecError(ValueError):
+    pass
+
+
+def changes_size(changes: List[StateChange]) -> int:
+    return COUNT.size + sum(CHANGE.size + len(c.state or b"") for c in changes)
+
+
+def pack_changes_into(view: memoryview, offset: int, changes: List[StateChange]):
+    """Pack changes into view at offset, which has to have room for
+    changes_size() of them, and return the offset after them."""
+    COUNT.pack_into(view, offset, len(changes))
+    offset += COUNT.size
+    # these run per change, so look them up once
+    pack_into, size = CHANGE.pack_into, CHANGE.size
+    for c in changes:
+        state = c.state
+        length = NO_STATE if state is None else len(state)
+        pack_into(view, offset, c.seqno, c.ts, c.node_id, c.event.value, length)
+        offset += size
+        if state:
+            # through a memoryview, since slicing into a bytearray is slower
+            view[offset : offset + length] = state
+            offset += length
+    return offset
+
+
+def unpack_changes_from(data: bytes, offset: int) -> Tuple[List[StateChange], int]:
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    changes = []
+    unpack_from, size, events = CHANGE.unpack_from, CHANGE.size, EVENTS
+    for _ in range(count):
+        seqno, ts, node_id, event, length = unpack_from(data, offset)
+        offset += size
+        state = None
+        if length != NO_STATE:
+            state = data[offset : offset + length]
+            offset += length
+            if offset > len(data):
+                raise CodecError(f"state runs {offset - len(data)} bytes over")
+        changes.append(StateChange(seqno, events[event], state, ts, node_id))
+    return changes, offset
+
+
+def pack_change(change: StateChange) -> bytes:
+    """One change on its own, as the WriteAheadLog stores them."""
+    state = change.state
+    length = NO_STATE if state is None else len(state)
+    header = CHANGE.pack(
+        change.seqno, change.ts, change.node_id, change.event.value, length
+    )
+    return header + state if state else header
+
+
+def unpack_change(data: bytes) -> StateChange:
+    try:
+        seqno, ts, node_id, event, length = CHANGE.unpack_from(data)
+        state = None if length == NO_STATE else data[CHANGE.size :]
+        if len(data) != CHANGE.size + (0 if state is None else length):
+            raise CodecError(f"change is {len(data)} bytes, not {length} of state")
+        return StateChange(seqno, EVENTS[event], state, ts, node_id)
+    except (struct.error, KeyError) as e:
+        raise CodecError(f"malformed change: {e}") from e
+
+
+def _ints_size(values) -> int:
+    return COUNT.size + 8 * len(values)
+
+
+def _pack_ints_into(view: memoryview, offset: int, values) -> int:
+    struct.pack_into(f"!I{len(values)}Q", view, offset, len(values), *values)
+    return offset + _ints_size(values)
+
+
+def _unpack_ints_from(data: bytes, offset: int) -> Tuple[Tuple[int, ...], int]:
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    values = struct.unpack_from(f"!{count}Q", data, offset)
+    return values, offset + 8 * count
+
+
+class MessageCodec:
+    """Encodes mesh messages into one buffer it reuses, rather than
+    allocating for every message.
+
+    What encode() returns is a view of that buffer, so it's only good until
+    the next encode(). It's for sending straight away, from one thread at a
+    time.
+    """
+
+    def __init__(self, size: int = 64 * 1024):
+        self.view = memoryview(bytearray(size))
+
+    def _reserve(self, size: int) -> memoryview:
+        if len(self.view) < size:
+            # a new one, since views of the old one may still be around
+            self.view = memoryview(bytearray(max(size, 2 * len(self.view))))
+        return self.view
+
+    def encode_changes(self, changes: List[StateChange]) -> memoryview:
+        """Just a batch of changes, in one frame."""
+        view = self._reserve(changes_size(changes))
+        return view[: pack_changes_into(view, 0, changes)]
+
+    def decode_changes(self, data: bytes) -> List[StateChange]:
+        try:
+            changes, offset = unpack_changes_from(bytes(data), 0)
+        except (struct.error, KeyError) as e:
+            raise CodecError(f"malformed changes: {e}") from e
+        if offset != len(data):
+            raise CodecError(f"{len(data) - offset} bytes after changes")
+        return changes
+
+    def encode(self, message: Tuple) -> memoryview:
+        kind, sender, *content = message
+        if kind == DIGEST:
+            (sums,) = content
+            size = _ints_size(sums) * 2
+        elif kind == RANGES:
+            level, parents, sums = content
+            size = LEVEL.size + _ints_size(parents) + _ints_size(sums) * 2
+        elif kind == ENTRIES:
+            changes, wanted = content
+            size = changes_size(changes) + _ints_size(wanted)
+        else:
+            raise CodecError(f"unknown message kind {kind!r}")
+
+        view = self._reserve(HEADER.size + size)
+        HEADER.pack_into(view, 0, SCHEMA_VERSION, kind, sender)
+        offset = HEADER.size
+        if kind == ENTRIES:
+            offset = pack_changes_into(view, offset, changes)
+            offset = _pack_ints_into(view, offset, wanted)
+            return view[:offset]
+        if kind == RANGES:
+            LEVEL.pack_into(view, offset, level)
+            offset = _pack_ints_into(view, offset + LEVEL.size, parents)
+        # sums go as one run of index, sum pairs, with the count of pairs
+        pairs = chain.from_iterable(sums.items())
+        struct.pack_into(f"!I{2 * len(sums)}Q", view, offset, len(sums), *pairs)
+        return view[: offset + COUNT.size + 16 * len(sums)]
+
+    def decode(self, data: bytes) -> Tuple[Any, ...]:
+        try:
+            # states are sliced straight out of it, so they come out bytes
+            return self._decode(bytes(data))
+        except (struct.error, KeyError, IndexError) as e:
+            raise CodecError(f"malformed mesh message: {e}") from e
+
+    def _decode(self, data: bytes) -> Tuple[Any, ...]:
+        version, kind, sender = HEADER.unpack_from(data)
+        if version != SCHEMA_VERSION:
+            raise CodecError(f"unsupported schema version {version}")
+        offset = HEADER.size
+        if kind == ENTRIES:
+            changes, offset = unpack_changes_from(data, offset)
+            wanted, offset = _unpack_ints_from(data, offset)
+            message = (kind, sender, changes, list(wanted))
+        elif kind == DIGEST or kind == RANGES:
+            prefix = ()
+            if kind == RANGES:
+                (level,) = LEVEL.unpack_from(data, offset)
+                parents, offset = _unpack_ints_from(data, offset + LEVEL.size)
+                prefix = (level, list(parents))
+            (count,) = COUNT.unpack_from(data, offset)
+            flat = struct.unpack_from(f"!{2 * count}Q", data, offset + COUNT.size)
+            offset += COUNT.size + 16 * count
+            sums = dict(zip(flat[::2], flat[1::2]))
+            message = (kind, sender, *prefix, sums)
+        else:
+            raise CodecError(f"unknown message kind {kind!r}")
+        if offset != len(data):
+            raise CodecError(f"{len(data) - offset} bytes after message")
+        return message
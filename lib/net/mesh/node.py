@@ -1,43 +1,104 @@
-
-import base64
-from collections import namedtuple
-from dataclasses import dataclass, field
+"""A log replicated between Nodes over zmq PUB/SUB.
+
+Every slot in the log is a seqno. A Node appends at the next free seqno and
+broadcasts the change, and when two nodes append at the same seqno while
+they can't hear each other, apply_state_change() picks the same winner on
+both. The loser's author appends its value again further on, so nothing is
+lost once everyone has heard everything.
+
+Broadcasts get dropped while peers are partitioned or still connecting, so
+nodes also repair their logs by anti-entropy. Each keeps XOR sums of its
+entries' hashes over ranges of seqnos, at a few levels of range size, and
+periodically broadcasts the top level. A peer that sums any range
+differently asks for the next level down for just those ranges, and so on
+down to single entries, and only entries that differ cross the wire.
+
+Changes are stamped by a HybridClock, which every node moves forward to
+the latest timestamp it hears of, so which of two changes to a seqno wins
+depends on what each author had heard, not on whose clock is slow.
+
+Given a wal_dir, a Node also keeps its log on disk in a WriteAheadLog, and
+picks up where it left off when started again.
+"""
 import dataclasses
-import datetime
-from enum import Enum
-import pickle
-import queue
+from pathlib import Path
 import threading
-from typing import Any
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 import zmq
 
 import logging
 
+from lib.metrics import REGISTRY
+from lib.net.mesh.change import HybridClock, StateChange, StateEvent
+from lib.net.mesh.codec import (
+    DIGEST,
+    ENTRIES,
+    RANGES,
+    CodecError,
+    MessageCodec,
+    pack_change,
+    unpack_change,
+)
+from lib.net.mesh.sortedlog import SortedLog
+from lib.net.mesh.wal import WriteAheadLog
+
 logger = logging.getLogger(__name__)
 
-class StateEvent(Enum):
-    NOOP: False
-    VERIFY: True
+# topic everyone subscribes to. nodes also subscribe to their own id, for
+# anti-entropy traffic meant for them alone
+BROADCAST = "*"
 
-@dataclass
-class StateChange:
-    ts: int = field(default_factory=int(datetime.datetime.timestamp()))
-    seqno: int
-    event: StateEvent
-    state: Any
+# ranges are FANOUT times bigger at each level, so level 1 sums 64 seqnos,
+# level 2 sums 4096, and so on up to LEVELS
+FANOUT = 64
+LEVELS = 3
+# most ranges to descend into per RANGES message, each costing FANOUT sums.
+# any past it get found again next round
+MAX_PARENTS = 1024
+ANTI_ENTROPY_INTERVAL = 1.0
 
 
 class InMemSharedState:
-    def __init__(self, node_id: int):
+    """The log, in memory. Every change that wins a seqno is also appended
+    to wal, if there is one, so replaying it rebuilds the same log."""
+
+    def __init__(self, node_id: int, wal: WriteAheadLog = None):
         self.node_id = node_id
-        self.state = {}
+        self.wal = None
+        # seqno -> the change that won it
+        self.state: Dict[int, StateChange] = {}
+        # the same changes in seqno order
+        self.log = SortedLog()
         self.next_seqno = 0
         self.state_lock = threading.Lock()
-
-        self.recover_state()
-
-    def recover_state(self):
-        pass
+        # sums[level][index] is the XOR of the digests of every entry in
+        # seqnos [index * FANOUT**level, (index + 1) * FANOUT**level).
+        # ranges summing to 0 are left out
+        self.sums: List[Dict[int, int]] = [{} for _ in range(LEVELS + 1)]
+
+        if wal:
+            self.recover_state(wal)
+            self.wal = wal
+            wal.start()
+
+    def recover_state(self, wal: WriteAheadLog):
+        started = time.perf_counter()
+        with self.state_lock:
+            for payload in wal.recover():
+                self.apply_state_change(unpack_change(payload))
+        logger.info(
+            f"recovered {len(self.log)} entries"
+            f" in {time.perf_counter() - started:.3f}s"
+        )
+
+    def snapshot(self):
+        """Save the whole log to the wal, so it can drop the segments
+        before it."""
+        with self.state_lock:
+            lsn = self.wal.next_lsn
+            changes = list(self.log)
+        self.wal.snapshot((pack_change(change) for change in changes), lsn)
 
     def iter_state_change(self, change: StateChange):
         change = change or StateChange(seqno=self.next_seqno, event=StateEvent.NOOP)
@@ -50,7 +111,33 @@ class InMemSharedState:
     def _empty_verify(self, change) -> StateChange:
         return dataclasses.replace(change, state=None)
 
+    @staticmethod
+    def _rank(change: StateChange):
+        # ts are HLC timestamps, so the earlier one is the one made knowing
+        # less. node_id settles ties, so every node picks the same winner
+        return (change.ts, -len(change.state), change.node_id)
+
     def apply_state_change(self, change: StateChange) -> StateChange:
+        result = self._resolve(change)
+        if self._won(result):
+            self.log.add(change)
+        return result
+
+    def apply_state_changes(self, changes: List[StateChange]) -> List[StateChange]:
+        """apply_state_change() each of changes, which have to be in seqno
+        order, and merge the winners into the log in one pass."""
+        results = [self._resolve(change) for change in changes]
+        self.log.update(
+            [change for change, result in zip(changes, results) if self._won(result)]
+        )
+        return results
+
+    @staticmethod
+    def _won(result: StateChange) -> bool:
+        # what _resolve() answers a change that took its seqno with
+        return result.event == StateEvent.VERIFY and result.state is None
+
+    def _resolve(self, change: StateChange) -> StateChange:
         if change.event == StateEvent.NOOP:
             return change
 
@@ -63,31 +150,71 @@ class InMemSharedState:
         existing_state = self.state.get(change.seqno, None)
         if existing_state:
             # we got a full verify for a seqno we know about.
-            # smaller ts or longest state wins, return the full verify if we won
-            if existing_state == min(existing_state, change, key=lambda x: (x.ts, -len(x.state))):
+            # earlier ts or longest state wins, return the full verify if we won
+            if existing_state == min(existing_state, change, key=self._rank):
                 return existing_state
             else:
                 # the change won. return an empty verify
-                self.state[change.seqno] = change
+                self._set(change, existing_state)
                 return self._empty_verify(change)
-        elif change.seqno >= self.next_seqno:
-            # we got a full verify for a seqno we don't know about
-            # if the seqno is valid, accept it and return an empty verify
-            self.next_seqno = change.seqno + 1
-            self.state[change.seqno] = change
-            return self._empty_verify(change)
         else:
-            # we got a full verify for an invalid seqno we don't know about.
-            # any client that sends us one of these is out of sync. return noop
-            return self._noop_change(change)
+            # we got a full verify for a seqno we don't know about. it may be
+            # behind next_seqno if it was appended on the other side of a
+            # partition, and anti-entropy is filling in the gap
+            self.next_seqno = max(self.next_seqno, change.seqno + 1)
+            self._set(change, None)
+            return self._empty_verify(change)
 
+    def _set(self, change: StateChange, existing: Optional[StateChange]):
+        if self.wal:
+            self.wal.append(pack_change(change))
+        # the log is left to the caller, which may be merging a batch
+        self.state[change.seqno] = change
+        delta = change.digest() ^ (existing.digest() if existing else 0)
+        for level in range(1, LEVELS + 1):
+            sums = self.sums[level]
+            index = change.seqno // FANOUT**level
+            value = sums.get(index, 0) ^ delta
+            if value:
+                sums[index] = value
+            else:
+                sums.pop(index, None)
+
+    def range_sums(self, level: int, parents: List[int] = None) -> Dict[int, int]:
+        """Sums of every range at level, or of just the children of the
+        given ranges one level up."""
+        if level == 0:
+            if parents is None:
+                return {seqno: c.digest() for seqno, c in self.state.items()}
+            changes = (
+                c
+                for p in parents
+                for c in self.log.irange(p * FANOUT, (p + 1) * FANOUT)
+            )
+            return {c.seqno: c.digest() for c in changes}
+        if parents is None:
+            return dict(self.sums[level])
+        sums = self.sums[level]
+        children = (i for p in parents for i in range(p * FANOUT, (p + 1) * FANOUT))
+        return {i: sums[i] for i in children if i in sums}
+
+    def fingerprint(self) -> Tuple[int, ...]:
+        """Equal on two nodes exactly when their logs are."""
+        return tuple(sorted(self.sums[LEVELS].items()))
+
+    def __iter__(self) -> Iterator[StateChange]:
+        return iter(self.log)
+
+    def __len__(self) -> int:
+        return len(self.log)
 
 
 class ZMQTransport(object):
-    def __init__(self, address: str, port: str):
+    def __init__(self, address: str, port: str, topics=(BROADCAST,)):
         super().__init__()
         self.address = address
         self.port = port
+        self.topics = topics
 
         self.zctx = zmq.Context.instance()
         self.cxn = f"tcp://{address}:{port}"
@@ -95,16 +222,28 @@ class ZMQTransport(object):
         self.socket.bind(self.cxn)
 
         self.peers = {}
+        self.codec = MessageCodec()
+        # the codec's buffer, like the socket, is for one thread at a time
+        self.send_lock = threading.Lock()
+        self.bytes_sent = REGISTRY.counter("mesh.bytes_sent", port=port)
+        self.bytes_received = REGISTRY.counter("mesh.bytes_received", port=port)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.socket.closed:
+            return
         self.remove_all_peers()
         logger.debug(f"closing pub socket on {self.cxn}")
-        self.socket.close()
+        self.socket.close(linger=0)
 
     def add_peer(self, address: str, port: str):
         peer_sock = self.zctx.socket(zmq.SUB)
         peer_sock.connect(f"tcp://{address}:{port}")
-        peer_sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        for topic in self.topics:
+            # the delimiter keeps node 1 from getting node 10's messages
+            peer_sock.setsockopt_string(zmq.SUBSCRIBE, f"{topic}:")
         logger.debug(f"connected to {address}:{port}")
         self.peers[(address, port)] = peer_sock
 
@@ -112,83 +251,214 @@ class ZMQTransport(object):
         sock = self.peers.pop((address, port), None)
         if sock:
             logger.debug(f"disconnect from {address}:{port}")
-            sock.close()
+            sock.close(linger=0)
 
     def remove_all_peers(self):
         for peer in list(self.peers.keys()):
             self.remove_peer(*peer)
 
-    @staticmethod
-    def recv_from_socket(sock: zmq.Socket) -> Any:
-        return ZMQTransport.deserialize(sock.recv())
+    def recv_from_socket(self, sock: zmq.Socket) -> Tuple:
+        frames = sock.recv_multipart()
+        if len(frames) != 2:
+            raise CodecError(f"message of {len(frames)} frames, not 2")
+        _, content = frames
+        self.bytes_received.inc(len(content))
+        return self.deserialize(content)
 
     def recv_from_peer(self, address: str, port: int):
         return self.recv_from_socket(self.peers[(address, port)])
 
-    def recv_from_peers(self):
-        r, _, _ = zmq.select(list(self.peers.values()), [], [], timeout=0.1)
-        logger.debug(f"recv messages from {len(r)} sockets:")
+    def recv_from_peers(self, timeout: float = 0.1):
+        """Everything waiting on any peer's socket, after waiting up to
+        timeout for something to turn up."""
+        r, _, _ = zmq.select(list(self.peers.values()), [], [], timeout=timeout)
         for sock in r:
-            if sock:
-                yield self.recv_from_socket(sock)
+            while sock.poll(0):
+                try:
+                    message = self.recv_from_socket(sock)
+                except CodecError as e:
+                    logger.warning(f"dropping {e}")
+                    continue
+                yield message
 
-    @staticmethod
-    def serialize(content: Any):
-        return pickle.dumps(content)
+    def serialize(self, content: Tuple) -> memoryview:
+        return self.codec.encode(content)
 
-    @staticmethod
-    def deserialize(content: bytes) -> Any:
-        return pickle.loads(content)
+    def deserialize(self, content: bytes) -> Tuple:
+        return self.codec.decode(content)
 
-    def send_to_peers(self, content: Any):
-        logger.debug("sending message")
-        return self.socket.send(self.serialize(content))
+    def send_to_peers(self, content: Tuple, to: str = BROADCAST):
+        with self.send_lock:
+            content = self.serialize(content)
+            self.bytes_sent.inc(len(content))
+            return self.socket.send_multipart([f"{to}:".encode(), content])
 
 
 class Node(ZMQTransport):
-    def __init__(self, node_id: int = 0, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """A replica of the shared log, see the top of this module.
+
+    append_state() adds to the log from any thread. synchronize() has to be
+    called regularly, from one thread, to take in what peers send and to
+    run anti-entropy every anti_entropy_interval. It also snapshots the log
+    in the background, when the wal says it's due.
+
+    Changes reach the disk within the wal's commit interval of being
+    applied. Call sync() to wait for them.
+    """
+
+    def __init__(
+        self,
+        node_id: int = 0,
+        *args,
+        anti_entropy_interval: float = ANTI_ENTROPY_INTERVAL,
+        wal_dir: Path = None,
+        **kwargs,
+    ):
+        super().__init__(*args, topics=(BROADCAST, str(node_id)), **kwargs)
         self.node_id = node_id
-
-
-    def load_state(self, state_fn: str):
-        with open(state_fn, 'r') as f:
-            for serialized in f.readlines():
-                change = pickle.loads(base64.decodebytes(serialized))
-                self.shared_state.append(change)
-
-    def save_state(self, state_fn: str):
-        with open(state_fn, "w") as f:
-            for change in self.shared_state:
-                f.write(base64.encodebytes(pickle.dumps(change)) + b"\n")
-
-
-    def append_state(self, value):
-        ts = datetime.datetime.utcnow()
-        content = (self.seqno, ts, self.node_id, value)
+        self.wal = WriteAheadLog(wal_dir) if wal_dir else None
+        self.shared_state = InMemSharedState(node_id, self.wal)
+        # start after everything we recovered, even if the wall clock has
+        # gone back since
+        self.clock = HybridClock(max((c.ts for c in self.shared_state), default=0))
+        self.snapshotting: Optional[threading.Thread] = None
+        self.state_lock = self.shared_state.state_lock
+        self.anti_entropy_interval = anti_entropy_interval
+        self.last_anti_entropy = 0.0
+        self.handlers = {
+            DIGEST: self._on_digest,
+            RANGES: self._on_ranges,
+            ENTRIES: self._on_entries,
+        }
+
+    @property
+    def seqno(self) -> int:
+        return self.shared_state.next_seqno
+
+    def close(self):
+        super().close()
+        if self.wal:
+            if self.snapshotting:
+                self.snapshotting.join()
+            self.wal.close()
+            self.wal = None
+
+    def sync(self):
+        """Wait for every change applied so far to be on disk."""
+        if self.wal:
+            self.wal.sync()
+
+    def save_state(self):
+        """Snapshot the log now, rather than when the wal says it's due."""
+        if self.wal:
+            self.shared_state.snapshot()
+
+    def _maybe_snapshot(self):
+        if self.snapshotting and self.snapshotting.is_alive():
+            return
+        if self.wal.should_snapshot():
+            self.snapshotting = threading.Thread(
+                target=self.save_state, name="snapshot", daemon=True
+            )
+            self.snapshotting.start()
+
+    def append_state(self, value: bytes) -> StateChange:
         with self.state_lock:
-            self.shared_state.append(content)
-            self.seqno += 1
-        self.synchronize(content)
+            change = StateChange(
+                seqno=self.shared_state.next_seqno,
+                event=StateEvent.VERIFY,
+                state=value,
+                ts=self.clock.now(),
+                node_id=self.node_id,
+            )
+            self.shared_state.apply_state_change(change)
+        self.send_to_peers((ENTRIES, self.node_id, [change], []))
+        return change
+
+    def synchronize(self, timeout: float = 0.1):
+        """Take in whatever peers sent within timeout, and run a round of
+        anti-entropy if it's due."""
+        if self.wal:
+            self._maybe_snapshot()
+        now = time.monotonic()
+        if now - self.last_anti_entropy >= self.anti_entropy_interval:
+            self.last_anti_entropy = now
+            with self.state_lock:
+                top = self.shared_state.range_sums(LEVELS)
+            self.send_to_peers((DIGEST, self.node_id, top))
+
+        for message in self.recv_from_peers(timeout):
+            kind, sender, *content = message
+            if sender != self.node_id and kind in self.handlers:
+                self.handlers[kind](sender, *content)
+
+    def _differing(self, ours: Dict[int, int], theirs: Dict[int, int]) -> List[int]:
+        return sorted(
+            i for i in ours.keys() | theirs.keys() if ours.get(i) != theirs.get(i)
+        )
+
+    def _on_digest(self, sender: int, sums: Dict[int, int]):
+        with self.state_lock:
+            ours = self.shared_state.range_sums(LEVELS)
+        differing = self._differing(ours, sums)
+        if differing:
+            self._send_ranges(sender, LEVELS - 1, differing)
 
-    def reset_state(self):
+    def _send_ranges(self, to: int, level: int, parents: List[int]):
+        parents = parents[:MAX_PARENTS]
+        with self.state_lock:
+            sums = self.shared_state.range_sums(level, parents)
+        self.send_to_peers((RANGES, self.node_id, level, parents, sums), to=str(to))
+
+    def _on_ranges(
+        self, sender: int, level: int, parents: List[int], sums: Dict[int, int]
+    ):
+        if not 0 <= level < LEVELS or len(parents) > MAX_PARENTS:
+            logger.warning(
+                f"dropping RANGES from {sender} at level {level}"
+                f" with {len(parents)} parents"
+            )
+            return
+        with self.state_lock:
+            ours = self.shared_state.range_sums(level, parents)
+        differing = self._differing(ours, sums)
+        if not differing:
+            return
+        if level > 0:
+            self._send_ranges(sender, level - 1, differing)
+            return
+        # down to single entries. send ours where they differ, and ask for
+        # theirs where we have nothing or something else
         with self.state_lock:
-            self.shared_state = []
-            self.seqno = 0
-        self.synchronize([])
-
-    def synchronize(self, content=None):
-        # first, publish our state
-        if content:
-            self.send_to_peers(content)
-        # then, get any updates from others.
-        # we maintain order on ts as an invariant
-        changes = self.recv_from_peers()
+            state = self.shared_state.state
+            changes = [state[s] for s in differing if s in state]
+        wanted = [s for s in differing if s in sums]
+        self.send_to_peers((ENTRIES, self.node_id, changes, wanted), to=str(sender))
+
+    def _on_entries(self, sender: int, changes: List[StateChange], wanted: List[int]):
+        self.synchronize_changes(changes)
+        if wanted:
+            with self.state_lock:
+                state = self.shared_state.state
+                changes = [state[s] for s in wanted if s in state]
+            if changes:
+                self.send_to_peers((ENTRIES, self.node_id, changes, []), to=str(sender))
+
+    def synchronize_changes(self, changes: List[StateChange]):
+        if changes:
+            self.clock.update(max(c.ts for c in changes))
+        # sort before taking the lock, so it's only held for the merge
+        changes = sorted(changes, key=lambda c: c.seqno)
         with self.state_lock:
-            # start reading the generator inside the lock
-            # so we hold it for the least amount of time
-            for change in changes:
-                logger.debug(f"synchronizing change: {change}")
-                self.shared_state.append(change)
-            # sort to maintain invariant
-            self.shared_state.sort(key=lambda x: x[0])
+            state = self.shared_state.state
+            ours = {
+                c.seqno: state[c.seqno]
+                for c in changes
+                if c.seqno in state and state[c.seqno].node_id == self.node_id
+            }
+            self.shared_state.apply_state_changes(changes)
+            lost = [c for seqno, c in ours.items() if state[seqno] is not c]
+        for change in lost:
+            # someone else won our slot. ours goes on the end instead
+            logger.debug(f"lost seqno {change.seqno}, appending again")
+            self.append_state(change.state)
@@ -0,0 +1,150 @@
+"""The log's entries in seqno order, as a list of sorted chunks.
+
+Chunks hold at most 2 * CHUNK entries, keys the seqnos of each chunk's
+entries and maxes the last seqno in each, so finding where a seqno goes is a
+bisect over maxes and then over one chunk's keys, and inserting only shifts
+that chunk. Appending past the end,
+which is nearly every insert, just goes on the last chunk.
+"""
+from bisect import bisect_left
+from itertools import chain
+import logging
+from typing import Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+CHUNK = 1024
+
+
+def _seqno(change) -> int:
+    return change.seqno
+
+
+class SortedLog:
+    def __init__(self, changes: Iterable = ()):
+        self.chunks: List[List] = []
+        # seqnos of each chunk, since bisect only takes a key= from 3.10
+        self.keys: List[List[int]] = []
+        self.maxes: List[int] = []
+        self.length = 0
+        self.update(sorted(changes, key=_seqno))
+
+    def _chunk_for(self, seqno: int) -> int:
+        # the first chunk that can hold seqno, or the last if none can
+        return min(bisect_left(self.maxes, seqno), len(self.chunks) - 1)
+
+    def add(self, change):
+        """Insert change, or replace the entry with its seqno."""
+        if not self.chunks:
+            self.chunks.append([change])
+            self.keys.append([change.seqno])
+            self.maxes.append(change.seqno)
+            self.length = 1
+            return
+        i = self._chunk_for(change.seqno)
+        chunk, keys = self.chunks[i], self.keys[i]
+        j = bisect_left(keys, change.seqno)
+        if j < len(keys) and keys[j] == change.seqno:
+            chunk[j] = change
+            return
+        chunk.insert(j, change)
+        keys.insert(j, change.seqno)
+        self.length += 1
+        self.maxes[i] = chunk[-1].seqno
+        if len(chunk) > 2 * CHUNK:
+            self._split(i)
+
+    def update(self, changes: List):
+        """add() every one of changes, which have to be in seqno order, in
+        one pass over the chunks they land in. Where several share a seqno
+        the last one wins."""
+        if not changes:
+            return
+        if not self.chunks:
+            self.chunks.append([])
+            self.keys.append([])
+            self.maxes.append(changes[0].seqno)
+        seqnos = [change.seqno for change in changes]
+        start = 0
+        while start < len(changes):
+            i = self._chunk_for(seqnos[start])
+            if i == len(self.chunks) - 1:
+                end = len(changes)
+            else:
+                # everything up to this chunk's last seqno goes in it
+                end = bisect_left(seqnos, self.maxes[i] + 1, lo=start)
+            self._merge(i, changes, start, end)
+            start = end
+        i = 0
+        while i < len(self.chunks):
+            if len(self.chunks[i]) > 2 * CHUNK:
+                self._split(i)
+            i += 1
+
+    def _merge(self, i: int, changes: List, start: int, end: int):
+        chunk, keys = self.chunks[i], self.keys[i]
+        if (end - start) * 8 < len(chunk):
+            # only a few, so inserting each in place shifts less than
+            # rebuilding the chunk would copy
+            j = 0
+            for k in range(start, end):
+                change = changes[k]
+                seqno = change.seqno
+                j = bisect_left(keys, seqno, lo=j)
+                if j < len(keys) and keys[j] == seqno:
+                    chunk[j] = change
+                else:
+                    chunk.insert(j, change)
+                    keys.insert(j, seqno)
+                    self.length += 1
+            self.maxes[i] = keys[-1]
+            return
+        merged, merged_keys = [], []
+        j = 0
+        for k in range(start, end):
+            change = changes[k]
+            seqno = change.seqno
+            while j < len(keys) and keys[j] < seqno:
+                merged.append(chunk[j])
+                merged_keys.append(keys[j])
+                j += 1
+            if j < len(keys) and keys[j] == seqno:
+                j += 1
+            elif merged_keys and merged_keys[-1] == seqno:
+                merged.pop()
+                merged_keys.pop()
+            else:
+                self.length += 1
+            merged.append(change)
+            merged_keys.append(seqno)
+        merged.extend(chunk[j:])
+        merged_keys.extend(keys[j:])
+        self.chunks[i] = merged
+        self.keys[i] = merged_keys
+        self.maxes[i] = merged_keys[-1]
+
+    def _split(self, i: int):
+        chunk, keys = self.chunks[i], self.keys[i]
+        starts = range(0, len(chunk), CHUNK)
+        self.chunks[i : i + 1] = [chunk[k : k + CHUNK] for k in starts]
+        self.keys[i : i + 1] = pieces = [keys[k : k + CHUNK] for k in starts]
+        self.maxes[i : i + 1] = [piece[-1] for piece in pieces]
+
+    def irange(self, lo: int, hi: int) -> Iterator:
+        """Entries with seqnos in [lo, hi), in order."""
+        if not self.chunks:
+            return
+        i = self._chunk_for(lo)
+        j = bisect_left(self.keys[i], lo)
+        for chunk in self.chunks[i:]:
+            for change in chunk[j:]:
+                if change.seqno >= hi:
+                    return
+                yield change
+            j = 0
+
+    def __iter__(self) -> Iterator:
+        return chain.from_iterable(self.chunks)
+
+    def __len__(self) -> int:
+        return self.length
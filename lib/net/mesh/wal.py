@@ -0,0 +1,292 @@
+"""Append-only storage for a Node's log.
+
+Records go into segment files, each named for the log sequence number (lsn)
+of its first record, as a struct header of length and crc32 followed by the
+payload. A flusher thread writes out and fsyncs whatever has been appended
+every commit_interval, or sooner once commit_bytes are waiting, so one fsync
+covers every append since the last. sync() waits for that to happen to a
+given lsn.
+
+Recovery mmaps each segment and walks it front to back, stopping at the
+first record that's torn or fails its checksum, which is where a crash left
+off. The log is cut there, and any later segments are moved aside.
+snapshot() writes a whole state out in the same format as of an lsn, after
+which every segment entirely before it is deleted, so recovery only ever
+reads one snapshot and the segments since.
+"""
+import logging
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+import zlib
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("!II")  # payload length, crc32 of payload
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+COMMIT_INTERVAL = 0.01
+COMMIT_BYTES = 1024 * 1024
+
+SEGMENT_SUFFIX = ".wal"
+SNAPSHOT_SUFFIX = ".snap"
+# segments after a corrupt one get this added, and are never read again
+CORRUPT_SUFFIX = ".corrupt"
+
+
+def encode_record(payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: Path) -> Tuple[List[bytes], int]:
+    """Every intact record in the file at path, and the offset just past
+    the last of them."""
+    records = []
+    offset = 0
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return records, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset + RECORD_HEADER.size <= size:
+                length, crc = RECORD_HEADER.unpack_from(mm, offset)
+                start = offset + RECORD_HEADER.size
+                if start + length > size:
+                    break
+                payload = mm[start : start + length]
+                if zlib.crc32(payload) != crc:
+                    break
+                records.append(payload)
+                offset = start + length
+    return records, offset
+
+
+class WriteAheadLog:
+    def __init__(
+        self,
+        directory: Path,
+        segment_size: int = SEGMENT_SIZE,
+        commit_interval: float = COMMIT_INTERVAL,
+        commit_bytes: int = COMMIT_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+
+        # encoded records appended but not yet written, and their size
+        self.pending: List[bytes] = []
+        self.pending_bytes = 0
+        self.next_lsn = 0
+        # every record before this one is on disk
+        self.durable_lsn = 0
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.wakeup = threading.Event()
+        self.closed = False
+        # what killed the flusher, if anything did
+        self.error: Optional[Exception] = None
+
+        self.segment = None
+        self.segment_bytes = 0
+        # bytes in segments since the last snapshot, and in that snapshot
+        self.bytes_since_snapshot = 0
+        self.snapshot_bytes = 0
+
+        self.bytes_written = REGISTRY.counter("wal.bytes_written")
+        self.fsyncs = REGISTRY.counter("wal.fsyncs")
+        self.commit_time = REGISTRY.histogram("wal.commit_time")
+        self.thread = None
+
+    def _segments(self) -> List[Tuple[int, Path]]:
+        return sorted(
+            (int(path.stem), path) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}")
+        )
+
+    def _snapshots(self) -> List[Tuple[int, Path]]:
+        return sorted(
+            (int(path.stem), path)
+            for path in self.directory.glob(f"*{SNAPSHOT_SUFFIX}")
+        )
+
+    def recover(self) -> Iterator[bytes]:
+        """Every payload in the latest snapshot, then every one appended
+        since, in order. Call it once, before appending anything."""
+        snapshots = self._snapshots()
+        start = 0
+        if snapshots:
+            start, path = snapshots[-1]
+            records, _ = read_records(path)
+            self.snapshot_bytes = path.stat().st_size
+            yield from records
+
+        lsn = start
+        segments = self._segments()
+        for i, (first, path) in enumerate(segments):
+            records, end = read_records(path)
+            later = segments[i + 1 :]
+            if end < path.stat().st_size:
+                if later:
+                    logger.error(f"{path} is corrupt at {end}, dropping what follows")
+                else:
+                    logger.warning(f"truncating torn write at the end of {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+                # appends carry on from the end of this one, so nothing
+                # after it may be read again
+                for _, later_path in later:
+                    later_path.rename(f"{later_path}{CORRUPT_SUFFIX}")
+                later = []
+            for n, payload in enumerate(records):
+                if first + n >= start:
+                    yield payload
+            lsn = first + len(records)
+            if first + len(records) > start:
+                self.bytes_since_snapshot += end
+            if not later:
+                break
+        self.next_lsn = self.durable_lsn = max(lsn, start)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="wal", daemon=True)
+        self.thread.start()
+
+    def append(self, payload: bytes) -> int:
+        """Queue payload to be written, and return its lsn."""
+        record = encode_record(payload)
+        with self.lock:
+            if self.error:
+                raise self.error
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            self.pending.append(record)
+            self.pending_bytes += len(record)
+            if self.pending_bytes >= self.commit_bytes:
+                self.wakeup.set()
+        return lsn
+
+    def sync(self, lsn: Optional[int] = None):
+        """Wait until every record up to and including lsn is on disk, or
+        every record appended so far if it's None."""
+        with self.lock:
+            target = self.next_lsn if lsn is None else lsn + 1
+            self.wakeup.set()
+            while self.durable_lsn < target and not self.closed:
+                if self.error:
+                    raise self.error
+                self.flushed.wait()
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.commit_interval)
+            self.wakeup.clear()
+            try:
+                self._commit()
+            except Exception as e:
+                # whatever was pending is lost, so nothing more can be
+                # appended after it
+                logger.exception("wal flusher failed")
+                with self.lock:
+                    self.error = e
+                    self.flushed.notify_all()
+                return
+
+    def _commit(self):
+        with self.lock:
+            records, self.pending, self.pending_bytes = self.pending, [], 0
+            end = self.next_lsn
+        if not records:
+            return
+        started = time.perf_counter()
+        lsn = end - len(records)
+        for record in records:
+            if self.segment is None or self.segment_bytes >= self.segment_size:
+                self._rotate(lsn)
+            os.write(self.segment, record)
+            self.segment_bytes += len(record)
+            lsn += 1
+        os.fsync(self.segment)
+        self.fsyncs.inc()
+        written = sum(len(record) for record in records)
+        self.bytes_written.inc(written)
+        self.commit_time.observe(time.perf_counter() - started)
+        with self.lock:
+            self.bytes_since_snapshot += written
+            self.durable_lsn = end
+            self.flushed.notify_all()
+
+    def _rotate(self, lsn: int):
+        if self.segment is not None:
+            os.fsync(self.segment)
+            os.close(self.segment)
+        path = self.directory / f"{lsn:020d}{SEGMENT_SUFFIX}"
+        self.segment = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.segment_bytes = os.fstat(self.segment).st_size
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        # so new and renamed files survive a crash too
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def should_snapshot(self) -> bool:
+        """Whether the log since the last snapshot has outgrown it. A
+        snapshot then writes about as much again as the log it replaces, so
+        each record costs a constant amount to store and to recover however
+        long the history gets."""
+        return self.bytes_since_snapshot >= max(self.snapshot_bytes, self.segment_size)
+
+    def snapshot(self, payloads: Iterable[bytes], lsn: int):
+        """Save payloads as the whole state as of lsn, i.e. with every
+        record before lsn applied, and drop what that makes redundant."""
+        path = self.directory / f"{lsn:020d}{SNAPSHOT_SUFFIX}"
+        tmp = path.with_suffix(".tmp")
+        written = 0
+        with open(tmp, "wb") as f:
+            for payload in payloads:
+                record = encode_record(payload)
+                f.write(record)
+                written += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._fsync_directory()
+        self.bytes_written.inc(written)
+
+        with self.lock:
+            self.snapshot_bytes = written
+            self.bytes_since_snapshot = 0
+        for old, old_path in self._snapshots():
+            if old < lsn:
+                old_path.unlink()
+        segments = self._segments()
+        for (first, seg_path), (following, _) in zip(segments, segments[1:]):
+            # every record in it comes before lsn
+            if following <= lsn:
+                seg_path.unlink()
+        logger.debug(f"snapshot at {lsn}, {written} bytes")
+
+    def close(self):
+        if self.thread and not self.error:
+            self.sync()
+        with self.lock:
+            self.closed = True
+            self.flushed.notify_all()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+        if not self.error:
+            self._commit()
+        if self.segment is not None:
+            os.close(self.segment)
+            self.segment = None
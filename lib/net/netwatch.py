@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import socket
+from typing import Callable, Optional, Set
+
+from lib.metrics import REGISTRY
+from lib.net.util import IPAddress, get_lan_ips
+
+logger = logging.getLogger(__name__)
+
+# rtnetlink multicast groups: links going up or down, and addresses coming
+# and going
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# how often to look for changes where netlink isn't available
+POLL_INTERVAL = 10.0
+# DHCP, VPNs and docks change several things at once, so wait this long
+# after the first netlink message before looking
+SETTLE_DELAY = 1.0
+
+
+def lan_addresses() -> Set[IPAddress]:
+    return get_lan_ips() | get_lan_ips(v6=True)
+
+
+class InterfaceWatcher:
+    """Calls on_change with our new set of LAN addresses whenever it changes.
+
+    On Linux we listen for rtnetlink address and link messages, and rescan
+    once things settle. Anywhere else, or if the netlink socket can't be
+    opened, we rescan every poll_interval instead. Either way on_change is
+    only called when the set of addresses get_lan_ips() returns differs
+    from last time.
+
+    Construct it anywhere, then call start() on the event loop on_change
+    should be called on.
+    """
+
+    def __init__(
+        self,
+        on_change: Callable[[Set[IPAddress]], None],
+        addresses: Set[IPAddress] = None,
+        poll_interval: float = POLL_INTERVAL,
+        settle_delay: float = SETTLE_DELAY,
+    ):
+        self.on_change = on_change
+        self.addresses = set(addresses) if addresses is not None else lan_addresses()
+        self.poll_interval = poll_interval
+        self.settle_delay = settle_delay
+
+        self.sock: Optional[socket.socket] = None
+        self.rescan: Optional[asyncio.TimerHandle] = None
+        self.task = None
+        self.changes = REGISTRY.counter("netwatch.changes")
+
+    def start(self):
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+            )
+            self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            self.sock.setblocking(False)
+        except (AttributeError, OSError) as e:
+            # AttributeError: not Linux, so no AF_NETLINK
+            logger.debug(f"no netlink ({e}), polling interfaces instead")
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+            self.task = asyncio.ensure_future(self._poll())
+            return
+        asyncio.get_event_loop().add_reader(self.sock.fileno(), self._on_netlink)
+
+    def close(self):
+        # safe to call more than once
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.rescan:
+            self.rescan.cancel()
+            self.rescan = None
+        if self.sock:
+            asyncio.get_event_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def _on_netlink(self):
+        # what the messages say doesn't matter, since we rescan everything
+        try:
+            while self.sock.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            # e.g. ENOBUFS when we fell behind, which a rescan covers too
+            logger.debug(f"netlink: {e}")
+        if self.rescan is None:
+            self.rescan = asyncio.get_event_loop().call_later(
+                self.settle_delay, self._rescan
+            )
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self._rescan()
+
+    def _rescan(self):
+        self.rescan = None
+        addresses = lan_addresses()
+        if addresses == self.addresses:
+            return
+        added, removed = addresses - self.addresses, self.addresses - addresses
+        logger.info(f"LAN addresses changed, added {added}, removed {removed}")
+        self.addresses = addresses
+        self.changes.inc()
+        self.on_change(addresses)
@@ -0,0 +1,87 @@
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# peers kept at most, the least recently seen going first
+MAX_PEERS = 256
+# peers not seen for this long are dropped
+MAX_AGE = 7 * 24 * 60 * 60.0
+
+
+@dataclass
+class CachedPeer:
+    uuid: str
+    username: str
+    # host:port we last reached them on
+    address: str
+    # wall clock, so it means something across restarts
+    last_seen: float
+    metadata: Dict[str, str] = field(default_factory=dict)
+
+
+class PeerCache:
+    """Peers we've discovered before, kept on disk between runs, so we can
+    connect to them at startup before mDNS has answered."""
+
+    def __init__(self, path: Path, max_peers: int = MAX_PEERS, max_age=MAX_AGE):
+        self.path = Path(path)
+        self.max_peers = max_peers
+        self.max_age = max_age
+        self.peers: Dict[str, CachedPeer] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                peers = [CachedPeer(**peer) for peer in json.load(f)]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"ignoring unreadable peer cache {self.path}: {e}")
+            return
+        self.peers = {peer.uuid: peer for peer in peers}
+        self._evict()
+
+    def save(self):
+        self._evict()
+        # write then rename, so a crash never leaves half a file
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump([asdict(peer) for peer in self.recent()], f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"couldn't write peer cache {self.path}: {e}")
+
+    def _evict(self):
+        cutoff = time.time() - self.max_age
+        for peer in self.recent()[self.max_peers :]:
+            del self.peers[peer.uuid]
+        for peer in list(self.peers.values()):
+            if peer.last_seen < cutoff:
+                del self.peers[peer.uuid]
+
+    def recent(self) -> List[CachedPeer]:
+        """Every peer, most recently seen first."""
+        return sorted(self.peers.values(), key=lambda p: p.last_seen, reverse=True)
+
+    def seen(self, uuid: str, address: str, metadata: Dict[str, str]):
+        self.peers[uuid] = CachedPeer(
+            uuid=uuid,
+            username=metadata.get("username", uuid),
+            address=address,
+            last_seen=time.time(),
+            metadata=dict(metadata),
+        )
+
+    def touch(self, uuid: str):
+        peer = self.peers.get(uuid)
+        if peer:
+            peer.last_seen = time.time()
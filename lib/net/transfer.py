@@ -0,0 +1,467 @@
+import asyncio
+from dataclasses import dataclass, field
+import hashlib
+import logging
+import mmap
+import os
+from pathlib import Path
+import shutil
+import struct
+import time
+from typing import BinaryIO, Dict, List, Optional
+
+from lib.net.zmq import AsyncZMQManager, ZMQEvent, ZMQEventType
+from lib.ui.event import FileProgressPayload, FileReceivedPayload
+
+logger = logging.getLogger(__name__)
+
+# leading frame of direct messages belonging to a file transfer
+TRANSFER = b"F"
+
+# second frame: what the rest of the message is
+OFFER = b"O"  # sender -> receiver: [header, filename]
+RESUME = b"R"  # receiver -> sender: [header], send from offset with credits
+CHUNK = b"C"  # sender -> receiver: [header, digest, data]
+CREDIT = b"K"  # receiver -> sender: [header], room for more chunks
+DONE = b"D"  # receiver -> sender: [header], everything arrived intact
+CANCEL = b"X"  # either way: [header, reason]
+
+# transfer id, then whatever the message needs
+OFFER_HEADER = struct.Struct("!16sQI")  # id, size, chunk size
+RESUME_HEADER = struct.Struct("!16sQI")  # id, offset, credits
+CHUNK_HEADER = struct.Struct("!16sQ")  # id, offset
+CREDIT_HEADER = struct.Struct("!16sI")  # id, credits
+ID_HEADER = struct.Struct("!16s")  # id
+
+CHUNK_SIZE = 256 * 1024
+DIGEST_SIZE = 16
+# chunks a receiver lets a sender have in flight
+WINDOW = 8
+# how long a sender waits on a silent receiver before giving up
+STALL_TIMEOUT = 30.0
+# how long a receiver waits on a silent sender before giving up, and
+# throwing away what it has
+IDLE_TIMEOUT = 2 * STALL_TIMEOUT
+# offers outside these are refused. MAX_FILE_SIZE is just the default for
+# FileTransfers' max_size, since offers are accepted without asking
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_FILE_SIZE = 1 << 30
+# at most one progress event per transfer per this many seconds
+PROGRESS_INTERVAL = 0.2
+
+
+def chunk_digest(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def transfer_id(sender: str, path: Path, stat: os.stat_result) -> bytes:
+    # stable across retries of the same file, so the receiver can pick a
+    # half finished transfer back up where it left off
+    key = f"{sender}\0{path.resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+@dataclass
+class _Transfer:
+    id: bytes
+    peer: str
+    filename: str
+    size: int
+    chunk_size: int
+    offset: int = 0
+    last_progress: float = 0.0
+
+
+@dataclass
+class _Outgoing(_Transfer):
+    view: Optional[memoryview] = None
+    credits: int = 0
+    done: bool = False
+    # why the transfer failed, for send_file to raise
+    error: Optional[Exception] = None
+    # set whenever the receiver tells us something
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+@dataclass
+class _Incoming(_Transfer):
+    part: Path = None
+    file: BinaryIO = None
+    # we asked the sender to start again from offset, and haven't yet had
+    # the chunk there
+    resyncing: bool = False
+    last_heard: float = field(default_factory=time.monotonic)
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class FileTransfers:
+    """Streams files between peers over AsyncZMQManager's unicast channel.
+
+    The sender mmaps the file and sends it in fixed-size chunks, each a
+    zero-copy view into the mapping with a blake2b digest alongside. The
+    receiver hands out credits for WINDOW chunks at a time, writes each chunk
+    to a .part file as it arrives and never holds more than one in memory.
+    Transfer ids are derived from the file, so offering the same file again
+    resumes from whatever the receiver already has.
+
+    Progress and completion come out of the manager's events() as
+    TRANSFER_PROGRESS and FILE_RECEIVED events.
+
+    Offers are accepted as they come, into directory, as long as they're no
+    bigger than max_size and there's room for them on disk.
+
+    Construct it anywhere, then call start() on the manager's event loop.
+    """
+
+    def __init__(
+        self,
+        manager: AsyncZMQManager,
+        directory: Path = Path.home() / "Downloads",
+        chunk_size: int = CHUNK_SIZE,
+        window: int = WINDOW,
+        max_size: int = MAX_FILE_SIZE,
+    ):
+        self.manager = manager
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.window = window
+        self.max_size = max_size
+
+        self.outgoing: Dict[bytes, _Outgoing] = {}
+        self.incoming: Dict[bytes, _Incoming] = {}
+        self.handlers = {
+            OFFER: self._on_offer,
+            RESUME: self._on_resume,
+            CHUNK: self._on_chunk,
+            CREDIT: self._on_credit,
+            DONE: self._on_done,
+            CANCEL: self._on_cancel,
+        }
+
+    def start(self):
+        self.manager.register_unicast(TRANSFER, self._on_frames)
+
+    def close(self):
+        """Fail every transfer in progress. Part files stay, so offering
+        the same file again later picks up where this one stopped."""
+        # and refuse to start any more
+        self.manager.unregister_unicast(TRANSFER)
+        for t in self.outgoing.values():
+            t.error = ConnectionError("file transfers closed")
+            t.done = True
+            t.wakeup.set()
+        for t in self.incoming.values():
+            self._close_incoming(t)
+        self.incoming.clear()
+
+    async def send_file(self, to: str, path: Path) -> bytes:
+        """Send the file at path to peer `to`. Returns once the receiver has
+        all of it, or raises if the transfer fails."""
+        path = Path(path)
+        stat = path.stat()
+        t = _Outgoing(
+            id=transfer_id(self.manager.name, path, stat),
+            peer=to,
+            filename=path.name,
+            size=stat.st_size,
+            chunk_size=self.chunk_size,
+        )
+        if t.id in self.outgoing:
+            raise RuntimeError(f"already sending {path} to {to}")
+
+        with open(path, "rb") as f:
+            # mmap refuses empty files, and there's nothing to map anyway
+            if t.size > 0:
+                t.view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        self.outgoing[t.id] = t
+        try:
+            await self._send(t)
+        finally:
+            self.outgoing.pop(t.id, None)
+            # chunks still queued in zmq hold their own references, so the
+            # mapping goes away once the last of them is sent
+            t.view = None
+        return t.id
+
+    async def _send(self, t: _Outgoing):
+        header = OFFER_HEADER.pack(t.id, t.size, t.chunk_size)
+        if not await self._send_frames(t.peer, OFFER, header, t.filename.encode()):
+            raise ConnectionError(f"don't know where {t.peer} is")
+
+        while not t.done:
+            # clear before sending rather than after, so a DONE or CANCEL that
+            # lands while we're awaiting a send still wakes the wait below
+            t.wakeup.clear()
+            while t.credits > 0 and t.offset < t.size and not t.done:
+                chunk = t.view[t.offset : t.offset + t.chunk_size]
+                header = CHUNK_HEADER.pack(t.id, t.offset)
+                await self._send_frames(
+                    t.peer, CHUNK, header, chunk_digest(chunk), chunk
+                )
+                t.offset += len(chunk)
+                t.credits -= 1
+                self._progress(t, incoming=False)
+            if t.done:
+                break
+
+            try:
+                await asyncio.wait_for(t.wakeup.wait(), STALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                await self._cancel(t, "timed out waiting on receiver")
+                raise
+        if t.error:
+            raise t.error
+
+        self._progress(t, incoming=False, force=True)
+        logger.debug(f"sent {t.filename} to {t.peer}")
+
+    async def _send_frames(self, to: str, op: bytes, *frames) -> bool:
+        return await self.manager.send_frames(to, [TRANSFER, op, *frames])
+
+    def _send_frames_soon(self, to: str, op: bytes, *frames):
+        # for replies from inside a unicast handler, which can't await
+        asyncio.ensure_future(self._send_frames(to, op, *frames))
+
+    async def _cancel(self, t: _Transfer, reason: str):
+        logger.warning(f"cancelling transfer of {t.filename} with {t.peer}: {reason}")
+        await self._send_frames(t.peer, CANCEL, ID_HEADER.pack(t.id), reason.encode())
+
+    def _progress(self, t: _Transfer, incoming: bool, force: bool = False):
+        now = time.monotonic()
+        if not force and now - t.last_progress < PROGRESS_INTERVAL:
+            return
+        t.last_progress = now
+        self.manager.emit(
+            ZMQEvent(
+                ZMQEventType.TRANSFER_PROGRESS,
+                FileProgressPayload(
+                    id=t.id.hex(),
+                    peer=t.peer,
+                    filename=t.filename,
+                    transferred=t.offset,
+                    size=t.size,
+                    incoming=incoming,
+                ),
+            )
+        )
+
+    def _on_frames(self, peer: str, frames: List[bytes], batch: List[ZMQEvent]):
+        if not frames or frames[0] not in self.handlers:
+            logger.warning(f"dropping malformed file transfer message from {peer}")
+            return
+        try:
+            self.handlers[frames[0]](peer, *frames[1:])
+        except (struct.error, TypeError, ValueError) as e:
+            logger.warning(f"dropping malformed file transfer message from {peer}: {e}")
+
+    # sender side
+
+    def _outgoing(self, peer: str, id: bytes) -> Optional[_Outgoing]:
+        t = self.outgoing.get(id)
+        # only the peer we're sending to gets a say in how it goes
+        return t if t and t.peer == peer else None
+
+    def _on_resume(self, peer: str, header: bytes):
+        id, offset, credits = RESUME_HEADER.unpack(header)
+        t = self._outgoing(peer, id)
+        if t:
+            t.offset = min(offset, t.size)
+            t.credits = credits
+            t.wakeup.set()
+
+    def _on_credit(self, peer: str, header: bytes):
+        id, credits = CREDIT_HEADER.unpack(header)
+        t = self._outgoing(peer, id)
+        if t:
+            t.credits += credits
+            t.wakeup.set()
+
+    def _on_done(self, peer: str, header: bytes):
+        (id,) = ID_HEADER.unpack(header)
+        t = self._outgoing(peer, id)
+        if t:
+            t.offset = t.size
+            t.done = True
+            t.wakeup.set()
+
+    # receiver side
+
+    def _unique_path(self, filename: str) -> Path:
+        path = self.directory / filename
+        n = 1
+        while path.exists():
+            path = (
+                self.directory / f"{Path(filename).stem} ({n}){Path(filename).suffix}"
+            )
+            n += 1
+        return path
+
+    def _on_offer(self, peer: str, header: bytes, filename: bytes):
+        id, size, chunk_size = OFFER_HEADER.unpack(header)
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE or size > self.max_size:
+            logger.warning(
+                f"refusing offer from {peer} of {size} bytes"
+                f" in chunks of {chunk_size}"
+            )
+            self._send_frames_soon(peer, CANCEL, ID_HEADER.pack(id), b"refused")
+            return
+        if id in self.incoming:
+            # the sender restarted, start over from what's on disk
+            self._close_incoming(self.incoming.pop(id))
+
+        # never let a peer pick where on disk we write
+        filename = filename.decode(errors="replace").replace("\0", "")
+        filename = Path(filename).name or "file"
+        t = _Incoming(
+            id=id,
+            peer=peer,
+            filename=filename,
+            size=size,
+            chunk_size=chunk_size,
+            part=self.directory / f".{id.hex()}.part",
+        )
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if t.part.exists():
+                # everything in the part file was checked against its digest
+                # before it got written, so keep every whole chunk of it
+                existing = min(t.part.stat().st_size, size)
+                t.offset = existing - existing % chunk_size
+            free = shutil.disk_usage(self.directory).free
+            if free < size - t.offset:
+                logger.warning(
+                    f"refusing {filename} from {peer}, {size - t.offset} bytes"
+                    f" to go and {free} free"
+                )
+                self._send_frames_soon(
+                    peer, CANCEL, ID_HEADER.pack(id), b"not enough space"
+                )
+                return
+            t.file = open(t.part, "r+b" if t.offset else "w+b")
+            t.file.truncate(t.offset)
+            t.file.seek(t.offset)
+        except OSError as e:
+            self._fail_incoming(t, e)
+            return
+        self.incoming[id] = t
+        self._arm_idle(t)
+
+        logger.debug(f"receiving {filename} from {peer} from offset {t.offset}")
+        self._send_frames_soon(
+            peer, RESUME, RESUME_HEADER.pack(id, t.offset, self.window)
+        )
+        if t.offset == t.size:
+            self._finish(t)
+
+    def _on_chunk(self, peer: str, header: bytes, digest: bytes, data: bytes):
+        id, offset = CHUNK_HEADER.unpack(header)
+        t = self.incoming.get(id)
+        if t is None or t.peer != peer:
+            self._send_frames_soon(
+                peer, CANCEL, ID_HEADER.pack(id), b"unknown transfer"
+            )
+            return
+
+        t.last_heard = time.monotonic()
+        if offset != t.offset:
+            if not t.resyncing:
+                # one went missing on the way
+                logger.warning(f"expected {t.filename} at {t.offset}, not {offset}")
+                self._resync(t)
+            # otherwise it left before the sender heard our RESUME, which
+            # gave it a whole new window, so no credit for this one
+            return
+
+        if chunk_digest(data) != digest:
+            logger.warning(f"bad chunk at {offset} of {t.filename}, resyncing")
+            self._resync(t)
+            return
+
+        t.resyncing = False
+        try:
+            t.file.write(data)
+        except OSError as e:
+            # keep what's been written, a later offer can resume from it
+            self.incoming.pop(id, None)
+            self._fail_incoming(t, e)
+            return
+        t.offset += len(data)
+        self._progress(t, incoming=True)
+        if t.offset >= t.size:
+            self._finish(t)
+        else:
+            self._send_frames_soon(peer, CREDIT, CREDIT_HEADER.pack(id, 1))
+
+    def _resync(self, t: _Incoming):
+        t.resyncing = True
+        self._send_frames_soon(
+            t.peer, RESUME, RESUME_HEADER.pack(t.id, t.offset, self.window)
+        )
+
+    def _arm_idle(self, t: _Incoming):
+        delay = t.last_heard + IDLE_TIMEOUT - time.monotonic()
+        t.timer = asyncio.get_event_loop().call_later(delay, self._on_idle, t)
+
+    def _on_idle(self, t: _Incoming):
+        t.timer = None
+        if self.incoming.get(t.id) is not t:
+            return
+        if time.monotonic() - t.last_heard < IDLE_TIMEOUT:
+            self._arm_idle(t)
+            return
+        logger.warning(f"gave up on {t.filename} from {t.peer}, nothing for a while")
+        self._close_incoming(self.incoming.pop(t.id))
+        t.part.unlink(missing_ok=True)
+        self._send_frames_soon(t.peer, CANCEL, ID_HEADER.pack(t.id), b"timed out")
+
+    def _fail_incoming(self, t: _Incoming, e: OSError):
+        logger.error(f"can't receive {t.filename} from {t.peer}: {e}")
+        self._close_incoming(t)
+        self._send_frames_soon(
+            t.peer, CANCEL, ID_HEADER.pack(t.id), b"can't write the file"
+        )
+
+    def _finish(self, t: _Incoming):
+        self.incoming.pop(t.id, None)
+        self._close_incoming(t)
+        try:
+            path = self._unique_path(t.filename)
+            t.part.rename(path)
+        except OSError as e:
+            self._fail_incoming(t, e)
+            return
+
+        self._send_frames_soon(t.peer, DONE, ID_HEADER.pack(t.id))
+        self._progress(t, incoming=True, force=True)
+        self.manager.emit(
+            ZMQEvent(
+                ZMQEventType.FILE_RECEIVED,
+                FileReceivedPayload(author=t.peer, filename=t.filename, path=str(path)),
+            )
+        )
+        logger.debug(f"received {t.filename} from {t.peer} into {path}")
+
+    @staticmethod
+    def _close_incoming(t: _Incoming):
+        if t.timer:
+            t.timer.cancel()
+            t.timer = None
+        if t.file:
+            t.file.close()
+            t.file = None
+
+    def _on_cancel(self, peer: str, header: bytes, reason: bytes = b""):
+        (id,) = ID_HEADER.unpack(header)
+        reason = reason.decode(errors="replace")
+        logger.warning(f"{peer} cancelled transfer {id.hex()}: {reason}")
+        t = self.incoming.get(id)
+        if t and t.peer == peer:
+            # leave the part file, so the next offer can resume from it
+            self._close_incoming(self.incoming.pop(id))
+        t = self._outgoing(peer, id)
+        if t:
+            t.error = ConnectionError(f"{peer} cancelled: {reason}")
+            t.done = True
+            t.wakeup.set()
@@ -1,15 +1,23 @@
 from abc import ABC, abstractmethod
+import asyncio
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Tuple, Dict, List
+import functools
+from typing import Callable, List, Optional, Set, Tuple, Dict, List
 import logging
 import queue
 import socket
 import socket
-from zeroconf import ServiceBrowser, ServiceInfo, Zeroconf
+import time
+from zeroconf import IPVersion, ServiceInfo, ServiceStateChange, Zeroconf
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
 from time import sleep
 
+from lib.metrics import REGISTRY
+from lib.net.address import AddressBook, usable_addresses
+from lib.net.peers import PeerCache
 from lib.net.util import IPAddress
+from lib.util import LoopThread
 
 logger = logging.getLogger(__name__)
 
@@ -27,14 +35,61 @@ class ZeroInterface(ABC):
         ...
 
 
-class ZeroconfManager:
+# how long to wait for a discovered service to answer with its details
+RESOLVE_TIMEOUT_MS = 3000
+# resolutions on the wire at once. each is a multicast query, and a busy LAN
+# can announce hundreds of peers the moment we start browsing
+MAX_RESOLVING = 32
+# how long peers from the PeerCache have to turn up in mDNS before we give
+# up on them
+CONFIRM_TIMEOUT = 10.0
+# how long changes to the PeerCache wait before being written out, so a
+# burst of discoveries is one write
+SAVE_DELAY = 5.0
+
+# called with (name, address, metadata) for every discovered peer,
+# and (name, None, None) when one goes away
+DiscoveryCallback = Callable[[str, Optional[str], Optional[Dict]], None]
+# called with (name, changes) when a peer's metadata changes, where changes
+# has the new value of everything that did, and None for anything removed
+UpdateCallback = Callable[[str, Dict[str, Optional[str]]], None]
+
+
+class AsyncZeroconfManager:
+    """Publishes our service and browses for peers with python-zeroconf's
+    asyncio API, on whichever event loop start() gets awaited on.
+
+    Discoveries are handed to on_discovered on that loop, so an
+    AsyncZMQManager sharing it can take them without any locking. Peers
+    advertising several addresses are handed over with whichever of them
+    the AddressBook ranks best, and failover() hands over the next best.
+
+    Services are resolved concurrently, at most max_resolving at a time,
+    and straight from zeroconf's record cache when it already has them,
+    so a full friends list takes about as long as the slowest peer does.
+
+    Our own metadata lives in our TXT record, and update_metadata() changes
+    it in place. When a peer's changes, on_updated gets just the fields
+    that did, and anyone who discovers the peer later gets them anyway.
+
+    With a peer_cache, every peer it remembers is handed to on_discovered
+    as soon as we start, at its last good address, so they're connected
+    before mDNS has answered. Any that mDNS hasn't confirmed within
+    confirm_timeout are then dropped again.
+    """
+
     def __init__(
         self,
         name: str,
         metadata: Dict,
-        addresses: List[str],
+        addresses: List[IPAddress],
         port: int,
-        event_queue: queue.Queue,
+        on_discovered: DiscoveryCallback,
+        address_book: AddressBook = None,
+        max_resolving: int = MAX_RESOLVING,
+        on_updated: UpdateCallback = None,
+        peer_cache: PeerCache = None,
+        confirm_timeout: float = CONFIRM_TIMEOUT,
     ):
         self.service_info = ServiceInfo(
             type_=ZEROCONF_TYPE,
@@ -43,51 +98,318 @@ class ZeroconfManager:
             addresses=[ip.packed for ip in addresses],
             properties=metadata,
         )
+        self.own_metadata = dict(metadata)
         self.friends = {}
+        # service name -> what it resolved to last
+        self.services: Dict[str, ServiceInfo] = {}
+        # service name -> the properties it advertised
+        self.metadata: Dict[str, Dict] = {}
+        self.address_book = address_book or AddressBook()
+        self.on_discovered = on_discovered
+        self.on_updated = on_updated
+        self.max_resolving = max_resolving
+        # service name -> its resolution in flight, which also keeps the
+        # task from being collected
+        self.resolving: Dict[str, asyncio.Task] = {}
+        # the same for updates
+        self.pending = set()
+        self.peer_cache = peer_cache
+        self.confirm_timeout = confirm_timeout
+        # names handed over from the peer cache and not yet seen in mDNS
+        self.speculative: Set[str] = set()
+        self.timers: List[asyncio.TimerHandle] = []
+        self.save_timer: Optional[asyncio.TimerHandle] = None
+        REGISTRY.gauge("zeroconf.resolving", lambda: len(self.resolving))
+        self.resolve_time = REGISTRY.histogram("zeroconf.resolve_time")
+        self.resolve_timeouts = REGISTRY.counter("zeroconf.resolve_timeouts")
+        self.cache_hits = REGISTRY.counter("zeroconf.resolve_cached")
 
-        self.zc = Zeroconf()
-        self.zc.register_service(self.service_info)
-        self.browser = ServiceBrowser(
-            self.zc,
+    async def start(self):
+        # made here so it belongs to the loop we run on
+        self.slots = asyncio.Semaphore(self.max_resolving)
+        if self.peer_cache:
+            # before registering, which takes a few hundred ms of announcing
+            self._preconnect()
+        self.azc = AsyncZeroconf()
+        await self.azc.async_register_service(self.service_info)
+        self.browser = AsyncServiceBrowser(
+            self.azc.zeroconf,
             ZEROCONF_TYPE,
-            listener=self,
+            handlers=[self._on_service_state_change],
         )
-
-        self.queue = event_queue
         logger.debug("zeroconf up")
 
-    def close(self):
-        self.browser.cancel()
-        self.zc.unregister_service(self.service_info)
-        self.zc.close()
+    async def close(self):
+        await self.browser.async_cancel()
+        for task in list(self.resolving.values()) + list(self.pending):
+            task.cancel()
+        for timer in self.timers:
+            timer.cancel()
+        if self.peer_cache:
+            self.peer_cache.save()
+        await self.azc.async_unregister_service(self.service_info)
+        await self.azc.async_close()
         logger.debug("zeroconf down")
 
-    def make_address(self, svc: ServiceInfo) -> str:
-        dst_address = "10.20.30.55" # socket.inet_ntoa(svc.addresses[0])
-        return f"{dst_address}:{svc.port}"
-
-    def add_service(self, zeroconf, type, name) -> str:
-        svc = zeroconf.get_service_info(type, name)
-        address = ""
-        if svc.name != self.service_info.name:
-            logger.debug(f"discovered friend {name} {address}")
-            metadata = {
-                key.decode(): value.decode() for key, value in svc.properties.items()
-            }
-            address = self.make_address(svc)
-            self.friends[svc.name] = address
-
-            # put information into the queue so downstream
-            # libraries can consume it in a thread-safe way
-            if self.queue:
-                self.queue.put((name, address, metadata))
-
-    def remove_service(self, zeroconf, type, name):
-        address = self.friends.pop(name)
+    def _preconnect(self):
+        for peer in self.peer_cache.recent():
+            name = f"{peer.uuid}.{ZEROCONF_TYPE}"
+            if name == self.service_info.name:
+                continue
+            logger.debug(f"connecting to cached friend {name} {peer.address}")
+            self.speculative.add(name)
+            self.friends[name] = peer.address
+            self.metadata[name] = peer.metadata
+            self.on_discovered(name, peer.address, peer.metadata)
+        if self.speculative:
+            self.timers.append(
+                asyncio.get_event_loop().call_later(
+                    self.confirm_timeout, self._evict_unconfirmed
+                )
+            )
+
+    def _evict_unconfirmed(self):
+        for name in self.speculative:
+            logger.debug(f"cached friend {name} never showed up")
+            self.friends.pop(name, None)
+            self.metadata.pop(name, None)
+            self.on_discovered(name, None, None)
+        self.speculative.clear()
+
+    def _remember(self, name: str):
+        if not self.peer_cache:
+            return
+        uuid = name.split(".")[0]
+        if name in self.friends:
+            self.peer_cache.seen(uuid, self.friends[name], self.metadata[name])
+        else:
+            self.peer_cache.touch(uuid)
+        if self.save_timer is None:
+            self.save_timer = asyncio.get_event_loop().call_later(
+                SAVE_DELAY, self._save
+            )
+            self.timers.append(self.save_timer)
+
+    def _save(self):
+        self.timers.remove(self.save_timer)
+        self.save_timer = None
+        self.peer_cache.save()
+
+    async def make_address(self, svc: ServiceInfo) -> Optional[str]:
+        addresses = usable_addresses(svc.addresses_by_version(IPVersion.All))
+        return await self.address_book.choose(svc.name, addresses, svc.port)
+
+    def _on_service_state_change(
+        self,
+        zeroconf: Zeroconf,
+        service_type: str,
+        name: str,
+        state_change: ServiceStateChange,
+    ):
+        if state_change == ServiceStateChange.Added:
+            if name not in self.resolving:
+                task = asyncio.ensure_future(self.add_service(service_type, name))
+                self.resolving[name] = task
+                task.add_done_callback(functools.partial(self._resolved, name))
+        elif state_change == ServiceStateChange.Removed:
+            self.remove_service(service_type, name)
+        elif state_change == ServiceStateChange.Updated:
+            task = asyncio.ensure_future(self.update_service(service_type, name))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    def _resolved(self, name: str, task: asyncio.Task):
+        # unless it was cancelled and another resolution took its place
+        if self.resolving.get(name) is task:
+            del self.resolving[name]
+
+    async def resolve(self, type: str, name: str) -> Optional[AsyncServiceInfo]:
+        svc = AsyncServiceInfo(type, name)
+        # the browser's answers usually come with everything we need, in
+        # which case there's no query to make and no slot to wait for
+        if svc.load_from_cache(self.azc.zeroconf):
+            self.cache_hits.inc()
+            return svc
+        async with self.slots:
+            start = time.monotonic()
+            if not await svc.async_request(self.azc.zeroconf, RESOLVE_TIMEOUT_MS):
+                self.resolve_timeouts.inc()
+                return None
+            self.resolve_time.observe(time.monotonic() - start)
+        return svc
+
+    async def add_service(self, type: str, name: str):
+        if name == self.service_info.name:
+            return
+
+        svc = await self.resolve(type, name)
+        if svc is None:
+            logger.warning(f"timed out resolving {name}")
+            return
+
+        address = await self.make_address(svc)
+        if address is None:
+            logger.warning(f"{name} advertised no address we can reach")
+            return
+        logger.debug(f"discovered friend {name} {address}")
+        metadata = self._metadata(svc)
+        self.speculative.discard(svc.name)
+        self.friends[svc.name] = address
+        self.services[svc.name] = svc
+        self.metadata[svc.name] = metadata
+        self._remember(svc.name)
+        self.on_discovered(name, address, metadata)
+
+    def remove_service(self, type: str, name: str):
+        task = self.resolving.pop(name, None)
+        if task:
+            # gone before we finished resolving it
+            task.cancel()
+        self.speculative.discard(name)
+        address = self.friends.pop(name, None)
+        self.services.pop(name, None)
+        self.metadata.pop(name, None)
+        self._remember(name)
+        self.address_book.forget(name)
         if address:
             logger.debug(f"lost friend {name}")
+            self.on_discovered(name, None, None)
+
+    async def failover(self, peer: str):
+        """Move peer over to its next best address, if it has one that
+        answers, e.g. once its heartbeats stop arriving on this one."""
+        name = f"{peer}.{ZEROCONF_TYPE}"
+        if name not in self.friends:
+            return
+        address = await self.address_book.failover(name)
+        # it may have gone away while we were probing
+        if address and name in self.friends:
+            self.friends[name] = address
+            self._remember(name)
+            self.on_discovered(name, address, self.metadata[name])
+
+    @staticmethod
+    def _metadata(svc: ServiceInfo) -> Dict[str, str]:
+        return {
+            key.decode(): value.decode() if value is not None else ""
+            for key, value in svc.properties.items()
+        }
+
+    async def update_service(self, type: str, name: str):
+        if name not in self.friends:
+            # still being resolved, which will pick up whatever changed
+            return
+        svc = await self.resolve(type, name)
+        if svc is None or name not in self.friends:
+            return
+        self.services[name] = svc
+
+        metadata = self._metadata(svc)
+        address = await self.make_address(svc)
+        if address and address != self.friends[name]:
+            # it moved, which downstream takes as a whole new discovery
+            logger.debug(f"{name} moved to {address}")
+            self.friends[name] = address
+            self.metadata[name] = metadata
+            self._remember(name)
+            self.on_discovered(name, address, metadata)
+            return
+
+        old = self.metadata.get(name, {})
+        changes = {k: v for k, v in metadata.items() if old.get(k) != v}
+        changes.update({k: None for k in old if k not in metadata})
+        self.metadata[name] = metadata
+        if changes:
+            self._remember(name)
+        if changes and self.on_updated:
+            logger.debug(f"{name} updated {changes}")
+            self.on_updated(name, changes)
+
+    async def update_metadata(self, changes: Dict[str, str]):
+        """Change fields of our own TXT record, and tell everyone."""
+        metadata = {**self.own_metadata, **changes}
+        if metadata == self.own_metadata:
+            return
+        self.own_metadata = metadata
+        await self._reannounce(
+            self.service_info.addresses_by_version(IPVersion.All), metadata
+        )
+
+    async def update_addresses(self, addresses: List[IPAddress]):
+        """Advertise a new set of our addresses, e.g. after a DHCP renew."""
+        packed = [ip.packed for ip in addresses]
+        if set(packed) == set(self.service_info.addresses_by_version(IPVersion.All)):
+            return
+        await self._reannounce(packed, self.own_metadata)
+
+    async def _reannounce(self, addresses: List[bytes], metadata: Dict):
+        old = self.service_info
+        self.service_info = ServiceInfo(
+            type_=old.type,
+            name=old.name,
+            port=old.port,
+            addresses=addresses,
+            properties=metadata,
+            # filled in when the original was registered
+            server=old.server,
+        )
+        await self.azc.async_update_service(self.service_info)
+
+
+class ZeroconfManager:
+    """Threaded shim around AsyncZeroconfManager.
+
+    Discoveries go into event_queue as (name, address, metadata) tuples,
+    with address None for peers that went away, and metadata changes as
+    (name, changes) tuples. The manager runs on loop,
+    which is started for us if we aren't handed one to share.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        metadata: Dict,
+        addresses: List[IPAddress],
+        port: int,
+        event_queue: queue.Queue,
+        loop: LoopThread = None,
+        peer_cache: PeerCache = None,
+    ):
+        self.queue = event_queue
+        self.owns_loop = loop is None
+        self.loop = loop or LoopThread(name="zeroconf")
+
+        self.manager = AsyncZeroconfManager(
+            name,
+            metadata,
+            addresses,
+            port,
+            on_discovered=self._on_discovered,
+            on_updated=self._on_updated,
+            peer_cache=peer_cache,
+        )
+        self.loop.submit(self.manager.start()).result()
+
+    def _on_discovered(self, name: str, address: Optional[str], metadata: Dict):
+        # put information into the queue so downstream
+        # libraries can consume it in a thread-safe way
+        if self.queue:
+            self.queue.put((name, address, metadata))
+
+    def _on_updated(self, name: str, changes: Dict[str, Optional[str]]):
         if self.queue:
-            self.queue.put((name, None, None))
+            self.queue.put((name, changes))
+
+    def update_metadata(self, changes: Dict[str, str]):
+        self.loop.submit(self.manager.update_metadata(changes))
 
-    def update_service(self, *args):
-        pass
+    def update_addresses(self, addresses: List[IPAddress]):
+        self.loop.submit(self.manager.update_addresses(addresses))
+
+    def failover(self, peer: str):
+        self.loop.submit(self.manager.failover(peer))
+
+    def close(self):
+        self.loop.submit(self.manager.close()).result()
+        if self.owns_loop:
+            self.loop.stop()
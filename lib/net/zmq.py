@@ -1,26 +1,119 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, is_dataclass
-import dataclasses
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
-import json
-from typing import Any, List, Tuple, Dict
+import functools
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    List,
+    Tuple,
+    Dict,
+    Optional,
+    Set,
+)
 import logging
 import queue
+import random
 import socket
 import socket
+import struct
 import threading
+import time
 import zmq
+import zmq.asyncio
 
+from lib.net.codec import (
+    CODECS,
+    COMPRESSION_THRESHOLD,
+    Codec,
+    CodecError,
+    compress,
+    decode_any,
+)
+from lib.metrics import REGISTRY
 from lib.net.util import IPAddress
-from lib.util import EventQueue
+from lib.ui.event import EventMessage
+from lib.util import EventQueue, LoopThread
 
 logger = logging.getLogger(__name__)
 
 
+# topic for messages addressed to everyone. peer names are uuids, so this
+# can't collide with (or be a prefix of) a peer's topic.
+BROADCAST_TOPIC = "*"
+# clients from before topics publish every message as a single JSON frame,
+# with no topic or sender, so it starts with this. what we send them goes out
+# on a LegacyPublisher instead, see below
+LEGACY_TOPIC = "{"
+
+# a manager binds the port it's given, which is the one it advertises, and
+# the next few after it:
+#   port      LegacyPublisher, for clients from before topics. they subscribe
+#             to everything on it, so it only ever carries single JSON frames
+#   port + 1  Router, for direct messages
+#   port + 2  Publisher, for peers that advertise their "caps"
+UNICAST_PORT_OFFSET = 1
+PUBLISHER_PORT_OFFSET = 2
+PORT_SPAN = 3
+# leading frame of a direct message carrying an encoded EventMessage.
+# other kinds of direct traffic register their own with register_unicast()
+UNICAST_MESSAGE = b"M"
+
+# (peer, frames after the kind frame, batch to add events to)
+UnicastHandler = Callable[[str, List[bytes], List["ZMQEvent"]], None]
+# (peer, content frame, batch to add events to)
+TopicHandler = Callable[[str, bytes, List["ZMQEvent"]], None]
+
+# direct messages with sequence numbers, and acks for them, exchanged with
+# peers that advertise RELIABLE_CAPABILITY in their "caps"
+RELIABLE_MESSAGE = b"S"
+ACK = b"A"
+RELIABLE_CAPABILITY = "seq"
+
+# our epoch, seq and the oldest seq we can still resend, then an ack for the
+# peer's messages to us riding along: their epoch (0 for none) and cum
+RELIABLE_HEADER = struct.Struct("!IQQIQ")
+# epoch and cumulative seq of the stream being acked. (first, last) ranges
+# that arrived past the cumulative seq follow in a frame of their own
+ACK_HEADER = struct.Struct("!IQ")
+SACK_RANGE = struct.Struct("!QQ")
+MAX_SACK_RANGES = 16
+
+# how long a receiver holds an ack back, hoping to piggyback it on a reply
+ACK_DELAY = 0.05
+# the first retransmit comes this long after a send goes unacked, doubling
+# each time up to RETRANSMIT_MAX
+RETRANSMIT_TIMEOUT = 0.5
+RETRANSMIT_MAX = 8.0
+# retransmit rounds without hearing an ack before giving up on the peer
+MAX_RETRANSMITS = 8
+# bytes of unacked messages held per peer before giving up on the oldest
+RETRANSMIT_BUDGET = 256 * 1024
+
+
+class TransportMode(Enum):
+    # one SUB socket per peer
+    PER_PEER = 1
+    # one SUB socket connected to every peer, demuxed on the sender frame
+    MULTIPLEXED = 2
+
+
 class ZMQEventType(Enum):
     SOCKET_ADDED = 1
     SOCKET_REMOVED = 2
     MESSAGE_RECEIVED = 3
+    TRANSFER_PROGRESS = 4
+    FILE_RECEIVED = 5
+    # (peer, EventMessage) once the peer acks a reliably sent message
+    MESSAGE_DELIVERED = 6
+    # (peer, Status) when heartbeats say a peer's presence changed
+    PEER_STATUS = 7
+    # (peer, {field: new value or None}) when discovery metadata changes
+    PEER_UPDATED = 8
 
 
 @dataclass
@@ -43,6 +136,9 @@ class Socket:
         self.cxn = cxn
 
         self.sock = self.ctx.socket(self.socktype)
+        # peers may only be reachable over IPv6, and binding * with this set
+        # listens on both
+        self.sock.setsockopt(zmq.IPV6, 1)
 
     @property
     def normalized_name(self):
@@ -51,8 +147,8 @@ class Socket:
     def __str__(self):
         return f"{self.normalized_name}.{self.cxn}"
 
-    def close(self):
-        self.sock.close()
+    def close(self, linger: int = None):
+        self.sock.close(linger=linger)
 
     def is_closed(self):
         return self.sock.closed
@@ -62,80 +158,816 @@ class Socket:
 
 
 class Publisher(Socket):
-    def __init__(self, name: str, cxn: str):
-        super().__init__(zmq.PUB, name, cxn)
+    """Publishes [topic, sender, content] multipart messages.
+
+    The topic is the recipient's name, or BROADCAST_TOPIC. Since ZMQ 3, SUB
+    sockets forward their subscriptions upstream over tcp and PUB drops
+    anything nobody subscribed to before it hits the wire, so a message
+    addressed to one peer only costs bandwidth for that peer.
+    """
+
+    def __init__(self, name: str, cxn: str, ctx: zmq.Context = None):
+        super().__init__(zmq.PUB, name, cxn, ctx)
+        self.messages_out = REGISTRY.counter("zmq.published.messages", publisher=name)
+        self.bytes_out = REGISTRY.counter("zmq.published.bytes", publisher=name)
 
         self.sock.bind(self.cxn)
         logger.debug(f"Publisher socket {name}@{cxn} up")
 
-    def send_message(self, message: str):
-        self.sock.send_string(message)
+    def send_message(self, message: bytes, topic: str = BROADCAST_TOPIC):
+        # lead with our name so a multiplexed subscriber can tell who sent it.
+        # on a zmq.asyncio socket this returns an awaitable
+        self.messages_out.inc()
+        self.bytes_out.inc(len(message))
+        return self.sock.send_multipart([topic.encode(), self.name.encode(), message])
+
+
+class LegacyPublisher(Socket):
+    """Publishes messages the way clients from before topics expect them, as
+    one JSON frame each. They read every frame as a whole message, so
+    anything else on this socket would break them."""
+
+    def __init__(self, name: str, cxn: str, ctx: zmq.Context = None):
+        super().__init__(zmq.PUB, name, cxn, ctx)
+        self.messages_out = REGISTRY.counter("zmq.published_legacy.messages")
+        self.bytes_out = REGISTRY.counter("zmq.published_legacy.bytes")
+
+        self.sock.bind(self.cxn)
+        logger.debug(f"LegacyPublisher socket {name}@{cxn} up")
+
+    def send_message(self, message: bytes):
+        self.messages_out.inc()
+        self.bytes_out.inc(len(message))
+        return self.sock.send(message)
+
+
+def subscribe(sock: zmq.Socket, topics: Iterable[str]):
+    for topic in topics:
+        sock.setsockopt_string(zmq.SUBSCRIBE, topic)
 
 
 class Subscriber(Socket):
-    def __init__(self, name: str, cxn: str):
-        super().__init__(zmq.SUB, name, cxn)
+    def __init__(
+        self,
+        name: str,
+        cxn: str,
+        topics: Iterable[str] = ("",),
+        ctx: zmq.Context = None,
+    ):
+        super().__init__(zmq.SUB, name, cxn, ctx)
 
         self.sock.connect(self.cxn)
-        self.sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        subscribe(self.sock, topics)
         logger.debug(f"Subscriber socket {name}@{cxn} up")
 
 
-class ZMQManager:
-    """ZMQ Socket Manager. Holds data and callbacks for the sockets
-    we use to communicate with other instances.
+class MultiplexSubscriber(Socket):
+    """A single SUB socket connected to every peer's Publisher.
 
-    Consumers interact with this class by:
-        1. calling send_message() to publish messages to subscribers
-        2. polling subscriber_events() for messages from subscriptions
+    Peers are told apart by the sender frame Publisher puts in front of every
+    message, so adding or dropping a peer is a connect() or disconnect() rather
+    than a new socket, fd and set of zmq I/O objects.
     """
 
-    def __init__(self, name: str, port: int):
-        # we populate this for external use
-        self.subscriber_events = EventQueue()
+    def __init__(
+        self, name: str, topics: Iterable[str] = ("",), ctx: zmq.Context = None
+    ):
+        super().__init__(zmq.SUB, name, "*", ctx)
+        # peer name -> endpoint
+        self.endpoints = {}
 
-        # this gets populated externally
-        self.discover_events = EventQueue()
+        subscribe(self.sock, topics)
+        logger.debug(f"Multiplexed subscriber socket {name} up")
+
+    def connect(self, peer: str, cxn: str):
+        if self.endpoints.get(peer) == cxn:
+            return
+        self.disconnect(peer)
+        self.sock.connect(cxn)
+        self.endpoints[peer] = cxn
+
+    def disconnect(self, peer: str) -> Optional[str]:
+        cxn = self.endpoints.pop(peer, None)
+        if cxn:
+            self.release(cxn)
+        return cxn
+
+    def park(self, peer: str) -> Optional[str]:
+        """Stop taking messages from peer, but stay connected to it, so
+        resume() can pick it back up without a new handshake."""
+        return self.endpoints.pop(peer, None)
+
+    def resume(self, peer: str, cxn: str):
+        old = self.endpoints.get(peer)
+        if old and old != cxn:
+            self.disconnect(peer)
+        self.endpoints[peer] = cxn
+
+    def release(self, cxn: str):
+        try:
+            self.sock.disconnect(cxn)
+        except zmq.error.ZMQError as e:
+            logger.error(f"error while disconnecting from {cxn}: {e}")
+
+
+class Router(Socket):
+    """Receives direct messages from peers' Dealers as
+    [identity, kind, content], where identity is the sender's name."""
+
+    def __init__(self, name: str, cxn: str, ctx: zmq.Context = None):
+        super().__init__(zmq.ROUTER, name, cxn, ctx)
+
+        # a peer that reconnects with the same identity takes over its route
+        self.sock.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.sock.bind(self.cxn)
+        logger.debug(f"Router socket {name}@{cxn} up")
+
+
+class Dealer(Socket):
+    """Sends direct messages to one peer's Router, identified by our name."""
+
+    def __init__(self, name: str, cxn: str, ctx: zmq.Context = None):
+        super().__init__(zmq.DEALER, name, cxn, ctx)
+
+        self.sock.setsockopt(zmq.IDENTITY, name.encode())
+        self.sock.connect(self.cxn)
+        logger.debug(f"Dealer socket {name}@{cxn} up")
+
+
+class UnicastChannel:
+    """A Dealer connected to one peer, with its own send queue.
+
+    Messages wait in the queue while the connection comes up, and a slow or
+    unreachable peer only ever backs up its own messages.
+    """
+
+    def __init__(self, name: str, peer: str, cxn: str, ctx: zmq.Context, maxsize: int):
+        self.peer = peer
+        self.dealer = Dealer(name=name, cxn=cxn, ctx=ctx)
+        self.queue = asyncio.Queue(maxsize)
+        self.task = asyncio.ensure_future(self._flush())
+
+        self.messages_out = REGISTRY.counter("zmq.unicast_sent.messages", peer=peer)
+        self.bytes_out = REGISTRY.counter("zmq.unicast_sent.bytes", peer=peer)
+        self.dropped = REGISTRY.counter("zmq.unicast_sent.dropped", peer=peer)
+        REGISTRY.gauge("zmq.unicast_sent.queued", self.queue.qsize, peer=peer)
+
+    @property
+    def cxn(self) -> str:
+        return self.dealer.cxn
+
+    async def put(self, frames: List[bytes]):
+        await self.queue.put(frames)
+
+    def put_nowait(self, frames: List[bytes]) -> bool:
+        try:
+            self.queue.put_nowait(frames)
+        except asyncio.QueueFull:
+            logger.warning(f"send queue to {self.peer} is full, dropping message")
+            self.dropped.inc()
+            return False
+        return True
+
+    async def _flush(self):
+        sock = self.dealer.sock
+        while True:
+            frames = await self.queue.get()
+            try:
+                # frames may be views into something big, like a mmapped
+                # file. pyzmq keeps a reference until libzmq is done with them
+                await sock.send_multipart(frames, copy=False)
+                self.messages_out.inc()
+                self.bytes_out.inc(sum(len(frame) for frame in frames))
+            except zmq.error.ZMQError as e:
+                if sock.closed:
+                    return
+                logger.error(f"error while sending to {self.peer}: {e}")
+
+    def close(self):
+        self.task.cancel()
+        # the peer is gone or moved, don't hang on to what we couldn't send
+        self.dealer.close(linger=0)
+
+
+@dataclass
+class _OutStream:
+    """Our sequenced messages to one peer."""
+
+    # a fresh one per stream, so once we forget a peer and start over at
+    # seq 1 it can't mistake the new messages for ones it already has
+    epoch: int = field(default_factory=lambda: random.getrandbits(32) or 1)
+    next_seq: int = 1
+    # seq -> (encoded message, the EventMessage it came from)
+    unacked: "OrderedDict[int, Tuple[bytes, EventMessage]]" = field(
+        default_factory=OrderedDict
+    )
+    size: int = 0
+    timeout: float = RETRANSMIT_TIMEOUT
+    timer: Optional[asyncio.TimerHandle] = None
+    # retransmit rounds since the last ack
+    tries: int = 0
+
+    @property
+    def base(self) -> int:
+        # the oldest seq we could still resend
+        return next(iter(self.unacked), self.next_seq)
+
+
+@dataclass
+class _InStream:
+    """What has arrived of one peer's sequenced messages to us."""
+
+    # the stream's, so when the peer starts a new one we start over too
+    epoch: int
+    # everything up to and including cum has arrived
+    cum: int = 0
+    # seqs past cum that arrived out of order
+    received: Set[int] = field(default_factory=set)
+    ack_timer: Optional[asyncio.TimerHandle] = None
+
+    def advance(self):
+        while self.cum + 1 in self.received:
+            self.cum += 1
+            self.received.discard(self.cum)
+
+    def sack_ranges(self) -> List[Tuple[int, int]]:
+        ranges = []
+        for seq in sorted(self.received):
+            if ranges and ranges[-1][1] == seq - 1:
+                ranges[-1] = (ranges[-1][0], seq)
+            else:
+                ranges.append((seq, seq))
+        return ranges[:MAX_SACK_RANGES]
+
+
+class ReliableDelivery:
+    """Sequence numbers, acks and retransmits for direct messages.
+
+    Every message to a peer gets the next seq in our stream to it. The peer
+    acks cumulatively after ACK_DELAY, or sooner by piggybacking the ack on
+    a message of its own, so a conversation costs no extra messages. When a
+    seq arrives past a gap, the peer acks right away with the ranges it does
+    have, and we resend only what's missing from them. Anything unacked for
+    too long gets resent with backoff.
+
+    Unacked messages are held up to `budget` bytes per peer. Past that we
+    give up on the oldest, and tell the peer not to wait for them by sending
+    the oldest seq we still have along with every message. After
+    MAX_RETRANSMITS rounds with no ack, or once the peer is gone, we give up
+    on the whole stream.
+    """
+
+    def __init__(self, manager: "AsyncZMQManager", budget: int = RETRANSMIT_BUDGET):
+        self.manager = manager
+        self.budget = budget
+        self.outgoing: Dict[str, _OutStream] = {}
+        self.incoming: Dict[str, _InStream] = {}
+        manager.register_unicast(RELIABLE_MESSAGE, self._on_message)
+        manager.register_unicast(ACK, self._on_ack)
+
+    def close(self):
+        for stream in self.outgoing.values():
+            if stream.timer:
+                stream.timer.cancel()
+        for stream in self.incoming.values():
+            if stream.ack_timer:
+                stream.ack_timer.cancel()
+
+    def forget(self, peer: str):
+        """Drop our streams to and from peer, and stop resending to it."""
+        stream = self.outgoing.pop(peer, None)
+        if stream and stream.timer:
+            stream.timer.cancel()
+        if stream and stream.unacked:
+            # not per peer, or _forget_metrics() would take it with the peer
+            REGISTRY.counter("zmq.reliable.abandoned").inc(len(stream.unacked))
+            logger.info(f"gave up on {len(stream.unacked)} messages to {peer}")
+        incoming = self.incoming.pop(peer, None)
+        if incoming and incoming.ack_timer:
+            incoming.ack_timer.cancel()
+
+    def sequence(self, peer: str, data: bytes, payload: EventMessage) -> List[bytes]:
+        """Frames carrying data to peer as the next message in our stream."""
+        stream = self.outgoing.setdefault(peer, _OutStream())
+        seq = stream.next_seq
+        stream.next_seq += 1
+        stream.unacked[seq] = (data, payload)
+        stream.size += len(data)
+        while stream.size > self.budget and len(stream.unacked) > 1:
+            old, (old_data, _) = stream.unacked.popitem(last=False)
+            stream.size -= len(old_data)
+            REGISTRY.counter("zmq.reliable.abandoned").inc()
+            logger.warning(f"retransmit buffer for {peer} is full, dropped {old}")
+        self._arm(peer, stream)
+        return self._frames(peer, stream, seq, data)
+
+    def _frames(self, peer: str, stream: _OutStream, seq: int, data: bytes):
+        ack_epoch, ack_cum = 0, 0
+        incoming = self.incoming.get(peer)
+        if incoming and incoming.ack_timer:
+            # we owe them an ack. this message can carry it instead
+            incoming.ack_timer.cancel()
+            incoming.ack_timer = None
+            ack_epoch, ack_cum = incoming.epoch, incoming.cum
+        header = RELIABLE_HEADER.pack(
+            stream.epoch, seq, stream.base, ack_epoch, ack_cum
+        )
+        return [RELIABLE_MESSAGE, header, data]
+
+    def _resend(self, peer: str, seqs: Iterable[int]):
+        stream = self.outgoing[peer]
+        channel = self.manager._channel(peer)
+        if channel is None:
+            return
+        for seq in seqs:
+            data, _ = stream.unacked[seq]
+            REGISTRY.counter("zmq.reliable.retransmits", peer=peer).inc()
+            channel.put_nowait(self._frames(peer, stream, seq, data))
+
+    def _arm(self, peer: str, stream: _OutStream):
+        if stream.timer is None and stream.unacked:
+            stream.timer = asyncio.get_event_loop().call_later(
+                stream.timeout, self._on_timeout, peer
+            )
+
+    def _on_timeout(self, peer: str):
+        stream = self.outgoing[peer]
+        stream.timer = None
+        stream.tries += 1
+        if stream.tries > MAX_RETRANSMITS:
+            self.forget(peer)
+            return
+        logger.debug(f"{len(stream.unacked)} messages to {peer} unacked, resending")
+        self._resend(peer, list(stream.unacked))
+        stream.timeout = min(stream.timeout * 2, RETRANSMIT_MAX)
+        self._arm(peer, stream)
+
+    def _acked(self, peer: str, epoch: int, cum: int, sacks, batch: List[ZMQEvent]):
+        stream = self.outgoing.get(peer)
+        if stream is None or epoch != stream.epoch:
+            # an ack for a stream we've since forgotten
+            return
+
+        delivered = []
+        while stream.unacked and next(iter(stream.unacked)) <= cum:
+            delivered.append(stream.unacked.popitem(last=False))
+        holes = []
+        if sacks:
+            for seq in list(stream.unacked):
+                if any(first <= seq <= last for first, last in sacks):
+                    delivered.append((seq, stream.unacked.pop(seq)))
+                elif seq < sacks[-1][1]:
+                    holes.append(seq)
+
+        for _, (data, payload) in delivered:
+            stream.size -= len(data)
+            batch.append(ZMQEvent(ZMQEventType.MESSAGE_DELIVERED, (peer, payload)))
+        if delivered:
+            # they're listening, so back to resending promptly
+            stream.timeout = RETRANSMIT_TIMEOUT
+            stream.tries = 0
+            if stream.timer:
+                stream.timer.cancel()
+                stream.timer = None
+            self._arm(peer, stream)
+        if holes:
+            self._resend(peer, holes)
+
+    def _on_ack(self, peer: str, content: List[bytes], batch: List[ZMQEvent]):
+        if (
+            len(content) != 2
+            or len(content[0]) != ACK_HEADER.size
+            or len(content[1]) % SACK_RANGE.size
+        ):
+            logger.warning(f"dropping malformed ack from {peer}")
+            return
+        header, ranges = content
+        epoch, cum = ACK_HEADER.unpack(header)
+        sacks = [r for r in SACK_RANGE.iter_unpack(ranges)]
+        self._acked(peer, epoch, cum, sacks, batch)
+
+    def _on_message(self, peer: str, content: List[bytes], batch: List[ZMQEvent]):
+        if len(content) != 2 or len(content[0]) != RELIABLE_HEADER.size:
+            logger.warning(f"dropping malformed message from {peer}")
+            return
+        header, data = content
+        epoch, seq, base, ack_epoch, ack_cum = RELIABLE_HEADER.unpack(header)
+        if ack_epoch:
+            self._acked(peer, ack_epoch, ack_cum, (), batch)
+
+        stream = self.incoming.get(peer)
+        if stream is None or stream.epoch != epoch:
+            # first we've heard of this stream of theirs
+            if stream and stream.ack_timer:
+                stream.ack_timer.cancel()
+            stream = self.incoming[peer] = _InStream(epoch=epoch)
+        if base - 1 > stream.cum:
+            # they gave up on resending everything before base
+            stream.cum = base - 1
+            stream.received = {s for s in stream.received if s > stream.cum}
+            stream.advance()
+
+        fresh = seq > stream.cum and seq not in stream.received
+        # seq opened a new hole, rather than just extending one we've told
+        # them about already
+        gap = fresh and seq > stream.cum + 1 and seq - 1 not in stream.received
+        if fresh:
+            stream.received.add(seq)
+            stream.advance()
+            self.manager._decode(peer, data, batch)
+
+        if gap:
+            # say what we have right away, so they can fill the hole in
+            self._send_ack(peer)
+        elif stream.ack_timer is None:
+            stream.ack_timer = asyncio.get_event_loop().call_later(
+                ACK_DELAY, self._send_ack, peer
+            )
+
+    def _send_ack(self, peer: str):
+        stream = self.incoming[peer]
+        if stream.ack_timer:
+            stream.ack_timer.cancel()
+            stream.ack_timer = None
+        channel = self.manager._channel(peer)
+        if channel is None:
+            return
+        ranges = b"".join(SACK_RANGE.pack(*r) for r in stream.sack_ranges())
+        REGISTRY.counter("zmq.reliable.acks", peer=peer).inc()
+        channel.put_nowait([ACK, ACK_HEADER.pack(stream.epoch, stream.cum), ranges])
+
+
+class WarmPool:
+    """Connections to peers that discovery just dropped, kept open for a
+    while in case the peer comes straight back, as it does when wifi roams.
+
+    Entries are keyed by (peer, address), so a peer that comes back
+    somewhere else never gets a connection to where it used to be. They're
+    handed to close() once they've been parked for ttl seconds, or sooner if
+    more than size are parked at once.
+    """
+
+    def __init__(self, ttl: float, size: int, close: Callable[[Any], None]):
+        self.ttl = ttl
+        self.size = size
+        self.close_item = close
+        # (peer, address) -> (connection, when it expires), oldest first
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.reused = REGISTRY.counter("zmq.pool.reused")
+        self.expired = REGISTRY.counter("zmq.pool.expired")
+        REGISTRY.gauge("zmq.pool.size", lambda: len(self.entries))
+
+    def park(self, key: Tuple[str, str], item: Any):
+        if self.size <= 0:
+            self.close_item(item)
+            return
+        old = self.entries.pop(key, None)
+        if old:
+            self.close_item(old[0])
+        self.entries[key] = (item, time.monotonic() + self.ttl)
+        while len(self.entries) > self.size:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.expired.inc()
+            self.close_item(evicted)
+        self._arm()
+
+    def take(self, key: Tuple[str, str]) -> Optional[Any]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.reused.inc()
+        return entry[0]
+
+    def items(self) -> List[Any]:
+        return [item for item, _ in self.entries.values()]
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        for item, _ in self.entries.values():
+            self.close_item(item)
+        self.entries.clear()
+
+    def _arm(self):
+        if self.timer is None and self.entries:
+            _, expires = next(iter(self.entries.values()))
+            self.timer = asyncio.get_event_loop().call_later(
+                max(0.0, expires - time.monotonic()), self._expire
+            )
+
+    def _expire(self):
+        self.timer = None
+        now = time.monotonic()
+        while self.entries:
+            key, (item, expires) = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[key]
+            logger.debug(f"closing idle connection to {key[0]} at {key[1]}")
+            self.expired.inc()
+            self.close_item(item)
+        self._arm()
+
+
+class WakeupEventQueue(EventQueue):
+    """EventQueue that calls wake() whenever an item is put on it."""
+
+    def __init__(self, wake: Callable[[], None], name: str = None):
+        super().__init__(name)
+        self.wake = wake
+
+    def put(self, item):
+        super().put(item)
+        self.wake()
+
+    def put_nonblocking(self, item):
+        success = super().put_nonblocking(item)
+        if success:
+            self.wake()
+        return success
+
+
+class AsyncZMQManager:
+    """ZMQ Socket Manager, on zmq.asyncio. Holds data and callbacks for the
+    sockets we use to communicate with other instances.
+
+    Consumers interact with this class by:
+        1. awaiting send() to publish messages to subscribers, or to send
+           them straight to one peer
+        2. iterating `async for event in events()` for messages from
+           subscriptions, and for peers coming and going
+        3. calling on_discovered() with (name, address, metadata) tuples from
+           discovery, with address None when a peer goes away
+
+    It has to be created, used and closed on the event loop it runs on.
+
+    Every subscriber socket gets a reader task, so adding or dropping a peer
+    is a task being created or cancelled, and nothing ever polls on a timer.
+    A reader drains up to recv_budget messages per wakeup and hands them over
+    as one batch, then yields to the loop so one chatty peer can't starve
+    the rest.
+
+    In TransportMode.MULTIPLEXED, a single MultiplexSubscriber and reader
+    task serve every peer instead of one Subscriber per peer.
+
+    Messages for a single peer skip PUB/SUB, and with it the slow joiner
+    window and HWM drops. They go over a UnicastChannel, created the first time
+    we send to that peer, to the Router it binds on the port after the one
+    it advertises. PUB/SUB carries presence and broadcasts.
+
+    Peers that advertise no "caps" at all predate all of this, and read
+    every frame published on the port they found us on as a whole JSON
+    message. They get chat messages meant for them, and broadcasts, from a
+    LegacyPublisher there, and everything else goes out on a Publisher two
+    ports up that only newer peers connect to. What they publish is taken
+    in from per-peer Subscribers, but the multiplexed one can't tell who it
+    came from, so drops it.
+
+    Outgoing EventMessages are encoded with the given Codec. Incoming ones are
+    decoded with whichever codec the sender used, so peers configured with
+    different codecs still understand each other. Binary frames of at least
+    compression_threshold bytes are zlib compressed for peers that advertise
+    "zlib" in their "caps" discovery metadata. None turns that off.
+
+    Subscriptions that discovery drops are parked in a WarmPool for
+    pool_ttl seconds, up to pool_size of them, and picked back up if the
+    peer reappears at the same address, skipping the reconnect and slow
+    joiner window. A pool_size of 0 closes them straight away.
+
+    With reliable set, direct messages to peers that advertise
+    RELIABLE_CAPABILITY go through ReliableDelivery, which resends anything
+    lost and reports MESSAGE_DELIVERED events as the peer acks them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        port: int,
+        recv_budget: int = 64,
+        mode: TransportMode = TransportMode.PER_PEER,
+        codec: Codec = CODECS["binary"],
+        unicast_queue: int = 1000,
+        compression_threshold: Optional[int] = COMPRESSION_THRESHOLD,
+        reliable: bool = False,
+        pool_ttl: float = 30.0,
+        pool_size: int = 32,
+    ):
+        self.zmq = zmq.asyncio.Context.instance()
+        self.name = self._normalize_name(name)
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+        self.recv_budget = recv_budget
+        # (metric, peer) -> (messages, bytes) counters, so the receive path
+        # doesn't look them up in the registry for every message
+        self._traffic = {}
+        # batches of ZMQEvents, for events() to unpack
+        self._events = asyncio.Queue()
 
         self.subscriptions = {}
-        self.zmq = zmq.Context.instance()
+        # peer name -> the task reading its Subscriber
+        self._readers = {}
+        # peer name -> address, for every peer discovery told us about
+        self.peers = {}
+        # peer name -> the "caps" they advertised, e.g. {"zlib"}
+        self.capabilities: Dict[str, Set[str]] = {}
+        # peers that advertised no "caps" at all, so predate topics. they
+        # only get what goes out on the LegacyPublisher
+        self.legacy: Set[str] = set()
+        # peer name -> UnicastChannel, created on first send
+        self.channels = {}
+        self.unicast_queue = unicast_queue
+        # leading frame of a direct message -> what handles it
+        self._unicast_handlers: Dict[bytes, UnicastHandler] = {
+            UNICAST_MESSAGE: self._on_unicast_message
+        }
+        self.reliable = ReliableDelivery(self) if reliable else None
+        # topics besides ours and BROADCAST_TOPIC -> what handles them
+        self._topic_handlers: Dict[bytes, TopicHandler] = {}
 
-        # for now, bind to 0.0.0.0
-        cxn = f"tcp://0.0.0.0:{port}"
-        self.publisher = Publisher(name=name, cxn=cxn)
-        self.message_poller_thread = threading.Thread(
-            target=self._poll_for_events, daemon=True
-        ).start()
+        # only ask peers for messages addressed to us, or to everyone. senders
+        # address us by our normalized name, so that's what to subscribe to
+        self.topics = (self.name, BROADCAST_TOPIC, LEGACY_TOPIC)
+
+        self.mode = mode
+        self.mux = None
+        self._mux_reader = None
+        if self.mode == TransportMode.MULTIPLEXED:
+            self.mux = MultiplexSubscriber(
+                name=self.name, topics=self.topics, ctx=self.zmq
+            )
+            self._mux_reader = asyncio.ensure_future(
+                self._read(self.mux.sock, self._on_published)
+            )
+        # parked Subscribers, or endpoints of the multiplexed socket
+        self.pool = WarmPool(
+            pool_ttl, pool_size, self.mux.release if self.mux else Subscriber.close
+        )
+
+        cxn = f"tcp://*:{port}"
+        self.legacy_publisher = LegacyPublisher(name=name, cxn=cxn, ctx=self.zmq)
+        cxn = f"tcp://*:{port + PUBLISHER_PORT_OFFSET}"
+        self.publisher = Publisher(name=name, cxn=cxn, ctx=self.zmq)
+        cxn = f"tcp://*:{port + UNICAST_PORT_OFFSET}"
+        self.router = Router(name=name, cxn=cxn, ctx=self.zmq)
+        self._router_reader = asyncio.ensure_future(
+            self._read(self.router.sock, self._on_unicast)
+        )
 
         logger.debug(f"zmq up")
 
     def close(self):
+        if self.reliable:
+            self.reliable.close()
+        for name in list(self.subscriptions):
+            self._close_subscriber(self.subscriptions.pop(name))
+        self.pool.close()
+        if self.mux:
+            self._mux_reader.cancel()
+            self.mux.close()
+        for channel in self.channels.values():
+            channel.close()
+        self.channels.clear()
+        self._router_reader.cancel()
+        self.router.close()
         self.publisher.close()
-        for sub in self.subscriptions.values():
-            sub.close()
+        self.legacy_publisher.close()
         logger.debug("zmq down")
 
-    @staticmethod
-    def _serialize(payload: Any) -> str:
-        if is_dataclass(payload) and not isinstance(payload, type):
-            # make dataclass json serializable
-            payload = dataclasses.asdict(payload)
-        return json.dumps(payload)
+    async def send(self, payload: EventMessage, to: Optional[str] = None) -> bool:
+        """Send payload to peer `to`, or broadcast it if `to` is None.
 
-    def send_message(self, payload: Any) -> bool:
+        Waits for room in the peer's send queue if it's backed up.
+        """
         # i dont like that we're passing in EventMessages
         # but returning ZMQEvents. only one datatype should
         # pass through this layer.
-        self.publisher.send_message(self._serialize(payload))
+        channel = self._channel(to)
+        if channel:
+            await channel.put(self._unicast_frames(payload, to))
+            return True
+        return self._publish(payload, to)
+
+    def send_nowait(self, payload: EventMessage, to: Optional[str] = None) -> bool:
+        """Like send(), but drops the message if the peer's queue is full."""
+        channel = self._channel(to)
+        if channel:
+            return channel.put_nowait(self._unicast_frames(payload, to))
+        return self._publish(payload, to)
+
+    async def send_frames(self, to: str, frames: List[bytes]) -> bool:
+        """Send raw frames straight to peer `to`, for the handler they
+        registered for frames[0] with register_unicast().
+
+        Waits for room in the peer's send queue. Returns False if we don't
+        know where `to` is.
+        """
+        channel = self._channel(to)
+        if channel is None:
+            return False
+        await channel.put(frames)
+        return True
+
+    def register_unicast(self, kind: bytes, handler: UnicastHandler):
+        self._unicast_handlers[kind] = handler
+
+    def unregister_unicast(self, kind: bytes):
+        """Drop direct messages of this kind from now on, e.g. once whatever
+        registered for them is closed."""
+        self._unicast_handlers.pop(kind, None)
+
+    def register_topic(self, topic: str, handler: TopicHandler):
+        """Subscribe to topic on every peer, and hand what's published on it
+        to handler rather than the codec."""
+        self._topic_handlers[topic.encode()] = handler
+        self.topics = (*self.topics, topic)
+        for sub in self.subscriptions.values():
+            subscribe(sub.sock, [topic])
+        if not self.mux:
+            for sub in self.pool.items():
+                subscribe(sub.sock, [topic])
+        else:
+            subscribe(self.mux.sock, [topic])
+
+    def emit(self, event: ZMQEvent):
+        """Hand an event from an extension like FileTransfers to events()."""
+        self._events.put_nowait([event])
+
+    def _publish(self, payload: EventMessage, to: Optional[str]) -> bool:
+        # PUB sockets drop messages past their HWM rather than block, so the
+        # returned future is already done and there's nothing to wait for.
+        # direct messages only end up here for peers we have no address for
+        topic = self._normalize_name(to) if to else BROADCAST_TOPIC
+        self.publisher.send_message(self._encode(payload, to), topic=topic)
+        if self.legacy and (not to or self._normalize_name(to) in self.legacy):
+            # they get everything published, and go by the recipient in the
+            # message itself
+            self.legacy_publisher.send_message(CODECS["json"].encode(payload))
+        return True
+
+    def _unicast_frames(self, payload: EventMessage, to: str) -> List[bytes]:
+        to = self._normalize_name(to)
+        data = self._encode(payload, to)
+        if self.reliable and RELIABLE_CAPABILITY in self.capabilities.get(to, ()):
+            return self.reliable.sequence(to, data, payload)
+        return [UNICAST_MESSAGE, data]
+
+    def _encode(self, payload: EventMessage, to: Optional[str]) -> bytes:
+        data = self.codec.encode(payload)
+        if self.compression_threshold is None:
+            return data
+        # a broadcast reaches everyone on the Publisher, so all of them have
+        # to understand it
+        peers = (
+            [self._normalize_name(to)]
+            if to
+            else [p for p in self.peers if p not in self.legacy]
+        )
+        if peers and all("zlib" in self.capabilities.get(p, ()) for p in peers):
+            return compress(data, self.compression_threshold)
+        return data
 
     @staticmethod
-    def _deserialize(payload: str) -> Any:
-        # gets called in _poll_for_events
-        return json.loads(payload)
+    def _offset_address(address: str, offset: int) -> str:
+        host, _, port = address.rpartition(":")
+        return f"{host}:{int(port) + offset}"
 
-    def get_events(self) -> Any:
+    @classmethod
+    def _unicast_address(cls, address: str) -> str:
+        return cls._offset_address(address, UNICAST_PORT_OFFSET)
+
+    def _channel(self, to: Optional[str]) -> Optional[UnicastChannel]:
+        """The channel to peer `to`, connecting it if this is our first
+        message for them. None for broadcasts, unknown peers and peers that
+        predate direct messages."""
+        if not to:
+            return None
+        to = self._normalize_name(to)
+        if to in self.legacy:
+            return None
+        channel = self.channels.get(to)
+        if channel is None and to in self.peers:
+            cxn = self.fmt_address(self._unicast_address(self.peers[to]))
+            channel = UnicastChannel(
+                self.name, to, cxn, ctx=self.zmq, maxsize=self.unicast_queue
+            )
+            self.channels[to] = channel
+        return channel
+
+    def _close_channel(self, name: str):
+        channel = self.channels.pop(name, None)
+        if channel:
+            channel.close()
+
+    async def batches(self) -> AsyncIterator[List[ZMQEvent]]:
         while True:
-            yield self.subscriber_events.get()
+            yield await self._events.get()
+
+    async def events(self) -> AsyncIterator[ZMQEvent]:
+        async for batch in self.batches():
+            for event in batch:
+                yield event
 
     @staticmethod
     def fmt_address(address):
@@ -145,60 +977,304 @@ class ZMQManager:
     def _normalize_name(name: str):
         return name.split(".")[0]
 
-    def on_add_subscription(self, name: str, address: str):
-        """Instantiate a socket when we get a new address
-        from the events queue.
+    def on_discovered(self, name: str, address: Optional[str], metadata: Dict):
+        if address:
+            peer = self._normalize_name(name)
+            caps = (metadata or {}).get("caps")
+            if caps is None:
+                self.legacy.add(peer)
+            else:
+                self.legacy.discard(peer)
+            self.capabilities[peer] = set(filter(None, (caps or "").split(",")))
+            name = self.on_add_subscription(name, address)
+            if self.peers.get(name) != address:
+                # they moved, so reconnect on the next direct message
+                self._close_channel(name)
+                self.peers[name] = address
+            self._events.put_nowait(
+                [ZMQEvent(ZMQEventType.SOCKET_ADDED, (name, metadata))]
+            )
+        else:
+            self.peers.pop(self._normalize_name(name), None)
+            self.capabilities.pop(self._normalize_name(name), None)
+            self.legacy.discard(self._normalize_name(name))
+            self._close_channel(self._normalize_name(name))
+            if self.reliable:
+                self.reliable.forget(self._normalize_name(name))
+            self._forget_metrics(self._normalize_name(name))
+            name = self.on_drop_subscription(name)
+            if name:
+                self._events.put_nowait([ZMQEvent(ZMQEventType.SOCKET_REMOVED, name)])
+
+    def on_updated(self, name: str, changes: Dict[str, Optional[str]]):
+        name = self._normalize_name(name)
+        if name not in self.peers:
+            return
+        if "caps" in changes:
+            caps = changes["caps"] or ""
+            self.capabilities[name] = set(filter(None, caps.split(",")))
+        self._events.put_nowait([ZMQEvent(ZMQEventType.PEER_UPDATED, (name, changes))])
+
+    def on_add_subscription(self, name: str, address: str) -> str:
+        """Instantiate a socket, or connect the multiplexed one,
+        when we get a new address from discovery.
         """
-        sub = Subscriber(name=self._normalize_name(name), cxn=self.fmt_address(address))
+        name = self._normalize_name(name)
+        if name not in self.legacy:
+            address = self._offset_address(address, PUBLISHER_PORT_OFFSET)
+        cxn = self.fmt_address(address)
+        if self.mux:
+            if self.pool.take((name, cxn)):
+                self.mux.resume(name, cxn)
+                logger.debug(f"Resumed parked ZMQ subscription to {name}.{cxn}")
+            else:
+                self.mux.connect(name, cxn)
+                logger.debug(f"Connected ZMQ subscriber to {name}.{cxn}")
+            return name
+
+        current = self.subscriptions.get(name)
+        if current and current.cxn == cxn:
+            # discovery telling us again about a peer we're connected to
+            return name
+
+        sub = self.pool.take((name, cxn))
+        if sub:
+            logger.debug(f"Reusing parked ZMQ subscriber for {sub}")
+        else:
+            sub = Subscriber(name=name, cxn=cxn, topics=self.topics, ctx=self.zmq)
+        stale = self.subscriptions.pop(sub.name, None)
+        if stale:
+            self._close_subscriber(stale)
         self.subscriptions[sub.name] = sub
+        self._readers[sub.name] = asyncio.ensure_future(
+            self._read(sub.sock, functools.partial(self._on_published, name=sub.name))
+        )
         logger.debug(f"Added ZMQ subscriber for {sub}")
-        return sub
+        return name
 
-    def on_drop_subscription(self, name: str):
-        sub = self.subscriptions.pop(self._normalize_name(name), None)
+    def on_drop_subscription(self, name: str) -> Optional[str]:
+        name = self._normalize_name(name)
+        if self.mux:
+            cxn = self.mux.park(name)
+            if cxn:
+                logger.debug(f"Parked ZMQ subscription to {name}.{cxn}")
+                self.pool.park((name, cxn), cxn)
+                return name
+            return None
+
+        sub = self.subscriptions.pop(name, None)
         if sub:
-            logger.debug(f"Removing ZMQ subscriber for {sub}")
-            return sub
+            logger.debug(f"Parking ZMQ subscriber for {sub}")
+            # stop reading, so whatever they send while parked waits in the
+            # socket for whoever picks it back up
+            reader = self._readers.pop(sub.name, None)
+            if reader:
+                reader.cancel()
+            self.pool.park((name, sub.cxn), sub)
+            return name
+
+    def _close_subscriber(self, sub: Subscriber):
+        reader = self._readers.pop(sub.name, None)
+        if reader:
+            reader.cancel()
+        sub.close()
+
+    def _decode(self, peer: str, content: bytes, batch: List[ZMQEvent]):
+        # deserialize the content here
+        try:
+            message = decode_any(content)
+        except CodecError as e:
+            logger.error(f"dropping undecodable message from {peer}: {e}")
+            return
+        batch.append(
+            # message here is an EventMessage, assuming the only thing
+            # coming across the wire from subscribers are EventMessages
+            ZMQEvent(ZMQEventType.MESSAGE_RECEIVED, (peer, message))
+        )
+        logger.debug(f"Received message from {peer}: {message}")
 
-    def _poll_for_events(self):
-        def _sub_from_fd(fd) -> str:
-            for sub in self.subscriptions.values():
-                if fd == sub.sock.fileno():
-                    return sub
+    def _on_published(
+        self, frames: List[bytes], batch: List[ZMQEvent], name: str = None
+    ):
+        """Handle [topic, sender, content] off of a SUB socket, or [content]
+        from a client that predates topics.
+
+        name is the peer on the other end of a per-peer Subscriber. Messages
+        read off the multiplexed socket are attributed by their sender frame.
+        """
+        if len(frames) == 1 and name:
+            # an old client. it sends everything to everyone, so the
+            # recipient in the message itself is all that tells them apart
+            self._count("zmq.subscribed", name, len(frames[0]))
+            self._decode(name, frames[0], batch)
+            return
+        if len(frames) != 3:
+            logger.warning(f"dropping malformed message with {len(frames)} frames")
+            return
+        topic, sender, content = frames
+        try:
+            peer = name or self._normalize_name(sender.decode())
+        except UnicodeDecodeError:
+            logger.warning(f"dropping message with undecodable sender {sender!r}")
+            return
+        if self.mux and peer not in self.mux.endpoints:
+            # straggler from a peer we've since disconnected from
+            return
+        self._count("zmq.subscribed", peer, len(content))
+        handler = self._topic_handlers.get(topic)
+        if handler:
+            handler(peer, content, batch)
+        else:
+            self._decode(peer, content, batch)
 
-        def available_messages(sockets: List["Subscriber"]) -> Tuple[str, str]:
+    def _on_unicast(self, frames: List[bytes], batch: List[ZMQEvent]):
+        """Handle [identity, kind, ...] off of the Router."""
+        if len(frames) < 2:
+            logger.warning(f"dropping malformed message with {len(frames)} frames")
+            return
+        identity, kind, *content = frames
+        handler = self._unicast_handlers.get(kind)
+        if handler is None:
+            logger.warning(f"dropping direct message of unknown kind {kind}")
+            return
+        try:
+            peer = identity.decode()
+        except UnicodeDecodeError:
+            logger.warning(f"dropping message with undecodable identity {identity!r}")
+            return
+        self._count(
+            "zmq.unicast_received", peer, sum(len(frame) for frame in frames[1:])
+        )
+        handler(peer, content, batch)
+
+    def _forget_metrics(self, peer: str):
+        for key in [key for key in self._traffic if key[1] == peer]:
+            del self._traffic[key]
+        REGISTRY.remove(peer=peer)
+
+    def _count(self, metric: str, peer: str, size: int):
+        counters = self._traffic.get((metric, peer))
+        if counters is None:
+            counters = self._traffic[(metric, peer)] = (
+                REGISTRY.counter(f"{metric}.messages", peer=peer),
+                REGISTRY.counter(f"{metric}.bytes", peer=peer),
+            )
+        counters[0].inc()
+        counters[1].inc(size)
+
+    def _on_unicast_message(
+        self, peer: str, content: List[bytes], batch: List[ZMQEvent]
+    ):
+        if len(content) != 1:
+            logger.warning(f"dropping malformed message from {peer}")
+            return
+        self._decode(peer, content[0], batch)
+
+    @staticmethod
+    def _handle(on_frames, frames: List[bytes], batch: List[ZMQEvent]):
+        # one bad message mustn't end the reader, and with it the socket
+        try:
+            on_frames(frames, batch)
+        except Exception:
+            logger.exception("dropping message that failed to handle")
+
+    async def _read(
+        self,
+        sock: zmq.asyncio.Socket,
+        on_frames: Callable[[List[bytes], List[ZMQEvent]], None],
+    ):
+        """Read messages off of sock until our task gets cancelled, handing
+        each one to on_frames along with the batch it should add events to.
+        """
+        shadow = zmq.Socket.shadow(sock.underlying)
+        while True:
             try:
-                r, _, _ = zmq.select(sockets, [], [], timeout=0.1)
-                for sock in r:
-                    if sock:
-                        # deserialize the content here
-                        yield (sock.fileno(), self._deserialize(sock.recv_string()))
+                frames = await sock.recv_multipart()
             except zmq.error.ZMQError as e:
+                if sock.closed:
+                    return
                 logger.error(f"error while reading from zmq socket: {e}")
-                return []
+                continue
+
+            batch = []
+            self._handle(on_frames, frames, batch)
+            for _ in range(self.recv_budget - 1):
+                # whatever is already queued gets read through the plain
+                # socket underneath, skipping a future per message
+                try:
+                    frames = shadow.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self._handle(on_frames, frames, batch)
+            else:
+                # out of budget, give everyone else a turn
+                await asyncio.sleep(0)
+
+            if batch:
+                self._events.put_nowait(batch)
+
+
+class ZMQManager:
+    """Threaded shim around AsyncZMQManager, for callers without an event loop.
+
+    Consumers interact with this class by:
+        1. calling send_message() to publish messages to subscribers
+        2. polling subscriber_events() for messages from subscriptions
+
+    discover_events gets populated externally, with the same tuples
+    AsyncZMQManager.on_discovered() and on_updated() take. The manager itself runs on loop,
+    which is started for us if we aren't handed one to share.
+    """
+
+    def __init__(self, name: str, port: int, loop: LoopThread = None, **kwargs):
+        # we populate this for external use
+        self.subscriber_events = EventQueue("zmq.events")
+
+        self.owns_loop = loop is None
+        self.loop = loop or LoopThread(name="zmq")
+
+        # this gets populated externally
+        self.discover_events = WakeupEventQueue(
+            lambda: self.loop.call_soon(self._process_discover_events),
+            name="zmq.discover",
+        )
+
+        self.manager: AsyncZMQManager = self.loop.submit(
+            self._start(name, port, **kwargs)
+        ).result()
+        self.publisher = self.manager.publisher
+
+    async def _start(self, name: str, port: int, **kwargs) -> AsyncZMQManager:
+        manager = AsyncZMQManager(name, port, **kwargs)
+        self._forwarder = asyncio.ensure_future(self._forward(manager))
+        return manager
+
+    async def _forward(self, manager: AsyncZMQManager):
+        async for batch in manager.batches():
+            self.subscriber_events.put_many(batch)
+
+    async def _stop(self):
+        self._forwarder.cancel()
+        self.manager.close()
+
+    def close(self):
+        self.loop.submit(self._stop()).result()
+        if self.owns_loop:
+            self.loop.stop()
+
+    def send_message(self, payload: EventMessage, to: Optional[str] = None):
+        self.loop.call_soon(self.manager.send_nowait, payload, to)
+
+    def get_events(self) -> Any:
+        while True:
+            yield self.subscriber_events.get()
 
+    def _process_discover_events(self):
         while True:
-            # first process any new sockets we need to create
-            # or remove, so we avoid thread safety issues in select
-            while self.discover_events.size() > 0:
-                name, address, metadata = self.discover_events.get()
-                if address:
-                    sub = self.on_add_subscription(name, address)
-                    self.subscriber_events.put(
-                        ZMQEvent(ZMQEventType.SOCKET_ADDED, (sub.name, metadata))
-                    )
-                else:
-                    sub = self.on_drop_subscription(name)
-                    self.subscriber_events.put(
-                        ZMQEvent(ZMQEventType.SOCKET_REMOVED, sub.name)
-                    )
-
-            socks = [s.sock for s in self.subscriptions.values()]
-            for fd, message in available_messages(socks):
-                name = _sub_from_fd(fd).name
-                self.subscriber_events.put(
-                    # message here will be a dict, assuming the only thing
-                    # coming across the wire from subscribers are EventMessages
-                    ZMQEvent(ZMQEventType.MESSAGE_RECEIVED, (name, message))
-                )
-                logger.debug(f"Received message from {name}: {message}")
+            discovered = self.discover_events.get_nonblocking()
+            if discovered is None:
+                break
+            if len(discovered) == 2:
+                self.manager.on_updated(*discovered)
+            else:
+                self.manager.on_discovered(*discovered)
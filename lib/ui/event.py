@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import IntEnum
 from typing import Union
 
@@ -17,16 +17,32 @@ class EventType(IntEnum):
     # Username changed
     USERNAME_CHANGED = 4
 
+    ###########################################
+    # User picked a file to send to a friend
+    FILE_SENT = 5
+    # A file transfer in either direction made progress
+    FILE_PROGRESS = 6
+    # A friend finished sending us a file
+    FILE_RECEIVED = 7
+    # A friend acknowledged one of our messages
+    MESSAGE_DELIVERED = 8
+
 
 FriendIdentifier = str
 LOOPBACK_IDENTIFIER: FriendIdentifier = "You"
 
+# field metadata for things that only mean something inside this process,
+# which the codecs leave off the wire
+LOCAL_ONLY = {"wire": False}
+
 
 @dataclass
 class ChatMessagePayload:
     content: str
     author: FriendIdentifier
     to: FriendIdentifier
+    # the UI's handle on a message we sent, for MESSAGE_DELIVERED
+    id: int = field(default=0, metadata=LOCAL_ONLY)
 
     def is_loopback(self):
         return self.author == self.to
@@ -53,7 +69,56 @@ class UsernameChangedPayload:
     username: str
 
 
-UiEventPayload = Union[ChatMessagePayload, StatusChangedPayload, UsernameChangedPayload]
+@dataclass
+class MessageDeliveredPayload:
+    id: int
+    to: FriendIdentifier
+
+
+@dataclass
+class FileSentPayload:
+    path: str
+    to: FriendIdentifier
+
+
+@dataclass
+class FileProgressPayload:
+    id: str
+    peer: FriendIdentifier
+    filename: str
+    transferred: int
+    size: int
+    incoming: bool
+
+
+@dataclass
+class FileReceivedPayload:
+    author: FriendIdentifier
+    filename: str
+    path: str
+
+
+UiEventPayload = Union[
+    ChatMessagePayload,
+    StatusChangedPayload,
+    UsernameChangedPayload,
+    MessageDeliveredPayload,
+    FileSentPayload,
+    FileProgressPayload,
+    FileReceivedPayload,
+]
+
+# which payload dataclass goes with each event type
+PAYLOAD_TYPES = {
+    EventType.FRIEND_STATUS_CHANGED: StatusChangedPayload,
+    EventType.MESSAGE_RECEIVED: ChatMessagePayload,
+    EventType.MESSAGE_SENT: ChatMessagePayload,
+    EventType.USERNAME_CHANGED: UsernameChangedPayload,
+    EventType.FILE_SENT: FileSentPayload,
+    EventType.FILE_PROGRESS: FileProgressPayload,
+    EventType.FILE_RECEIVED: FileReceivedPayload,
+    EventType.MESSAGE_DELIVERED: MessageDeliveredPayload,
+}
 
 
 @dataclass
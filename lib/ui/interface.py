@@ -1,3 +1,4 @@
+from lib.metrics import REGISTRY, format_snapshot, rates
 from lib.util import EventQueue
 from lib.ui.event import (
     EventMessage,
@@ -15,6 +16,7 @@ from lib.ui.util import clamp
 
 from collections import deque, OrderedDict, namedtuple
 from copy import deepcopy
+import itertools
 from typing import Optional
 
 
@@ -22,6 +24,7 @@ import dearpygui.dearpygui as dpg
 from enum import Enum
 import logging
 import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -31,9 +34,16 @@ CircleColor = namedtuple("CircleColor", "outline fill")
 
 class Friend:
     class _Message:
+        _ids = itertools.count(1)
+
         def __init__(self, content: str, outgoing: bool):
             self.content = content
             self.outgoing = outgoing
+            self.id = next(Friend._Message._ids)
+            # set once the friend acks it, see EventType.MESSAGE_DELIVERED
+            self.delivered = False
+            # the text item showing that, while the message is on screen
+            self.status_item = None
 
     def append_message(self, content: str, outgoing: bool) -> _Message:
         self.messages.append(Friend._Message(content=content, outgoing=outgoing))
@@ -131,14 +141,35 @@ class UI:
         )
         self.active_friend: Optional[Friend] = None
 
-        self.rx_queue = EventQueue()
-        self.tx_queue = EventQueue()
+        # monotonic time of the last key press or mouse movement, which
+        # decides whether we tell friends we're AWAY
+        self.last_activity = time.monotonic()
+
+        self.rx_queue = EventQueue("ui.rx")
+        self.tx_queue = EventQueue("ui.tx")
         self.local_tx_queue = deque()
+        REGISTRY.gauge(
+            "queue.depth", lambda: len(self.local_tx_queue), queue="ui.local_tx"
+        )
+
+        self.frame_time = REGISTRY.histogram("ui.frame_time")
+        # the last snapshot the Stats window showed, and when it was taken
+        self.stats = ({}, time.monotonic())
 
     @property
     def friend_us(self):
         return self.friends[self.settings.uuid]
 
+    def friend(self, id: str) -> Friend:
+        """The friend with this id, added to the list if we haven't heard of
+        them yet, e.g. because their message beat their discovery here."""
+        friend = self.friends.get(id)
+        if friend is None:
+            logger.debug(f"event from unknown friend {id}")
+            friend = self.friends[id] = Friend(identifier=id, username=id)
+            self.on_friends_list_changed()
+        return friend
+
     def register_fonts(self):
         font_file_ttf = load_font()
         self.fonts = {}
@@ -157,7 +188,7 @@ class UI:
         dpg.focus_item(self.input_box)
 
     def disable_input_if_offline(self):
-        if self.active_friend.status == event.Status.ONLINE:
+        if self.active_friend.status != event.Status.OFFLINE:
             dpg.configure_item(self.input_box, readonly=False, hint="")
         else:
             dpg.configure_item(self.input_box, readonly=True, hint="OFFLINE")
@@ -198,6 +229,14 @@ class UI:
             else:
                 dpg.add_text(default_value=author_them, color=(227, 79, 68))
             dpg.add_text(default_value=message.content)
+            if message.outgoing:
+                message.status_item = dpg.add_text(
+                    default_value=self.delivery_status(message), color=(128, 128, 128)
+                )
+
+    @staticmethod
+    def delivery_status(message: Friend._Message) -> str:
+        return "(delivered)" if message.delivered else ""
 
     # New friend detected in the LAN, existing friend's online status changed
     def on_friends_list_changed(self):
@@ -313,6 +352,27 @@ class UI:
                 callback=_on_bring_to_front_checkbox_clicked,
             )
 
+            dpg.add_menu_item(
+                label="Stats", callback=lambda: dpg.show_item(self.stats_window)
+            )
+
+    # Live lib.metrics readout, opened from the settings menu
+    def add_stats_window(self):
+        with dpg.window(label="Stats", show=False, width=600, height=400) as window:
+            self.stats_text = dpg.add_text(default_value="")
+        self.stats_window = window
+
+    def refresh_stats(self):
+        before, then = self.stats
+        now = time.monotonic()
+        if not dpg.is_item_shown(self.stats_window) or now - then < 0.5:
+            return
+        after = REGISTRY.snapshot()
+        dpg.set_value(
+            self.stats_text, format_snapshot(after, rates(before, after, now - then))
+        )
+        self.stats = (after, now)
+
     # Main app content
     def content_area(self):
         self.content_area = dpg.add_group(parent=self.main_window, horizontal=True)
@@ -343,11 +403,37 @@ class UI:
                                 content=msg.content,
                                 author=self.friend_us.identifier,
                                 to=self.active_friend.identifier,
+                                id=msg.id,
                             ),
                         )
 
             dpg.configure_item(self.input_box, callback=_on_message_submit)
-            dpg.add_button(label="Submit", callback=_on_message_submit)
+
+            def _on_file_selected(sender, app_data):
+                friend = self.active_friend
+                if friend is None or friend == self.friend_us:
+                    return
+                path = app_data["file_path_name"]
+                msg = friend.append_message(f"[sending file] {path}", True)
+                self.render_message(friend, msg)
+                self.goto_most_recent_message()
+                self.enqueue_event(
+                    EventType.FILE_SENT,
+                    event.FileSentPayload(path=path, to=friend.identifier),
+                )
+
+            with dpg.file_dialog(
+                show=False, callback=_on_file_selected, width=600, height=400
+            ) as self.file_dialog:
+                dpg.add_file_extension(".*")
+
+            with dpg.group(horizontal=True):
+                dpg.add_button(label="Submit", callback=_on_message_submit)
+                dpg.add_button(
+                    label="Send File",
+                    callback=lambda: dpg.show_item(self.file_dialog),
+                )
+                self.transfer_status = dpg.add_text(default_value="")
         self.goto_most_recent_message()
 
         # Friends list
@@ -371,6 +457,7 @@ class UI:
         )
         self.menu_bar()
         self.content_area()
+        self.add_stats_window()
 
     def reflow_layout(self):
         dpg.configure_item(
@@ -382,6 +469,9 @@ class UI:
         if self.active_friend is not None:
             self.on_selected_friend_changed(self.active_friend, force=True)
 
+    def activity_callback(self, sender, data):
+        self.last_activity = time.monotonic()
+
     def tab_pressed_callback(self, sender, data):
         dpg.focus_item(self.input_box)
 
@@ -418,10 +508,8 @@ class UI:
                         self.disable_input_if_offline()
                 self.on_friends_list_changed()
             elif msg.type == EventType.MESSAGE_RECEIVED:
-                m = self.friends[msg.payload.author].append_message(
-                    content=msg.payload.content, outgoing=False
-                )
-                author = self.friends[msg.payload.author]
+                author = self.friend(msg.payload.author)
+                m = author.append_message(content=msg.payload.content, outgoing=False)
                 if author == self.active_friend:
                     self.render_message(author, m)
                     self.goto_most_recent_message()
@@ -431,8 +519,38 @@ class UI:
                 if self.settings.bring_to_front_on_new_message:
                     popup.bring_to_front()
             elif msg.type == EventType.USERNAME_CHANGED:
-                self.friends[msg.payload.id].username = msg.payload.username
+                self.friend(msg.payload.id).username = msg.payload.username
                 self.on_friends_list_changed()
+            elif msg.type == EventType.MESSAGE_DELIVERED:
+                p: event.MessageDeliveredPayload = msg.payload
+                friend = self.friends.get(p.to)
+                # almost always one of the last few
+                for m in reversed(friend.messages if friend else []):
+                    if m.id == p.id:
+                        m.delivered = True
+                        if friend == self.active_friend and m.status_item:
+                            dpg.set_value(m.status_item, self.delivery_status(m))
+                        break
+            elif msg.type == EventType.FILE_PROGRESS:
+                p: event.FileProgressPayload = msg.payload
+                percent = 100 * p.transferred // p.size if p.size else 100
+                direction = "from" if p.incoming else "to"
+                dpg.configure_item(
+                    self.transfer_status,
+                    default_value=f"{p.filename} {direction} {p.peer}: {percent}%",
+                )
+            elif msg.type == EventType.FILE_RECEIVED:
+                p: event.FileReceivedPayload = msg.payload
+                author = self.friend(p.author)
+                m = author.append_message(
+                    content=f"[received file] {p.filename} -> {p.path}", outgoing=False
+                )
+                if author == self.active_friend:
+                    self.render_message(author, m)
+                    self.goto_most_recent_message()
+                else:
+                    author.has_unread = True
+                    self.on_friends_list_changed()
 
     def process_tx_queue(self):
         def _peekleft():
@@ -451,6 +569,9 @@ class UI:
             dpg.add_key_press_handler(
                 key=dpg.mvKey_Tab, callback=self.tab_pressed_callback
             )
+            dpg.add_key_press_handler(callback=self.activity_callback)
+            dpg.add_mouse_move_handler(callback=self.activity_callback)
+            dpg.add_mouse_click_handler(callback=self.activity_callback)
         self.register_fonts()
         self.create_layout()
         dpg.create_viewport(
@@ -471,8 +592,11 @@ class UI:
                 daemon=True,
             ).start()
         while dpg.is_dearpygui_running():
+            start = time.perf_counter()
             self.process_rx_queue()
             self.process_tx_queue()
+            self.refresh_stats()
             dpg.render_dearpygui_frame()
+            self.frame_time.observe(time.perf_counter() - start)
         dpg.destroy_context()
         self.settings.serialize()
@@ -1,34 +1,122 @@
-import queue
+import asyncio
+import collections
+import concurrent.futures
 from enum import Enum
 import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from lib.metrics import REGISTRY
 
 
 class EventQueue:
-    def __init__(self):
-        self.fifo = queue.Queue()
+    """Unbounded thread-safe FIFO with non-blocking helpers and metrics.
+
+    A deque guarded by a Condition, rather than a queue.Queue, so put_many()
+    can add a whole batch under one lock acquisition. Items are stored
+    alongside the time they were put, so every get() can record how long its
+    item sat in the queue. A named queue reports its depth, puts, gets and
+    wait time to lib.metrics as queue.*{queue=name}.
+    """
+
+    def __init__(self, name: str = None):
+        self.fifo = collections.deque()
+        self.ready = threading.Condition()
+        self.metrics = name is not None
+        if self.metrics:
+            self.puts = REGISTRY.counter("queue.puts", queue=name)
+            self.gets = REGISTRY.counter("queue.gets", queue=name)
+            self.wait = REGISTRY.histogram("queue.wait", queue=name)
+            REGISTRY.gauge("queue.depth", self.size, queue=name)
+
+    def _got(self, entry):
+        put_at, item = entry
+        if self.metrics:
+            self.gets.inc()
+            self.wait.observe(time.monotonic() - put_at)
+        return item
 
     def get(self):
-        return self.fifo.get()
+        with self.ready:
+            while not self.fifo:
+                self.ready.wait()
+            entry = self.fifo.popleft()
+        return self._got(entry)
 
     def get_nonblocking(self):
-        try:
-            return self.fifo.get_nowait()
-        except queue.Empty:
-            return None
+        with self.ready:
+            if not self.fifo:
+                return None
+            entry = self.fifo.popleft()
+        return self._got(entry)
 
     def put(self, item):
-        return self.fifo.put(item)
+        self.put_many((item,))
 
     def put_nonblocking(self, item):
-        success = True
-        try:
-            self.fifo.put_nowait(item)
-        except queue.Full:
-            success = False
-        return success
+        # there's no bound to hit, so this can't fail
+        self.put(item)
+        return True
+
+    def put_many(self, items):
+        # one lock acquisition and one round of wakeups for the whole batch,
+        # instead of paying for both on every put()
+        if not items:
+            return
+        if self.metrics:
+            self.puts.inc(len(items))
+        now = time.monotonic()
+        with self.ready:
+            self.fifo.extend((now, item) for item in items)
+            self.ready.notify(len(items))
 
     def size(self):
-        return self.fifo.qsize()
+        return len(self.fifo)
+
+
+class LoopThread:
+    """An asyncio event loop running forever on a daemon thread, for the
+    threaded shims around the asyncio networking code."""
+
+    def __init__(self, name: str = None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name=name, daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, coro: Awaitable) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback: Callable, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run(self, callback: Callable, *args) -> Any:
+        """Call callback on the loop, and wait for what it returns."""
+
+        async def call():
+            return callback(*args)
+
+        return self.submit(call()).result()
+
+    @staticmethod
+    async def _cancel_tasks():
+        # whatever is still in flight, e.g. zeroconf's announcements
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        try:
+            self.submit(self._cancel_tasks()).result(timeout=1)
+        except concurrent.futures.TimeoutError:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+        if not self.thread.is_alive():
+            self.loop.close()
 
 
 class OperatingSystem(Enum):
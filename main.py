@@ -6,12 +6,20 @@ import time
 import json
 import lib.ui.interface as ui
 import logging
-from contextlib import closing
+from contextlib import closing, ExitStack
 
-from lib.ui.settings import DevSettings, Settings
+from lib.metrics import MetricsDumper
+from lib.ui.settings import APP_DIR, DevSettings, Settings
+from lib.net.codec import CAPABILITIES, CODECS
 from lib.net.util import get_lan_ips
+from lib.net.gossip import GOSSIP_CAPABILITY, Gossip
+from lib.net.heartbeat import Heartbeat
+from lib.net.netwatch import InterfaceWatcher
+from lib.net.peers import PeerCache
+from lib.net.transfer import MAX_FILE_SIZE, FileTransfers
 from lib.net.zeroconf import ZeroconfManager
 from lib.net.zmq import (
+    RELIABLE_CAPABILITY,
     ZMQEvent,
     ZMQEventType,
     ZMQManager,
@@ -22,17 +30,40 @@ from lib.ui.event import (
     EventMessage,
     EventType,
     LOOPBACK_IDENTIFIER,
+    MessageDeliveredPayload,
     Status,
+    StatusChangedPayload,
     FriendIdentifier,
 )
 import lib.ui.event as event
-from lib.util import EventQueue
+from lib.util import EventQueue, LoopThread
 
 logger = logging.getLogger(__name__)
 
 
+class LoopService:
+    """Starts service on loop and closes it there too, since asyncio wants
+    both done from the loop's own thread, so it can go in a closing()."""
+
+    def __init__(self, loop: LoopThread, service):
+        self.loop = loop
+        self.service = service
+        loop.run(service.start)
+
+    def close(self):
+        self.loop.run(self.service.close)
+
+
 class UIMiddleware:
-    def __init__(self, zmq: ZMQManager, settings: Settings):
+    def __init__(
+        self,
+        zmq: ZMQManager,
+        zeroconf: ZeroconfManager,
+        gossip: Gossip,
+        heartbeat: Heartbeat,
+        transfers: FileTransfers,
+        settings: Settings,
+    ):
         # Ownership of settings is now transferred to the UI. Necessarily, all settings
         # related changes are user driven.
         self.ui = ui.UI(settings=settings)
@@ -41,8 +72,13 @@ class UIMiddleware:
         self.rx_queue = self.ui.tx_queue
 
         self.zmq = zmq
+        self.zeroconf = zeroconf
+        self.gossip = gossip
         self.publisher = zmq.publisher
         self.network_events = zmq.subscriber_events
+        self.transfers = transfers
+        self.heartbeat = heartbeat
+        heartbeat.last_activity = lambda: self.ui.last_activity
 
         self._ui_rx_queue_processor = threading.Thread(
             target=self._process_ui_rx_queue, daemon=True
@@ -60,20 +96,36 @@ class UIMiddleware:
             if msg.type == EventType.MESSAGE_SENT:
                 m: event.ChatMessagePayload = msg.payload
                 if not m.is_loopback():
-                    self.zmq.send_message(msg)
+                    self.zmq.send_message(msg, to=m.to)
             elif msg.type == EventType.USERNAME_CHANGED:
                 self.username = msg.payload.username
-                self.zmq.send_message(msg)
-
-    def _process_ui_event(self, name, type, payload):
-        print(type == EventType.USERNAME_CHANGED)
-        if type == EventType.MESSAGE_SENT:
-            if payload["to"] == self.publisher.normalized_name:
-                self.on_new_message(name, payload["content"])
-        elif type == EventType.USERNAME_CHANGED:
-            self.on_friend_username_changed(id=name, new_username=payload["username"])
+                # goes out in our TXT record, so peers that find us later
+                # get it too
+                self.zeroconf.update_metadata({"username": self.username})
+                self.zmq.loop.call_soon(
+                    self.gossip.update_metadata, {"username": self.username}
+                )
+            elif msg.type == EventType.FILE_SENT:
+                f: event.FileSentPayload = msg.payload
+                self.zmq.loop.submit(
+                    self.transfers.send_file(f.to, f.path)
+                ).add_done_callback(self._on_file_sent)
+
+    def _on_file_sent(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"file transfer failed: {future.exception()}")
+
+    def _process_ui_event(self, name, msg: EventMessage):
+        if msg.type == EventType.MESSAGE_SENT:
+            m: event.ChatMessagePayload = msg.payload
+            # subscribers only ask for messages addressed to us or broadcast,
+            # so this should always match. keep it as a cheap sanity check
+            if m.to == self.publisher.normalized_name:
+                self.on_new_message(name, m.content)
+        elif msg.type == EventType.USERNAME_CHANGED:
+            self.on_friend_username_changed(id=name, new_username=msg.payload.username)
         else:
-            print(f"Unknown message typeeee {type}")
+            logger.warning(f"Unknown message type {msg.type}")
 
     def _process_zmq_event_queue(self):
         for event in self.zmq.get_events():
@@ -83,12 +135,44 @@ class UIMiddleware:
             elif event.type == ZMQEventType.SOCKET_REMOVED:
                 name = event.payload
                 self.on_friend_lost(name)
+            elif event.type == ZMQEventType.PEER_UPDATED:
+                name, changes = event.payload
+                if changes.get("username"):
+                    self.on_friend_username_changed(
+                        id=name, new_username=changes["username"]
+                    )
             elif event.type == ZMQEventType.MESSAGE_RECEIVED:
-                # message is a json dict, from when we serialized
-                # the ChatEventMessage we passed in _process_ui_rx_queue
-                name, payload = event.payload
-                self._process_ui_event(
-                    name=name, type=payload["type"], payload=payload["payload"]
+                # message is the EventMessage we sent in _process_ui_rx_queue,
+                # decoded back into its dataclasses by the codec
+                name, msg = event.payload
+                self._process_ui_event(name=name, msg=msg)
+            elif event.type == ZMQEventType.PEER_STATUS:
+                name, status = event.payload
+                logger.info(f"heartbeat: {name} is {status.name}")
+                if status == Status.OFFLINE:
+                    # maybe it's just the address we're using that went away
+                    self.zeroconf.failover(name)
+                self.tx_queue.put(
+                    EventMessage(
+                        type=EventType.FRIEND_STATUS_CHANGED,
+                        payload=StatusChangedPayload(id=name, status=status),
+                    )
+                )
+            elif event.type == ZMQEventType.MESSAGE_DELIVERED:
+                name, msg = event.payload
+                self.tx_queue.put(
+                    EventMessage(
+                        type=EventType.MESSAGE_DELIVERED,
+                        payload=MessageDeliveredPayload(id=msg.payload.id, to=name),
+                    )
+                )
+            elif event.type == ZMQEventType.TRANSFER_PROGRESS:
+                self.tx_queue.put(
+                    EventMessage(type=EventType.FILE_PROGRESS, payload=event.payload)
+                )
+            elif event.type == ZMQEventType.FILE_RECEIVED:
+                self.tx_queue.put(
+                    EventMessage(type=EventType.FILE_RECEIVED, payload=event.payload)
                 )
 
     def on_friend_discovered(self, id: FriendIdentifier, username: str):
@@ -135,7 +219,18 @@ class UIMiddleware:
         )
 
 
-def main(dev_name: str, port: int, mock: bool):
+def main(
+    dev_name: str,
+    port: int,
+    mock: bool,
+    codec: str,
+    metrics: str,
+    seeds: list,
+    max_file_size: int,
+):
+    if metrics:
+        MetricsDumper(metrics)
+
     settings = None
     if len(dev_name) > 0:
         settings = DevSettings(username=dev_name)
@@ -148,19 +243,49 @@ def main(dev_name: str, port: int, mock: bool):
     else:
         addresses = get_lan_ips() | get_lan_ips(v6=True)
 
-        username = settings.username
-        with closing(ZMQManager(settings.uuid, port)) as zmq:
+        metadata = {
+            "username": settings.username,
+            "caps": ",".join(CAPABILITIES + (RELIABLE_CAPABILITY, GOSSIP_CAPABILITY)),
+        }
+        with closing(
+            ZMQManager(settings.uuid, port, codec=CODECS[codec], reliable=True)
+        ) as zmq:
             with closing(
                 ZeroconfManager(
                     settings.uuid,
-                    {"username": username},
+                    metadata,
                     addresses,
                     port,
                     zmq.discover_events,
+                    # share zmq's event loop rather than start another
+                    loop=zmq.loop,
+                    peer_cache=PeerCache(APP_DIR / f"{settings.uuid}.peers.json"),
+                )
+            ) as zeroconf:
+                gossip = Gossip(
+                    zmq.manager,
+                    list(addresses),
+                    port,
+                    metadata,
+                    # gossip finds peers the same way zeroconf does
+                    on_discovered=lambda *peer: zmq.discover_events.put(peer),
+                    seeds=seeds,
                 )
-            ):
-                ui = UIMiddleware(zmq, settings)
-                ui.run()
+
+                def on_addresses_changed(addresses):
+                    # the sockets are bound to *, so there's nothing to
+                    # rebind. just tell everyone where we are now
+                    zeroconf.update_addresses(list(addresses))
+                    gossip.update_addresses(list(addresses))
+
+                watcher = InterfaceWatcher(on_addresses_changed, addresses)
+                heartbeat = Heartbeat(zmq.manager)
+                transfers = FileTransfers(zmq.manager, max_size=max_file_size)
+                ui = UIMiddleware(zmq, zeroconf, gossip, heartbeat, transfers, settings)
+                with ExitStack() as stack:
+                    for service in (gossip, heartbeat, transfers, watcher):
+                        stack.enter_context(closing(LoopService(zmq.loop, service)))
+                    ui.run()
 
 
 def parse_args():
@@ -170,10 +295,44 @@ def parse_args():
     parser.add_argument(
         "--mock", action="store_true", default=False, help="Run the mock UI"
     )
+    parser.add_argument(
+        "--codec",
+        choices=CODECS.keys(),
+        default="binary",
+        help="Wire encoding for outgoing messages",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default="",
+        help="Dump queue, traffic and UI metrics as JSON to this file every second",
+    )
+    parser.add_argument(
+        "--seed",
+        action="append",
+        default=[],
+        metavar="HOST:PORT",
+        help="Peer to exchange peers with even if mDNS can't see it. Repeatable",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=MAX_FILE_SIZE >> 20,
+        metavar="MIB",
+        help="Refuse files bigger than this",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     args = parse_args()
-    main(dev_name=args.dev_name, port=args.port, mock=args.mock)
+    main(
+        dev_name=args.dev_name,
+        port=args.port,
+        mock=args.mock,
+        codec=args.codec,
+        metrics=args.metrics,
+        seeds=args.seed,
+        max_file_size=args.max_file_size << 20,
+    )
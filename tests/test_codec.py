@@ -0,0 +1,39 @@
+"""JsonCodec and BinaryCodec on good and bad input.
+
+    $ python -m pytest tests
+"""
+import json
+import unittest
+
+from lib.net.codec import CODECS, CodecError
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+CHAT = EventMessage(
+    EventType.MESSAGE_SENT, ChatMessagePayload(content="hi", author="a", to="b")
+)
+
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name, codec in CODECS.items():
+            with self.subTest(name):
+                self.assertEqual(codec.decode(codec.encode(CHAT)), CHAT)
+
+    def test_json_checks_types(self):
+        chat = {"content": "hi", "author": "a", "to": "b"}
+        for message in (
+            {"type": 3, "payload": {**chat, "content": 1}},
+            {"type": 3, "payload": {**chat, "to": None}},
+            {"type": True, "payload": chat},
+            {"type": 1, "payload": {"id": "a", "status": "1"}},
+            {"type": 7, "payload": {"author": "a", "filename": "f", "path": "/"}},
+            {"type": 3, "payload": [chat]},
+            [chat],
+        ):
+            with self.subTest(message):
+                with self.assertRaises(CodecError):
+                    CODECS["json"].decode(json.dumps(message).encode())
+
+
+if __name__ == "__main__":
+    unittest.main()
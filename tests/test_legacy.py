@@ -0,0 +1,80 @@
+"""A client from before topics, talking to an AsyncZMQManager.
+
+The old client subscribes to everything on the advertised port, reads each
+frame as a whole JSON message, and publishes its own the same way.
+
+    $ python -m pytest tests
+"""
+import asyncio
+import json
+import unittest
+
+import zmq
+import zmq.asyncio
+
+from lib.net.heartbeat import Heartbeat
+from lib.net.zmq import AsyncZMQManager, ZMQEventType
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+HOST = "127.0.0.1"
+PORT, OLD_PORT = 19900, 19910
+
+
+def chat(content: str, author: str, to: str) -> EventMessage:
+    return EventMessage(
+        EventType.MESSAGE_SENT,
+        ChatMessagePayload(content=content, author=author, to=to),
+    )
+
+
+class LegacyClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.manager = AsyncZMQManager("new", PORT)
+        ctx = zmq.asyncio.Context.instance()
+        # what the old client's Subscriber and Publisher did
+        self.sub = ctx.socket(zmq.SUB)
+        self.sub.connect(f"tcp://{HOST}:{PORT}")
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.pub = ctx.socket(zmq.PUB)
+        self.pub.bind(f"tcp://{HOST}:{OLD_PORT}")
+        # old clients advertise no "caps"
+        self.manager.on_discovered("old", f"{HOST}:{OLD_PORT}", {"username": "o"})
+        await asyncio.sleep(0.3)
+
+    async def asyncTearDown(self):
+        self.manager.close()
+        self.sub.close(linger=0)
+        self.pub.close(linger=0)
+
+    async def received_by_old(self) -> list:
+        messages = []
+        while await self.sub.poll(300):
+            # the old client's receive loop, which died on anything else
+            messages.append(json.loads(await self.sub.recv_string()))
+        return messages
+
+    async def test_old_client_reads_what_we_send(self):
+        heartbeat = Heartbeat(self.manager, interval=0.05)
+        heartbeat.start()
+        self.manager.send_nowait(chat("everyone", "new", "*"))
+        self.manager.send_nowait(chat("just you", "new", "old"), to="old")
+        messages = await self.received_by_old()
+        heartbeat.close()
+        contents = [m["payload"]["content"] for m in messages]
+        self.assertEqual(contents, ["everyone", "just you"])
+
+    async def test_we_read_what_old_client_sends(self):
+        message = {"type": 3, "payload": {"content": "hi", "author": "o", "to": "new"}}
+        await self.pub.send_string(json.dumps(message))
+        await asyncio.sleep(0.3)
+        events = []
+        while not self.manager._events.empty():
+            events += self.manager._events.get_nowait()
+        received = [
+            e.payload for e in events if e.type == ZMQEventType.MESSAGE_RECEIVED
+        ]
+        self.assertEqual(received, [("old", chat("hi", "o", "new"))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""ReliableDelivery between two AsyncZMQManagers on localhost.
+
+    $ python -m pytest tests
+"""
+import asyncio
+import unittest
+
+from lib.metrics import REGISTRY
+from lib.net.zmq import AsyncZMQManager, RELIABLE_CAPABILITY, ZMQEventType
+from lib.ui.event import ChatMessagePayload, EventMessage, EventType
+
+HOST = "127.0.0.1"
+PORTS = (19800, 19810)
+CAPS = {"caps": RELIABLE_CAPABILITY}
+
+
+def chat(id: int) -> EventMessage:
+    return EventMessage(
+        EventType.MESSAGE_SENT,
+        ChatMessagePayload(content=str(id), author="alice", to="bob", id=id),
+    )
+
+
+def drain(manager: AsyncZMQManager, type: ZMQEventType) -> list:
+    events = []
+    while not manager._events.empty():
+        events += manager._events.get_nowait()
+    return [e.payload[1].payload for e in events if e.type == type]
+
+
+class ReliableDeliveryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.alice = AsyncZMQManager("alice", PORTS[0], reliable=True)
+        self.bob = AsyncZMQManager("bob", PORTS[1], reliable=True)
+        self.alice.on_discovered("bob", f"{HOST}:{PORTS[1]}", CAPS)
+        self.bob.on_discovered("alice", f"{HOST}:{PORTS[0]}", CAPS)
+        await asyncio.sleep(0.3)
+
+    async def asyncTearDown(self):
+        self.alice.close()
+        self.bob.close()
+
+    async def send(self, ids) -> tuple:
+        for id in ids:
+            self.alice.send_nowait(chat(id), to="bob")
+        await asyncio.sleep(0.5)
+        received = drain(self.bob, ZMQEventType.MESSAGE_RECEIVED)
+        delivered = drain(self.alice, ZMQEventType.MESSAGE_DELIVERED)
+        return [int(m.content) for m in received], [m.id for m in delivered]
+
+    async def test_delivered(self):
+        self.assertEqual(await self.send([1, 2, 3]), ([1, 2, 3], [1, 2, 3]))
+
+    async def test_delivered_after_one_sided_flap(self):
+        await self.send([1, 2, 3])
+        # alice loses and finds bob again, so forgets her stream to him,
+        # while bob never noticed and still has his from her
+        self.alice.on_discovered("bob", None, {})
+        self.alice.on_discovered("bob", f"{HOST}:{PORTS[1]}", CAPS)
+        await asyncio.sleep(0.3)
+        self.assertEqual(await self.send([4, 5]), ([4, 5], [4, 5]))
+
+    async def test_abandoned_counted_after_peer_leaves(self):
+        abandoned = REGISTRY.counter("zmq.reliable.abandoned")
+        before = abandoned.read()
+        # bob goes away before he can ack
+        self.bob.close()
+        self.alice.send_nowait(chat(1), to="bob")
+        self.alice.on_discovered("bob", None, {})
+        self.assertEqual(abandoned.read() - before, 1)
+        self.assertIs(REGISTRY.counter("zmq.reliable.abandoned"), abandoned)
+
+
+if __name__ == "__main__":
+    unittest.main()
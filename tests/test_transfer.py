@@ -0,0 +1,73 @@
+"""FileTransfers between two AsyncZMQManagers on localhost.
+
+    $ python -m pytest tests
+"""
+import asyncio
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.net.transfer import FileTransfers
+from lib.net.zmq import AsyncZMQManager
+
+HOST = "127.0.0.1"
+PORTS = (19920, 19930)
+CAPS = {"caps": ""}
+
+
+class FileTransfersTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.alice = AsyncZMQManager("alice", PORTS[0])
+        self.bob = AsyncZMQManager("bob", PORTS[1])
+        self.alice.on_discovered("bob", f"{HOST}:{PORTS[1]}", CAPS)
+        self.bob.on_discovered("alice", f"{HOST}:{PORTS[0]}", CAPS)
+        self.sender = FileTransfers(self.alice, self.dir / "alice", chunk_size=1024)
+        self.receiver = FileTransfers(self.bob, self.dir / "bob", max_size=4096)
+        self.sender.start()
+        self.receiver.start()
+        await asyncio.sleep(0.3)
+
+    async def asyncTearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        self.alice.close()
+        self.bob.close()
+        self.tmp.cleanup()
+
+    async def send(self, size: int):
+        path = self.dir / "file"
+        path.write_bytes(bytes(range(256)) * (size // 256))
+        await asyncio.wait_for(self.sender.send_file("bob", path), 5)
+        return path
+
+    async def test_received(self):
+        path = await self.send(4096)
+        self.assertEqual((self.dir / "bob" / "file").read_bytes(), path.read_bytes())
+
+    async def test_refuses_over_max_size(self):
+        with self.assertRaisesRegex(ConnectionError, "refused"):
+            await self.send(8192)
+        self.assertFalse((self.dir / "bob" / "file").exists())
+
+    async def test_refuses_without_room(self):
+        with mock.patch("shutil.disk_usage", return_value=mock.Mock(free=1024)):
+            with self.assertRaisesRegex(ConnectionError, "not enough space"):
+                await self.send(4096)
+        self.assertEqual(list((self.dir / "bob").iterdir()), [])
+
+    async def test_close_fails_sends_in_progress(self):
+        # the receiver never answers, so the send waits until close()
+        self.receiver.close()
+        send = asyncio.ensure_future(self.send(4096))
+        await asyncio.sleep(0.3)
+        self.sender.close()
+        with self.assertRaisesRegex(ConnectionError, "closed"):
+            await send
+        self.assertEqual(self.receiver.incoming, {})
+
+
+if __name__ == "__main__":
+    unittest.main()